@@ -0,0 +1,128 @@
+# access_sweeper.py - Manutenção periódica do acesso materializado (tabela user_access)
+import os
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from postgrest.exceptions import APIError as PostgrestAPIError
+
+# --- Configurações ---
+ACCESS_SWEEP_SECONDS = int(os.getenv("ACCESS_SWEEP_SECONDS", "300"))
+ACCESS_FULL_REFRESH_SECONDS = int(os.getenv("ACCESS_FULL_REFRESH_SECONDS", "21600"))
+
+class AccessSweeper:
+    """
+    Mantém user_access atualizado: a cada ciclo desativa quem passou da data de expiração
+    (sweep_expired_user_access) e, com intervalo maior, recalcula todos os usuários
+    (refresh_user_access). Mutações de grupos recalculam os usuários afetados na hora.
+    Os usuários alterados são repassados a `ao_alterar` (descarte do perfil em cache).
+    """
+    def __init__(
+        self,
+        supabase_client: Any,
+        ao_alterar: Callable[[str], None],
+        intervalo_varredura: float = ACCESS_SWEEP_SECONDS,
+        intervalo_recalculo: float = ACCESS_FULL_REFRESH_SECONDS
+    ):
+        self.supabase_client = supabase_client
+        self.ao_alterar = ao_alterar
+        self.intervalo_varredura = intervalo_varredura
+        self.intervalo_recalculo = intervalo_recalculo
+        # None = ainda não verificado; False = migração sql/003_user_access.sql não aplicada
+        self.disponivel: Optional[bool] = None
+        self._pendentes: Set[asyncio.Task] = set()
+        self._tarefa: Optional[asyncio.Task] = None
+        self.stats = {'varreduras': 0, 'expirados': 0, 'recalculos': 0, 'usuarios_recalculados': 0, 'erros': 0}
+
+    async def _rpc(self, funcao: str, parametros: Dict[str, Any]):
+        if self.disponivel is False:
+            return None
+        try:
+            response = await self.supabase_client.rpc(funcao, parametros).execute()
+            self.disponivel = True
+            return response.data
+        except PostgrestAPIError as e:
+            if e.code != 'PGRST202':
+                raise
+            logging.warning(f"⚠️ Função {funcao} não encontrada; acesso materializado desativado")
+            self.disponivel = False
+            return None
+
+    async def varrer(self) -> int:
+        """Desativa os acessos vencidos; retorna quantos usuários perderam o acesso"""
+        expirados = await self._rpc('sweep_expired_user_access', {}) or []
+        self.stats['varreduras'] += 1
+        self.stats['expirados'] += len(expirados)
+        for linha in expirados:
+            self.ao_alterar(linha['user_id'])
+        if expirados:
+            logging.info(f"⏰ Acesso expirado para {len(expirados)} usuários")
+        return len(expirados)
+
+    async def recalcular(self, user_id: Optional[str] = None) -> int:
+        """Recalcula o acesso de um usuário ou, sem user_id, de todos"""
+        total = await self._rpc('refresh_user_access', {'p_user_id': user_id}) or 0
+        self.stats['recalculos'] += 1
+        self.stats['usuarios_recalculados'] += total
+        return total
+
+    async def _recalcular_e_notificar(self, user_ids: Optional[Iterable[str]]):
+        try:
+            if user_ids is None:
+                await self.recalcular()
+                self.ao_alterar(None)
+            else:
+                for user_id in user_ids:
+                    await self.recalcular(user_id)
+                    # Descarta de novo: uma requisição pode ter lido a linha antiga durante o recálculo
+                    self.ao_alterar(user_id)
+        except Exception as e:
+            self.stats['erros'] += 1
+            logging.error(f"Erro ao recalcular acesso materializado: {e}")
+
+    def agendar_recalculo(self, user_ids: Optional[Iterable[str]] = None):
+        """Agenda o recálculo após uma mutação (None = todos os usuários); exige event loop ativo"""
+        if self.disponivel is False:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        tarefa = loop.create_task(self._recalcular_e_notificar(list(user_ids) if user_ids is not None else None))
+        self._pendentes.add(tarefa)
+        tarefa.add_done_callback(self._pendentes.discard)
+
+    async def _executar(self):
+        desde_recalculo = 0.0
+        while True:
+            await asyncio.sleep(self.intervalo_varredura)
+            try:
+                desde_recalculo += self.intervalo_varredura
+                if desde_recalculo >= self.intervalo_recalculo:
+                    desde_recalculo = 0.0
+                    await self._recalcular_e_notificar(None)
+                else:
+                    await self.varrer()
+            except Exception as e:
+                self.stats['erros'] += 1
+                logging.error(f"Erro na varredura de acessos expirados: {e}")
+
+    async def iniciar(self):
+        """Executa uma varredura inicial e agenda as seguintes"""
+        try:
+            await self.varrer()
+        except Exception as e:
+            logging.error(f"Erro na varredura inicial de acessos: {e}")
+        if self.disponivel is not False and (self._tarefa is None or self._tarefa.done()):
+            self._tarefa = asyncio.create_task(self._executar())
+
+    async def parar(self):
+        tarefas = list(self._pendentes)
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            tarefas.append(self._tarefa)
+            self._tarefa = None
+        await asyncio.gather(*tarefas, return_exceptions=True)
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {**self.stats, 'disponivel': self.disponivel}
@@ -0,0 +1,198 @@
+# activity_log.py - Pipeline assíncrono e em lote para os logs de atividade (log_de_usuarios)
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+# --- Configurações ---
+ACTIVITY_LOG_QUEUE_SIZE = int(os.getenv("ACTIVITY_LOG_QUEUE_SIZE", "10000"))
+ACTIVITY_LOG_BATCH_SIZE = int(os.getenv("ACTIVITY_LOG_BATCH_SIZE", "200"))
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.getenv("ACTIVITY_LOG_FLUSH_SECONDS", "2"))
+ACTIVITY_LOG_NAME_CACHE_SECONDS = 10 * 60
+ACTIVITY_LOG_ENQUEUE_TIMEOUT_SECONDS = 0.5
+
+class ActivityLogWriter:
+    """
+    Recebe os eventos de log em uma fila limitada e grava em log_de_usuarios com inserts de
+    várias linhas, disparados por tamanho do lote ou por tempo. Nome e e-mail do usuário vêm
+    de caches (perfis e diretório do Auth). Com a fila cheia, eventos são descartados e contados.
+    """
+    def __init__(
+        self,
+        supabase_client: Any,
+        user_directory: Any,
+        tamanho_fila: int = ACTIVITY_LOG_QUEUE_SIZE,
+        tamanho_lote: int = ACTIVITY_LOG_BATCH_SIZE,
+        intervalo_segundos: float = ACTIVITY_LOG_FLUSH_SECONDS
+    ):
+        self.supabase_client = supabase_client
+        self.user_directory = user_directory
+        self.tamanho_fila = tamanho_fila
+        self.tamanho_lote = tamanho_lote
+        self.intervalo_segundos = intervalo_segundos
+        self._fila: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tarefa: Optional[asyncio.Task] = None
+        self._nomes: Dict[str, tuple] = {}
+        self.stats = {'enfileirados': 0, 'descartados': 0, 'gravados': 0, 'falhas': 0, 'lotes': 0}
+
+    # --- Entrada de eventos ---
+    @staticmethod
+    def _preparar(evento: Dict[str, Any]) -> Dict[str, Any]:
+        # O horário é o do evento, não o da gravação do lote
+        if not evento.get('created_at'):
+            evento['created_at'] = datetime.now(timezone.utc).isoformat()
+        return evento
+
+    def _enfileirar_nowait(self, evento: Dict[str, Any]):
+        try:
+            self._fila.put_nowait(evento)
+            self.stats['enfileirados'] += 1
+        except asyncio.QueueFull:
+            self.stats['descartados'] += 1
+            if self.stats['descartados'] % 1000 == 1:
+                logging.warning(f"LOG DE ATIVIDADE: fila cheia, {self.stats['descartados']} eventos descartados até agora")
+
+    def registrar(self, evento: Dict[str, Any]):
+        """Enfileira um evento sem bloquear; pode ser chamado do event loop ou de threads de background"""
+        evento = self._preparar(evento)
+        if self._fila is None:
+            self.stats['descartados'] += 1
+            logging.warning("LOG DE ATIVIDADE: pipeline não iniciado, evento descartado")
+            return
+        try:
+            em_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            em_loop = False
+        if em_loop:
+            self._enfileirar_nowait(evento)
+        else:
+            self._loop.call_soon_threadsafe(self._enfileirar_nowait, evento)
+
+    async def registrar_lote(self, eventos: Iterable[Dict[str, Any]], timeout: float = ACTIVITY_LOG_ENQUEUE_TIMEOUT_SECONDS) -> int:
+        """Enfileira vários eventos aguardando espaço na fila por até `timeout` (backpressure); retorna quantos entraram"""
+        eventos = [self._preparar(evento) for evento in eventos]
+        if self._fila is None:
+            self.stats['descartados'] += len(eventos)
+            return 0
+        aceitos = 0
+        limite = time.monotonic() + timeout
+        for evento in eventos:
+            restante = limite - time.monotonic()
+            try:
+                if restante > 0:
+                    await asyncio.wait_for(self._fila.put(evento), restante)
+                else:
+                    self._fila.put_nowait(evento)
+                aceitos += 1
+            except (asyncio.TimeoutError, asyncio.QueueFull):
+                break
+        self.stats['enfileirados'] += aceitos
+        self.stats['descartados'] += len(eventos) - aceitos
+        return aceitos
+
+    # --- Gravação ---
+    async def _resolver_usuarios(self, lote: List[Dict[str, Any]]):
+        """Preenche user_name e user_email a partir dos caches, buscando em lote apenas o que falta"""
+        user_ids = {evento['user_id'] for evento in lote if evento.get('user_id')}
+        if not user_ids:
+            return
+
+        agora = time.time()
+        sem_nome = [uid for uid in user_ids if uid not in self._nomes or agora - self._nomes[uid][1] > ACTIVITY_LOG_NAME_CACHE_SECONDS]
+        if sem_nome:
+            try:
+                response = await self.supabase_client.table('profiles').select('id, full_name').in_('id', sem_nome).execute()
+                for profile in response.data or []:
+                    self._nomes[profile['id']] = (profile.get('full_name'), agora)
+            except Exception as e:
+                logging.error(f"LOG DE ATIVIDADE: erro ao buscar nomes dos usuários: {e}")
+
+        emails = await self.user_directory.obter_emails(user_ids)
+
+        for evento in lote:
+            user_id = evento.get('user_id')
+            if not user_id:
+                continue
+            user_email = evento.get('user_email') or emails.get(user_id)
+            user_name = evento.get('user_name') or (self._nomes.get(user_id) or (None, 0))[0] or user_email
+            evento['user_email'] = user_email
+            evento['user_name'] = user_name
+
+    async def _gravar(self, lote: List[Dict[str, Any]]):
+        try:
+            await self._resolver_usuarios(lote)
+        except Exception as e:
+            logging.error(f"LOG DE ATIVIDADE: erro ao resolver usuários do lote: {e}")
+
+        # O PostgREST exige as mesmas colunas em todas as linhas de um insert
+        por_colunas: Dict[tuple, List[Dict[str, Any]]] = {}
+        for evento in lote:
+            por_colunas.setdefault(tuple(sorted(evento.keys())), []).append(evento)
+
+        for linhas in por_colunas.values():
+            try:
+                await self.supabase_client.table('log_de_usuarios').insert(linhas).execute()
+                self.stats['gravados'] += len(linhas)
+                self.stats['lotes'] += 1
+            except Exception as e:
+                self.stats['falhas'] += len(linhas)
+                logging.error(f"LOG DE ATIVIDADE: falha ao gravar {len(linhas)} eventos: {e}")
+
+    async def _executar(self):
+        while True:
+            lote = [await self._fila.get()]
+            prazo = time.monotonic() + self.intervalo_segundos
+            try:
+                while len(lote) < self.tamanho_lote:
+                    restante = prazo - time.monotonic()
+                    if restante <= 0:
+                        break
+                    try:
+                        lote.append(await asyncio.wait_for(self._fila.get(), restante))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # Encerramento: eventos já retirados da fila não podem se perder
+                await self._gravar(lote)
+                raise
+            await self._gravar(lote)
+
+    async def flush(self) -> int:
+        """Grava imediatamente tudo o que estiver na fila"""
+        pendentes = []
+        while self._fila is not None and not self._fila.empty():
+            pendentes.append(self._fila.get_nowait())
+        for inicio in range(0, len(pendentes), self.tamanho_lote):
+            await self._gravar(pendentes[inicio:inicio + self.tamanho_lote])
+        return len(pendentes)
+
+    # --- Ciclo de vida ---
+    def iniciar(self):
+        """Cria a fila no event loop atual e inicia o consumidor"""
+        if self._tarefa is not None and not self._tarefa.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        if self._fila is None:
+            self._fila = asyncio.Queue(maxsize=self.tamanho_fila)
+        self._tarefa = asyncio.create_task(self._executar())
+        logging.info(f"LOG DE ATIVIDADE: pipeline iniciado (lote {self.tamanho_lote}, intervalo {self.intervalo_segundos}s)")
+
+    async def parar(self):
+        """Interrompe o consumidor e grava os eventos restantes"""
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+        gravados = await self.flush()
+        if gravados:
+            logging.info(f"LOG DE ATIVIDADE: {gravados} eventos pendentes gravados no encerramento")
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'na_fila': self._fila.qsize() if self._fila is not None else 0,
+            'capacidade': self.tamanho_fila
+        }
@@ -0,0 +1,125 @@
+# auth_service.py - Verificação local dos tokens JWT emitidos pelo Supabase Auth
+import os
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+import jwt
+from pydantic import BaseModel
+
+# --- Configurações ---
+SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip('/')
+# Segredo HS256 do projeto (Settings > API > JWT Secret); projetos com chaves assimétricas usam o JWKS
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+SUPABASE_JWT_ISSUER = os.getenv("SUPABASE_JWT_ISSUER", f"{SUPABASE_URL}/auth/v1")
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL", f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json")
+JWKS_CACHE_SECONDS = int(os.getenv("JWKS_CACHE_SECONDS", "600"))
+JWT_LEEWAY_SECONDS = int(os.getenv("JWT_LEEWAY_SECONDS", "10"))
+AUTH_LOCAL_VERIFICATION = os.getenv("AUTH_LOCAL_VERIFICATION", "true").lower() == "true"
+# Quando ativo, confirma no Supabase Auth que a sessão do token não foi encerrada (logout, usuário removido)
+AUTH_REVOCATION_CHECK = os.getenv("AUTH_REVOCATION_CHECK", "false").lower() == "true"
+
+ALGORITMOS_ASSIMETRICOS = ('RS256', 'ES256')
+
+class TokenInvalidoError(Exception):
+    """Token ausente, malformado, expirado, com claims inválidas ou revogado"""
+    pass
+
+class UsuarioAutenticado(BaseModel):
+    id: str
+    email: Optional[str] = None
+    role: Optional[str] = None
+    session_id: Optional[str] = None
+
+class VerificadorJWT:
+    """
+    Valida os JWTs do Supabase localmente: assinatura (segredo HS256 ou JWKS em cache, com
+    recarga automática quando surge um 'kid' desconhecido), expiração, audience e issuer.
+    Sem material de chave configurado, recorre à validação remota via supabase.auth.get_user.
+    """
+    def __init__(self, supabase_client: Any):
+        self.supabase_client = supabase_client
+        self._jwks_client: Optional[jwt.PyJWKClient] = None
+        self.stats = {'local': 0, 'remoto': 0, 'rejeitados': 0}
+
+    def _obter_jwks_client(self) -> jwt.PyJWKClient:
+        if self._jwks_client is None:
+            self._jwks_client = jwt.PyJWKClient(SUPABASE_JWKS_URL, cache_keys=True, lifespan=JWKS_CACHE_SECONDS)
+        return self._jwks_client
+
+    async def _obter_chave(self, token: str, algoritmo: str) -> Optional[Any]:
+        if algoritmo == 'HS256':
+            return SUPABASE_JWT_SECRET
+        if algoritmo in ALGORITMOS_ASSIMETRICOS and SUPABASE_URL:
+            # O PyJWKClient só vai à rede quando o JWKS expira ou o 'kid' é desconhecido
+            chave = await asyncio.to_thread(self._obter_jwks_client().get_signing_key_from_jwt, token)
+            return chave.key
+        return None
+
+    async def _decodificar(self, token: str) -> Optional[Dict[str, Any]]:
+        """Retorna as claims validadas ou None se não houver chave para verificar localmente"""
+        try:
+            cabecalho = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as e:
+            raise TokenInvalidoError(f"Token malformado: {e}")
+
+        algoritmo = cabecalho.get('alg')
+        try:
+            chave = await self._obter_chave(token, algoritmo)
+        except jwt.PyJWKClientError as e:
+            logging.warning(f"⚠️ Falha ao obter chave do JWKS, usando validação remota: {e}")
+            return None
+        if not chave:
+            return None
+
+        try:
+            return jwt.decode(
+                token,
+                chave,
+                algorithms=[algoritmo],
+                audience=SUPABASE_JWT_AUDIENCE,
+                issuer=SUPABASE_JWT_ISSUER,
+                leeway=JWT_LEEWAY_SECONDS,
+                options={'require': ['exp', 'sub', 'aud']}
+            )
+        except jwt.ExpiredSignatureError:
+            raise TokenInvalidoError("Token expirado")
+        except jwt.PyJWTError as e:
+            raise TokenInvalidoError(f"Token inválido: {e}")
+
+    async def _validar_remotamente(self, token: str) -> UsuarioAutenticado:
+        user_response = await asyncio.to_thread(lambda: self.supabase_client.auth.get_user(token))
+        if not user_response or not user_response.user:
+            raise TokenInvalidoError("Token inválido ou expirado - usuário não encontrado")
+        user = user_response.user
+        return UsuarioAutenticado(id=user.id, email=user.email, role=getattr(user, 'role', None))
+
+    async def verificar(self, token: str) -> UsuarioAutenticado:
+        """Valida o token e retorna o usuário autenticado; levanta TokenInvalidoError se inválido"""
+        if not token:
+            raise TokenInvalidoError("Token ausente")
+
+        claims = None
+        try:
+            if AUTH_LOCAL_VERIFICATION:
+                claims = await self._decodificar(token)
+        except TokenInvalidoError:
+            self.stats['rejeitados'] += 1
+            raise
+
+        if claims is None:
+            self.stats['remoto'] += 1
+            return await self._validar_remotamente(token)
+
+        if AUTH_REVOCATION_CHECK:
+            # Lança TokenInvalidoError se a sessão tiver sido encerrada no Supabase
+            await self._validar_remotamente(token)
+
+        self.stats['local'] += 1
+        return UsuarioAutenticado(
+            id=claims['sub'],
+            email=claims.get('email'),
+            role=claims.get('role'),
+            session_id=claims.get('session_id')
+        )
@@ -0,0 +1,135 @@
+# cache_warmer.py - Pré-aquecimento do cache de buscas com os termos mais pesquisados
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# --- Configurações ---
+CACHE_WARM_ENABLED = os.getenv("CACHE_WARM_ENABLED", "true").lower() == "true"
+CACHE_WARM_TOP_N = int(os.getenv("CACHE_WARM_TOP_N", "50"))
+CACHE_WARM_DAYS = int(os.getenv("CACHE_WARM_DAYS", "7"))
+# Limite de linhas de log lidas por aquecimento (as mais recentes)
+CACHE_WARM_MAX_LOG_ROWS = int(os.getenv("CACHE_WARM_MAX_LOG_ROWS", "20000"))
+CACHE_WARM_PAGE_SIZE = 1000
+# Termos repassados a ao_contar (popularidade das sugestões)
+CACHE_WARM_MAX_TERMS = 500
+
+Busca = Tuple[str, Tuple[str, ...]]
+
+class SearchCacheWarmer:
+    """
+    Lê em log_de_usuarios as buscas dos últimos `dias` dias, agrupa por (termo, mercados) e
+    recalcula as `top_n` combinações mais frequentes, de modo que as buscas comuns já encontrem
+    o cache quente logo após a coleta. A contagem por termo (todos os mercados somados) é
+    repassada a `ao_contar` (popularidade das sugestões).
+
+    `aquecer_busca` é trabalho de CPU no event loop (o índice em memória também é alterado pelo
+    loop, então não pode ir para outra thread): as buscas rodam uma a uma, cedendo o loop entre
+    elas, e um retorno None (índice ainda não carregado) encerra a execução sem contar nada.
+    """
+    def __init__(
+        self,
+        supabase_client: Any,
+        aquecer_busca: Callable[[str, Optional[List[str]]], Awaitable[Any]],
+        ao_contar: Optional[Callable[[Dict[str, int]], Awaitable[None]]] = None,
+        top_n: int = CACHE_WARM_TOP_N,
+        dias: int = CACHE_WARM_DAYS
+    ):
+        self.supabase_client = supabase_client
+        self.aquecer_busca = aquecer_busca
+        self.ao_contar = ao_contar
+        self.top_n = top_n
+        self.dias = dias
+        self._tarefa: Optional[asyncio.Task] = None
+        self.stats = {'execucoes': 0, 'buscas_aquecidas': 0, 'falhas': 0, 'ultima_duracao_segundos': 0.0, 'ultima_execucao': None}
+
+    async def contar_buscas(self) -> Counter:
+        """Quantas vezes cada combinação (termo normalizado, cnpjs ordenados) foi pesquisada no período"""
+        desde = (datetime.now(timezone.utc) - timedelta(days=self.dias)).isoformat()
+        contagem: Counter = Counter()
+        for inicio in range(0, CACHE_WARM_MAX_LOG_ROWS, CACHE_WARM_PAGE_SIZE):
+            response = await (
+                self.supabase_client.table('log_de_usuarios')
+                .select('search_term, selected_markets')
+                .eq('action_type', 'search')
+                .gte('created_at', desde)
+                .order('created_at', desc=True)
+                .range(inicio, inicio + CACHE_WARM_PAGE_SIZE - 1)
+                .execute()
+            )
+            lote = response.data or []
+            for linha in lote:
+                termo = (linha.get('search_term') or '').lower().strip()
+                # Buscas de cesta são registradas como "[Cesta: nome]" e não passam por /api/search
+                if not termo or termo.startswith('[cesta'):
+                    continue
+                contagem[(termo, tuple(sorted(set(linha.get('selected_markets') or []))))] += 1
+            if len(lote) < CACHE_WARM_PAGE_SIZE:
+                break
+        return contagem
+
+    async def aquecer(self) -> int:
+        """Recalcula as buscas populares; retorna quantas foram aquecidas"""
+        if not CACHE_WARM_ENABLED:
+            return 0
+        inicio = time.perf_counter()
+        contagem = await self.contar_buscas()
+        buscas = [busca for busca, _ in contagem.most_common(self.top_n)]
+        if self.ao_contar:
+            por_termo: Counter = Counter()
+            for (termo, _), total in contagem.items():
+                por_termo[termo] += total
+            try:
+                await self.ao_contar(dict(por_termo.most_common(CACHE_WARM_MAX_TERMS)))
+            except Exception as e:
+                logging.error(f"Erro ao repassar a contagem de buscas: {e}")
+        aquecidas = 0
+        for termo, cnpjs in buscas:
+            try:
+                if await self.aquecer_busca(termo, list(cnpjs) or None) is None:
+                    logging.info("🔥 Índice de busca ainda não carregado: aquecimento do cache adiado")
+                    break
+                aquecidas += 1
+            except Exception as e:
+                self.stats['falhas'] += 1
+                logging.error(f"Erro ao aquecer a busca '{termo}': {e}")
+            # Cada busca é síncrona: cede o loop para as requisições entre uma e outra
+            await asyncio.sleep(0)
+
+        duracao = time.perf_counter() - inicio
+        self.stats['execucoes'] += 1
+        self.stats['buscas_aquecidas'] += aquecidas
+        self.stats['ultima_duracao_segundos'] = round(duracao, 2)
+        self.stats['ultima_execucao'] = datetime.now().isoformat()
+        logging.info(f"🔥 Cache de buscas aquecido: {aquecidas}/{len(buscas)} buscas em {duracao:.1f}s")
+        return aquecidas
+
+    async def _executar(self):
+        try:
+            await self.aquecer()
+        except Exception as e:
+            self.stats['falhas'] += 1
+            logging.error(f"Erro no aquecimento do cache de buscas: {e}")
+
+    def agendar(self):
+        """Dispara o aquecimento em background (ignorado se já houver um em andamento)"""
+        if self._tarefa is None or self._tarefa.done():
+            self._tarefa = asyncio.get_running_loop().create_task(self._executar())
+
+    async def parar(self):
+        if self._tarefa is not None and not self._tarefa.done():
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+        self._tarefa = None
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'habilitado': CACHE_WARM_ENABLED,
+            'em_andamento': self._tarefa is not None and not self._tarefa.done(),
+            'top_n': self.top_n,
+            'dias': self.dias
+        }
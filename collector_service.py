@@ -3,8 +3,10 @@ import aiohttp
 import hashlib
 from datetime import datetime, timedelta
 import logging
+import re
 import time
-from typing import Dict, Any, List, Optional
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Callable, AsyncIterator, Awaitable, Set, Tuple
 import unicodedata
 
 # --- Configurações Otimizadas ---
@@ -14,6 +16,11 @@ RETRY_MAX = 3
 RETRY_BASE_MS = 2000
 CONCORRENCIA_PRODUTOS = 4
 TIMEOUT_POR_MERCADO_SEGUNDOS = 20 * 60
+REALTIME_WRITEBACK_LOTE = 500
+REALTIME_WRITEBACK_INTERVALO_SEGUNDOS = 5
+REALTIME_CACHE_TTL_SEGUNDOS = 10 * 60
+REALTIME_CACHE_MAX_ENTRADAS = 5000
+CONCORRENCIA_CESTA = 8
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
 
@@ -45,68 +52,163 @@ def detectar_tipo_unidade(nome_produto: str, unidade_medida_api: str) -> str:
         if palavra in nome_lower or palavra in unidade_lower: return 'KG'
     return 'UN'
 
+# --- Preço por unidade base (KG, L, UN) ---
+_FATORES_UNIDADE = {
+    'kg': ('KG', 1.0), 'kgs': ('KG', 1.0), 'quilo': ('KG', 1.0), 'quilos': ('KG', 1.0),
+    'g': ('KG', 0.001), 'gr': ('KG', 0.001), 'grs': ('KG', 0.001), 'grama': ('KG', 0.001), 'gramas': ('KG', 0.001),
+    'mg': ('KG', 0.000001),
+    'l': ('L', 1.0), 'lt': ('L', 1.0), 'lts': ('L', 1.0), 'litro': ('L', 1.0), 'litros': ('L', 1.0),
+    'ml': ('L', 0.001),
+}
+_UNIDADES_REGEX = '|'.join(sorted(_FATORES_UNIDADE, key=len, reverse=True))
+# "6X170G", "12 x 1,5L": embalagem múltipla
+_EMBALAGEM_MULTIPLA = re.compile(rf'(\d+)\s*x\s*(\d+(?:[.,]\d+)?)\s*({_UNIDADES_REGEX})\b')
+# "5KG", "1,5 L", "900ML"
+_EMBALAGEM_SIMPLES = re.compile(rf'(\d+(?:[.,]\d+)?)\s*({_UNIDADES_REGEX})\b')
+# "C/12", "30UN", "12 UNIDADES", "12 ROLOS", "3 PACOTES": itens na embalagem (sozinhos ou multiplicando o tamanho)
+_EMBALAGEM_CONTAGEM = re.compile(
+    r'(?:\bc/\s*(\d+)\b|(?<![\d.,])(\d+)\s*(?:un|und|unid|unidades?|rolos?|pacotes?|pcts?|latas?)\b)'
+)
+
+@lru_cache(maxsize=50000)
+def extrair_embalagem(descricao: str, unidade_medida_api: str = '') -> Tuple[float, str]:
+    """
+    Quantidade da embalagem na unidade base (KG, L ou UN) a partir da descrição: o tamanho é
+    multiplicado pela contagem de itens ("6X170G", "350ML C/12"); só a contagem ("12 ROLOS") dá UN.
+    Itens vendidos a granel (unidade da API em KG/L) têm preço já por unidade base; sem tamanho
+    reconhecido, 1 UN.
+    """
+    unidade_api = (unidade_medida_api or '').strip().lower()
+    if unidade_api in ('kg', 'l', 'lt'):
+        return 1.0, _FATORES_UNIDADE[unidade_api][0]
+    texto = (descricao or '').lower()
+    contagem = _EMBALAGEM_CONTAGEM.search(texto)
+    itens = int(next(g for g in contagem.groups() if g)) if contagem else None
+    encontrado = _EMBALAGEM_MULTIPLA.search(texto)
+    if encontrado:
+        base, fator = _FATORES_UNIDADE[encontrado.group(3)]
+        quantidade = int(encontrado.group(1)) * float(encontrado.group(2).replace(',', '.')) * fator
+    else:
+        encontrado = _EMBALAGEM_SIMPLES.search(texto)
+        if encontrado:
+            # "350ML C/12", "85G 4 UN": o tamanho é de cada item, como no NxTAMANHO
+            base, fator = _FATORES_UNIDADE[encontrado.group(2)]
+            quantidade = float(encontrado.group(1).replace(',', '.')) * fator * (itens or 1)
+        else:
+            base, quantidade = 'UN', float(itens or 1)
+    if quantidade <= 0:
+        return 1.0, 'UN'
+    return round(quantidade, 6), base
+
+def anotar_precos_unitarios(registros: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Grava em cada registro quantidade_embalagem, unidade_base e preco_unitario (preço por KG, L ou
+    UN). Roda em lote na ingestão; descrições repetidas entre mercados e páginas saem do cache.
+    """
+    for registro in registros:
+        quantidade, base = extrair_embalagem(registro.get('nome_produto') or '', registro.get('unidade_medida') or '')
+        registro['quantidade_embalagem'] = quantidade
+        registro['unidade_base'] = base
+        try:
+            registro['preco_unitario'] = round(float(registro['preco_produto']) / quantidade, 4)
+        except (KeyError, TypeError, ValueError):
+            registro['preco_unitario'] = None
+    return registros
+
+# --- Gravação em produtos ---
+COLUNAS_PRECO_UNITARIO = ('quantidade_embalagem', 'unidade_base', 'preco_unitario')
+# None = ainda não verificado; False = migração sql/008_unit_prices.sql não aplicada
+precos_unitarios_disponivel: Optional[bool] = None
+
+def _coluna_preco_unitario_ausente(erro: Exception) -> bool:
+    """PGRST204/42703: coluna inexistente; só conta se for uma das colunas de preço unitário"""
+    return getattr(erro, 'code', None) in ('PGRST204', '42703') and any(coluna in str(erro) for coluna in COLUNAS_PRECO_UNITARIO)
+
+def upsert_produtos(supabase_client: Any, dados: List[Dict[str, Any]], ignorar_duplicados: bool = False):
+    """
+    Upsert em produtos por id_registro (ignorar_duplicados: on conflict do nothing). Sem a migração 008
+    as colunas de preço unitário não existem: detectado no primeiro erro, elas passam a ser retiradas
+    dos registros e a ingestão continua.
+    """
+    global precos_unitarios_disponivel
+    if precos_unitarios_disponivel is False:
+        dados = [{k: v for k, v in item.items() if k not in COLUNAS_PRECO_UNITARIO} for item in dados]
+    try:
+        supabase_client.table('produtos').upsert(dados, on_conflict='id_registro', ignore_duplicates=ignorar_duplicados).execute()
+    except Exception as e:
+        if precos_unitarios_disponivel is False or not _coluna_preco_unitario_ausente(e):
+            raise
+        logging.warning("⚠️ Colunas de preço unitário não encontradas em produtos (sql/008); gravando sem elas")
+        precos_unitarios_disponivel = False
+        return upsert_produtos(supabase_client, dados, ignorar_duplicados)
+    if precos_unitarios_disponivel is None and any('preco_unitario' in item for item in dados):
+        precos_unitarios_disponivel = True
+
 # --- Lógica Principal de Coleta ---
-async def consultar_produto(produto: str, mercado: Dict[str, str], data_coleta: str, token: str, coleta_id: int, dias_pesquisa: int = 3) -> List[Dict[str, Any]]:
+async def consultar_produto(produto: str, mercado: Dict[str, str], data_coleta: str, token: str, coleta_id: int, dias_pesquisa: int = 3, session: Optional[aiohttp.ClientSession] = None) -> List[Dict[str, Any]]:
+    if session is None:
+        async with aiohttp.ClientSession() as nova_sessao:
+            return await consultar_produto(produto, mercado, data_coleta, token, coleta_id, dias_pesquisa, session=nova_sessao)
+
     cnpj = mercado['cnpj']
     pagina = 1
     todos_os_itens = []
-    async with aiohttp.ClientSession() as session:
-        while True:
-            request_body = {
-                "produto": {"descricao": produto.upper()}, 
-                "estabelecimento": {"individual": {"cnpj": cnpj}},
-                "dias": dias_pesquisa,
-                "pagina": pagina, 
-                "registrosPorPagina": REGISTROS_POR_PAGINA
+    while True:
+        request_body = {
+            "produto": {"descricao": produto.upper()}, 
+            "estabelecimento": {"individual": {"cnpj": cnpj}},
+            "dias": dias_pesquisa,
+            "pagina": pagina, 
+            "registrosPorPagina": REGISTROS_POR_PAGINA
+        }
+        headers = {'AppToken': token, 'Content-Type': 'application/json'}
+        response_data = None
+        for attempt in range(RETRY_MAX):
+            try:
+                await asyncio.sleep(0.3)
+                async with session.post(ECONOMIZA_ALAGOAS_API_URL, json=request_body, headers=headers, timeout=45) as response:
+                    if response.status == 200:
+                        response_data = await response.json(); break
+                    else:
+                        logging.warning(f"API ERRO: Status {response.status} para '{produto}' em {mercado['nome']}. Tentativa {attempt + 1}/{RETRY_MAX} - Dias: {dias_pesquisa}")
+                        await asyncio.sleep((RETRY_BASE_MS / 1000) * (2 ** attempt))
+            except Exception as e:
+                logging.error(f"CONEXÃO ERRO para '{produto}' em {mercado['nome']}: {e}. Tentativa {attempt + 1}/{RETRY_MAX} - Dias: {dias_pesquisa}")
+                await asyncio.sleep((RETRY_BASE_MS / 1000) * (2 ** attempt))
+        if not response_data:
+            logging.error(f"FALHA TOTAL ao coletar '{produto}' em {mercado['nome']} - Dias: {dias_pesquisa}."); return []
+        conteudo = response_data.get('conteudo', [])
+        for item in conteudo:
+            prod_info = item.get('produto', {}); venda_info = prod_info.get('venda', {})
+            nome_produto_original = prod_info.get('descricao', ''); unidade_medida_original = prod_info.get('unidadeMedida', '')
+            registro = {
+                'nome_supermercado': mercado['nome'], 
+                'cnpj_supermercado': cnpj,
+                'nome_produto': nome_produto_original, 
+                'nome_produto_normalizado': normalizar_texto(nome_produto_original),
+                'id_produto': prod_info.get('gtin') or normalizar_texto(f"{nome_produto_original}_{unidade_medida_original}"),
+                'preco_produto': venda_info.get('valorVenda'), 
+                'unidade_medida': unidade_medida_original,
+                'data_ultima_venda': venda_info.get('dataVenda'), 
+                'data_coleta': data_coleta, 
+                'codigo_barras': prod_info.get('gtin'), 
+                'tipo_unidade': detectar_tipo_unidade(nome_produto_original, unidade_medida_original),
+                'coleta_id': coleta_id,
+                'ncm': prod_info.get('ncm')  # NOVO CAMPO ADICIONADO
             }
-            headers = {'AppToken': token, 'Content-Type': 'application/json'}
-            response_data = None
-            for attempt in range(RETRY_MAX):
-                try:
-                    await asyncio.sleep(0.3)
-                    async with session.post(ECONOMIZA_ALAGOAS_API_URL, json=request_body, headers=headers, timeout=45) as response:
-                        if response.status == 200:
-                            response_data = await response.json(); break
-                        else:
-                            logging.warning(f"API ERRO: Status {response.status} para '{produto}' em {mercado['nome']}. Tentativa {attempt + 1}/{RETRY_MAX} - Dias: {dias_pesquisa}")
-                            await asyncio.sleep((RETRY_BASE_MS / 1000) * (2 ** attempt))
-                except Exception as e:
-                    logging.error(f"CONEXÃO ERRO para '{produto}' em {mercado['nome']}: {e}. Tentativa {attempt + 1}/{RETRY_MAX} - Dias: {dias_pesquisa}")
-                    await asyncio.sleep((RETRY_BASE_MS / 1000) * (2 ** attempt))
-            if not response_data:
-                logging.error(f"FALHA TOTAL ao coletar '{produto}' em {mercado['nome']} - Dias: {dias_pesquisa}."); return []
-            conteudo = response_data.get('conteudo', [])
-            for item in conteudo:
-                prod_info = item.get('produto', {}); venda_info = prod_info.get('venda', {})
-                nome_produto_original = prod_info.get('descricao', ''); unidade_medida_original = prod_info.get('unidadeMedida', '')
-                registro = {
-                    'nome_supermercado': mercado['nome'], 
-                    'cnpj_supermercado': cnpj,
-                    'nome_produto': nome_produto_original, 
-                    'nome_produto_normalizado': normalizar_texto(nome_produto_original),
-                    'id_produto': prod_info.get('gtin') or normalizar_texto(f"{nome_produto_original}_{unidade_medida_original}"),
-                    'preco_produto': venda_info.get('valorVenda'), 
-                    'unidade_medida': unidade_medida_original,
-                    'data_ultima_venda': venda_info.get('dataVenda'), 
-                    'data_coleta': data_coleta, 
-                    'codigo_barras': prod_info.get('gtin'), 
-                    'tipo_unidade': detectar_tipo_unidade(nome_produto_original, unidade_medida_original),
-                    'coleta_id': coleta_id,
-                    'ncm': prod_info.get('ncm')  # NOVO CAMPO ADICIONADO
-                }
-
-                # ✅ ADICIONAR ENDEREÇO APENAS SE ESTIVER DISPONÍVEL (apenas na coleta completa)
-                if 'endereco' in mercado and mercado['endereco']:
-                    registro['endereco_supermercado'] = mercado['endereco']
-
-                if registro['preco_produto'] is not None:
-                    registro['id_registro'] = gerar_id_registro(registro)
-                    todos_os_itens.append(registro)
-            total_paginas = response_data.get('totalPaginas', 1)
-            logging.info(f"Coletado: {mercado['nome']} - '{produto}' - Página {pagina}/{total_paginas} - Itens: {len(conteudo)} - Dias: {dias_pesquisa}")
-            if pagina >= total_paginas: break
-            pagina += 1
-    return todos_os_itens
+
+            # ✅ ADICIONAR ENDEREÇO APENAS SE ESTIVER DISPONÍVEL (apenas na coleta completa)
+            if 'endereco' in mercado and mercado['endereco']:
+                registro['endereco_supermercado'] = mercado['endereco']
+
+            if registro['preco_produto'] is not None:
+                registro['id_registro'] = gerar_id_registro(registro)
+                todos_os_itens.append(registro)
+        total_paginas = response_data.get('totalPaginas', 1)
+        logging.info(f"Coletado: {mercado['nome']} - '{produto}' - Página {pagina}/{total_paginas} - Itens: {len(conteudo)} - Dias: {dias_pesquisa}")
+        if pagina >= total_paginas: break
+        pagina += 1
+    return anotar_precos_unitarios(todos_os_itens)
 
 # FUNÇÃO PARA BUSCA EM TEMPO REAL (MANTÉM 3 DIAS FIXOS)
 async def consultar_produto_realtime(produto: str, mercado: Dict[str, str], data_coleta: str, token: str, coleta_id: int) -> List[Dict[str, Any]]:
@@ -115,7 +217,242 @@ async def consultar_produto_realtime(produto: str, mercado: Dict[str, str], data
     """
     return await consultar_produto(produto, mercado, data_coleta, token, coleta_id, dias_pesquisa=3)
 
-async def coletar_dados_mercado(mercado: Dict[str, Any], token: str, supabase_client: Any, status_tracker: Dict[str, Any], coleta_id: int, dias_pesquisa: int):
+# --- Cache e planejamento da busca em tempo real de cestas ---
+class RealtimeCache:
+    """
+    Cache em memória dos resultados em tempo real por (termo normalizado, cnpj).
+    Apenas resultados não vazios são guardados, para que uma falha não seja reaproveitada.
+    """
+    def __init__(self, ttl_segundos: float = REALTIME_CACHE_TTL_SEGUNDOS, max_entradas: int = REALTIME_CACHE_MAX_ENTRADAS):
+        self.ttl_segundos = ttl_segundos
+        self.max_entradas = max_entradas
+        self._dados: Dict[tuple, tuple] = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __len__(self) -> int:
+        return len(self._dados)
+
+    @staticmethod
+    def normalizar_termo(termo: str) -> str:
+        return ' '.join(remover_acentos(termo or '').split())
+
+    def obter(self, termo: str, cnpj: str) -> Optional[List[Dict[str, Any]]]:
+        chave = (self.normalizar_termo(termo), cnpj)
+        entrada = self._dados.get(chave)
+        if entrada is None or time.time() - entrada[0] > self.ttl_segundos:
+            self._dados.pop(chave, None)
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        # Cópias, pois os chamadores anotam os registros (idade_horas, origem...)
+        return [dict(registro) for registro in entrada[1]]
+
+    def guardar(self, termo: str, cnpj: str, registros: List[Dict[str, Any]]):
+        if not registros:
+            return
+        if len(self._dados) >= self.max_entradas:
+            self._remover_expirados()
+            if len(self._dados) >= self.max_entradas:
+                self._dados.pop(min(self._dados, key=lambda k: self._dados[k][0]), None)
+        self._dados[(self.normalizar_termo(termo), cnpj)] = (time.time(), [dict(registro) for registro in registros])
+
+    def _remover_expirados(self):
+        limite = time.time() - self.ttl_segundos
+        for chave in [c for c, (criado_em, _) in self._dados.items() if criado_em < limite]:
+            self._dados.pop(chave, None)
+
+async def planejar_cesta_realtime(
+    produtos: List[str],
+    mercados: List[Dict[str, str]],
+    token: str,
+    cache: Optional[RealtimeCache] = None,
+    concorrencia: int = CONCORRENCIA_CESTA,
+    ao_consultar: Optional[Callable[[List[Dict[str, Any]]], None]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Precifica uma cesta em tempo real: deduplica os termos, reaproveita o cache e consulta
+    os pares (termo, mercado) restantes com um número limitado de workers e uma única sessão HTTP.
+    Gera um evento por produto concluído, na ordem de conclusão.
+    """
+    termos: Dict[str, str] = {}
+    for produto in produtos:
+        chave = RealtimeCache.normalizar_termo(produto)
+        if chave and chave not in termos:
+            termos[chave] = produto.strip()
+
+    total = len(termos)
+    if not total or not mercados:
+        return
+
+    resultados: Dict[str, List[Dict[str, Any]]] = {chave: [] for chave in termos}
+    falhas: Dict[str, List[str]] = {chave: [] for chave in termos}
+    em_cache: Dict[str, int] = {chave: 0 for chave in termos}
+    pendentes: Dict[str, int] = {chave: len(mercados) for chave in termos}
+    fila: asyncio.Queue = asyncio.Queue()
+    concluidos_fila: asyncio.Queue = asyncio.Queue()
+    concluidos = 0
+
+    for chave, termo in termos.items():
+        for mercado in mercados:
+            registros = cache.obter(termo, mercado['cnpj']) if cache else None
+            if registros is not None:
+                resultados[chave].extend(registros)
+                em_cache[chave] += 1
+                pendentes[chave] -= 1
+            else:
+                fila.put_nowait((chave, termo, mercado))
+
+    def montar_evento(chave: str) -> Dict[str, Any]:
+        nonlocal concluidos
+        concluidos += 1
+        return {
+            'produto': termos[chave],
+            'resultados': resultados[chave],
+            'mercados_em_cache': em_cache[chave],
+            'mercados_com_falha': falhas[chave],
+            'concluidos': concluidos,
+            'total_produtos': total
+        }
+
+    for chave in [c for c, restantes in pendentes.items() if restantes == 0]:
+        yield montar_evento(chave)
+
+    if fila.empty():
+        return
+
+    async def worker(session: aiohttp.ClientSession):
+        while True:
+            try:
+                chave, termo, mercado = fila.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                registros = await consultar_produto(termo, mercado, datetime.now().isoformat(), token, -1, dias_pesquisa=3, session=session)
+                if cache:
+                    cache.guardar(termo, mercado['cnpj'], registros)
+                if ao_consultar and registros:
+                    ao_consultar(registros)
+                resultados[chave].extend(registros)
+            except Exception as e:
+                logging.error(f"Falha na busca em tempo real de cesta para '{termo}' no CNPJ {mercado['cnpj']}: {e}")
+                falhas[chave].append(mercado['cnpj'])
+            concluidos_fila.put_nowait(chave)
+
+    logging.info(f"CESTA: {total} produtos x {len(mercados)} mercados - {fila.qsize()} consultas, {sum(em_cache.values())} do cache")
+    conector = aiohttp.TCPConnector(limit=concorrencia)
+    async with aiohttp.ClientSession(connector=conector) as session:
+        workers = [asyncio.create_task(worker(session)) for _ in range(min(concorrencia, fila.qsize()))]
+        try:
+            while concluidos < total:
+                chave = await concluidos_fila.get()
+                pendentes[chave] -= 1
+                if pendentes[chave] == 0:
+                    yield montar_evento(chave)
+        finally:
+            # Se o consumidor desistir (ex.: cliente desconectou), as consultas restantes são canceladas
+            for tarefa in workers:
+                tarefa.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+# --- Write-back dos resultados em tempo real ---
+class RealtimeWriteBack:
+    """
+    Acumula os resultados das buscas em tempo real e os grava em lote na tabela produtos,
+    deduplicados por id_registro e marcados com origem 'realtime'. Só insere: vendas que já existem
+    em produtos (coleta completa ou write-back anterior) não são sobrescritas.
+    """
+    def __init__(self, supabase_client: Any, tamanho_lote: int = REALTIME_WRITEBACK_LOTE, intervalo_segundos: float = REALTIME_WRITEBACK_INTERVALO_SEGUNDOS):
+        self.supabase_client = supabase_client
+        self.tamanho_lote = tamanho_lote
+        self.intervalo_segundos = intervalo_segundos
+        self.pendentes: Dict[str, Dict[str, Any]] = {}
+        self.enderecos: Optional[Dict[str, Optional[str]]] = None
+        self._lock = asyncio.Lock()
+        self._tarefa_flush: Optional[asyncio.Task] = None
+        # Flushes disparados por tamanho: a referência evita que a tarefa seja coletada no meio da gravação
+        self._tarefas_lote: Set[asyncio.Task] = set()
+        self.stats = {'recebidos': 0, 'duplicados': 0, 'salvos': 0, 'falhas': 0, 'lotes': 0}
+
+    def adicionar(self, registros: List[Dict[str, Any]]):
+        """Enfileira registros para gravação; o flush ocorre por tamanho ou após o intervalo"""
+        for registro in registros:
+            if registro.get('preco_produto') is None or not registro.get('id_registro'):
+                continue
+            self.stats['recebidos'] += 1
+            if registro['id_registro'] in self.pendentes:
+                self.stats['duplicados'] += 1
+            self.pendentes[registro['id_registro']] = registro
+
+        if not self.pendentes:
+            return
+        if len(self.pendentes) >= self.tamanho_lote:
+            tarefa = asyncio.get_running_loop().create_task(self.flush())
+            self._tarefas_lote.add(tarefa)
+            tarefa.add_done_callback(self._lote_finalizado)
+        elif self._tarefa_flush is None or self._tarefa_flush.done():
+            self._tarefa_flush = asyncio.get_running_loop().create_task(self._flush_agendado())
+
+    def _lote_finalizado(self, tarefa: asyncio.Task):
+        self._tarefas_lote.discard(tarefa)
+        if not tarefa.cancelled() and tarefa.exception() is not None:
+            logging.error(f"WRITE-BACK: Falha no flush em lote: {tarefa.exception()}")
+
+    async def _flush_agendado(self):
+        await asyncio.sleep(self.intervalo_segundos)
+        await self.flush()
+
+    async def _carregar_enderecos(self):
+        try:
+            response = await asyncio.to_thread(
+                self.supabase_client.table('supermercados').select('cnpj, endereco').execute
+            )
+            self.enderecos = {m['cnpj']: m.get('endereco') for m in response.data or []}
+        except Exception as e:
+            logging.error(f"WRITE-BACK: Falha ao carregar endereços dos mercados: {e}")
+            self.enderecos = {}
+
+    def _preparar(self, registro: Dict[str, Any]) -> Dict[str, Any]:
+        item = {k: v for k, v in registro.items() if k not in ('id_produto', 'idade_horas', 'status_preco')}
+        endereco = (self.enderecos or {}).get(item.get('cnpj_supermercado'))
+        # Com o endereço, o id_registro coincide com o da coleta completa para a mesma venda
+        if endereco and not item.get('endereco_supermercado'):
+            item['endereco_supermercado'] = endereco
+            item['id_registro'] = gerar_id_registro({**item, 'id_produto': registro.get('id_produto')})
+        item['coleta_id'] = None
+        item['origem'] = 'realtime'
+        return item
+
+    async def flush(self) -> int:
+        """Grava todos os registros pendentes em lotes de upsert"""
+        async with self._lock:
+            if not self.pendentes:
+                return 0
+            if self.enderecos is None:
+                await self._carregar_enderecos()
+
+            lote_atual = list(self.pendentes.values())
+            self.pendentes = {}
+            dados_para_db = list({item['id_registro']: item for item in map(self._preparar, lote_atual)}.values())
+
+            salvos = 0
+            for inicio in range(0, len(dados_para_db), self.tamanho_lote):
+                bloco = dados_para_db[inicio:inicio + self.tamanho_lote]
+                try:
+                    # Venda já gravada pela coleta completa (mesmo id_registro) fica intacta: coleta_id e
+                    # origem da coleta continuam valendo para detalhes e limpeza por coleta
+                    await asyncio.to_thread(upsert_produtos, self.supabase_client, bloco, True)
+                    salvos += len(bloco)
+                    self.stats['lotes'] += 1
+                except Exception as e:
+                    self.stats['falhas'] += len(bloco)
+                    logging.error(f"WRITE-BACK: Falha ao salvar {len(bloco)} registros em tempo real: {e}")
+
+            self.stats['salvos'] += salvos
+            if salvos:
+                logging.info(f"WRITE-BACK: {salvos} registros em tempo real salvos em produtos")
+            return salvos
+
+async def coletar_dados_mercado(mercado: Dict[str, Any], token: str, supabase_client: Any, status_tracker: Dict[str, Any], coleta_id: int, dias_pesquisa: int, ao_salvar: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
     produtos_a_buscar = status_tracker['produtos_lista']
     total_produtos = len(produtos_a_buscar)
     registros_salvos_neste_mercado = 0
@@ -142,20 +479,25 @@ async def coletar_dados_mercado(mercado: Dict[str, Any], token: str, supabase_cl
     if resultados_unicos_lista:
         dados_para_db = [{k: v for k, v in item.items() if k != 'id_produto'} for item in resultados_unicos_lista]
         try:
-            supabase_client.table('produtos').upsert(dados_para_db, on_conflict='id_registro').execute()
+            upsert_produtos(supabase_client, dados_para_db)
             registros_salvos_neste_mercado = len(dados_para_db)
             logging.info(f"-----> SUPABASE SUCESSO: {registros_salvos_neste_mercado} salvos para {mercado['nome']}. (Dias: {dias_pesquisa})")
+            if ao_salvar:
+                try:
+                    ao_salvar(resultados_unicos_lista)
+                except Exception as e:
+                    logging.error(f"Erro ao repassar registros salvos de {mercado['nome']}: {e}")
         except Exception as e:
             logging.error(f"-----> SUPABASE ERRO: Falha ao salvar para {mercado['nome']}: {e}")
 
     return registros_salvos_neste_mercado
 
-async def coletar_dados_mercado_com_timeout(mercado: Dict[str, Any], token: str, supabase_client: Any, status_tracker: Dict[str, Any], coleta_id: int, dias_pesquisa: int):
+async def coletar_dados_mercado_com_timeout(mercado: Dict[str, Any], token: str, supabase_client: Any, status_tracker: Dict[str, Any], coleta_id: int, dias_pesquisa: int, ao_salvar: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
     start_time_market = time.time()
     registros_salvos = 0
     try:
         registros_salvos = await asyncio.wait_for(
-            coletar_dados_mercado(mercado, token, supabase_client, status_tracker, coleta_id, dias_pesquisa),
+            coletar_dados_mercado(mercado, token, supabase_client, status_tracker, coleta_id, dias_pesquisa, ao_salvar),
             timeout=TIMEOUT_POR_MERCADO_SEGUNDOS
         )
     except asyncio.TimeoutError:
@@ -192,10 +534,14 @@ async def run_full_collection(
     token: str, 
     status_tracker: Dict[str, Any],
     selected_markets: Optional[List[str]] = None,
-    dias_pesquisa: int = 3
+    dias_pesquisa: int = 3,
+    ao_salvar: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+    ao_finalizar: Optional[Callable[[], Awaitable[None]]] = None
 ):
     """
-    Executa coleta completa com opções flexíveis
+    Executa coleta completa com opções flexíveis. `ao_salvar` recebe os registros de cada
+    mercado assim que são gravados (atualização incremental do índice de busca) e `ao_finalizar`
+    é aguardado ao fim da coleta, com ou sem falha (os mercados já gravados continuam valendo).
     """
     logging.info(f"🎯 INICIANDO COLETA - Mercados: {len(selected_markets) if selected_markets else 'Todos'}, Dias: {dias_pesquisa}")
 
@@ -345,7 +691,7 @@ async def run_full_collection(
         total_registros_salvos = 0
         for mercado in MERCADOS:
             registros_salvos = await coletar_dados_mercado_com_timeout(
-                mercado, token, supabase_client, status_tracker, coleta_id, dias_pesquisa
+                mercado, token, supabase_client, status_tracker, coleta_id, dias_pesquisa, ao_salvar
             )
             total_registros_salvos += registros_salvos
 
@@ -379,3 +725,9 @@ async def run_full_collection(
                 'status': 'falhou', 
                 'finalizada_em': datetime.now().isoformat()
             }).eq('id', coleta_id).execute()
+    finally:
+        if ao_finalizar:
+            try:
+                await ao_finalizar()
+            except Exception as e:
+                logging.error(f"Erro no callback de fim da coleta: {e}")
@@ -6,7 +6,6 @@ from typing import List, Optional, Dict, Any, Tuple
 from datetime import date, datetime, timedelta
 from pydantic import BaseModel, Field
 import logging
-import asyncio
 import pandas as pd
 import numpy as np
 import json
@@ -20,7 +19,9 @@ import warnings
 warnings.filterwarnings('ignore')
 
 # Importar dependências compartilhadas
-from dependencies import get_current_user, UserProfile, require_page_access, supabase, supabase_admin
+from dependencies import get_current_user, UserProfile, require_page_access
+from database import db, db_admin
+from repository import repositorio
 
 # Configuração de Logs
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
@@ -216,6 +217,46 @@ VOLATILITY_THRESHOLD = 0.15  # 15% de volatilidade
 BARGAIN_THRESHOLD = 0.10     # 10% de economia mínima
 PRICE_ALERT_THRESHOLD = 0.08 # 8% de variação para alerta
 
+class _CodigosLocais:
+    """
+    Códigos inteiros estáveis no processo para quando as linhas ainda não trazem os ids do
+    dicionário canônico (sql/006 não aplicado). São negativos para não colidir com os ids do banco.
+    """
+    def __init__(self):
+        self._codigos: Dict[str, int] = {}
+
+    def codificar(self, chaves: pd.Series) -> np.ndarray:
+        # factorize hasheia cada string uma vez; o dicionário só vê os valores distintos
+        posicoes, valores = pd.factorize(chaves)
+        codigos = np.array([self._codigos.setdefault(valor, -(len(self._codigos) + 1)) for valor in valores] + [0], dtype=np.int32)
+        return codigos[posicoes]  # posição -1 (chave nula) cai no 0 do final
+
+_codigos_produtos = _CodigosLocais()
+_codigos_mercados = _CodigosLocais()
+
+def codificar_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Acrescenta produto_id e mercado_id inteiros (do dicionário canônico ou códigos locais) e
+    converte os nomes em categóricos, para que os agrupamentos comparem int32 e não strings longas.
+    """
+    if df.empty:
+        return df
+    if 'produto_id' in df.columns and df['produto_id'].notna().all():
+        df['produto_id'] = df['produto_id'].astype(np.int32)
+    else:
+        chave = df['nome_produto_normalizado']
+        if 'codigo_barras' in df.columns:
+            chave = df['codigo_barras'].where(df['codigo_barras'].fillna('') != '', chave)
+        df['produto_id'] = _codigos_produtos.codificar(chave)
+    if 'mercado_id' in df.columns and df['mercado_id'].notna().all():
+        df['mercado_id'] = df['mercado_id'].astype(np.int32)
+    else:
+        df['mercado_id'] = _codigos_mercados.codificar(df['cnpj_supermercado'])
+    for coluna in ('nome_produto_normalizado', 'nome_supermercado'):
+        if coluna in df.columns and not isinstance(df[coluna].dtype, pd.CategoricalDtype):
+            df[coluna] = df[coluna].astype('category')
+    return df
+
 # --------------------------------------------------------------------------
 # --- FUNÇÕES AUXILIARES PARA ANÁLISE DE DADOS AVANÇADA ---
 # --------------------------------------------------------------------------
@@ -265,8 +306,8 @@ def _fill_missing_dates(df: pd.DataFrame, start_date: date, end_date: date, peri
 async def _fetch_data_for_period(start_date: date, end_date: date, period: str) -> List[Dict[str, Any]]:
     """Busca dados agregados usando a função RPC 'get_products_aggregated'."""
     try:
-        data = await asyncio.to_thread(
-            supabase_admin.rpc, 'get_products_aggregated', {
+        data = await db_admin.rpc(
+            'get_products_aggregated', {
                 'start_dt': start_date.isoformat(),
                 'end_dt': end_date.isoformat(), 
                 'aggregation_period': period
@@ -280,8 +321,8 @@ async def _fetch_data_for_period(start_date: date, end_date: date, period: str)
 async def _fetch_markets_ranking(ref_date: date) -> List[Dict[str, Any]]:
     """Busca ranking de mercados usando a função RPC 'get_markets_ranking'."""
     try:
-        data = await asyncio.to_thread(
-            supabase_admin.rpc, 'get_markets_ranking', {
+        data = await db_admin.rpc(
+            'get_markets_ranking', {
                 'reference_dt': ref_date.isoformat()
             }
         ).execute()
@@ -294,14 +335,8 @@ async def get_date_range_data(start_date: date, end_date: date, cnpjs: Optional[
     """Obtém dados do período especificado com cache inteligente"""
     try:
         cache_key = f"data_{start_date}_{end_date}_{hash(str(cnpjs))}"
-        query = supabase.table('produtos').select('*')
-        query = query.gte('data_coleta', str(start_date)).lte('data_coleta', str(end_date))
-
-        if cnpjs and cnpjs != ['all']:
-            query = query.in_('cnpj_supermercado', cnpjs)
-
-        response = await asyncio.to_thread(query.execute)
-        return response.data or []
+        filtro_cnpjs = cnpjs if cnpjs and cnpjs != ['all'] else None
+        return await repositorio.produtos_do_periodo(start_date, end_date, filtro_cnpjs)
     except Exception as e:
         logging.error(f"Erro ao buscar dados do período: {e}")
         return []
@@ -309,10 +344,10 @@ async def get_date_range_data(start_date: date, end_date: date, cnpjs: Optional[
 async def get_complete_market_data() -> List[Dict]:
     """Obtém dados completos de mercados"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        response = await (
+            db.table('supermercados')
             .select('*')
-            .execute
+            .execute()
         )
         return response.data or []
     except Exception as e:
@@ -322,12 +357,12 @@ async def get_complete_market_data() -> List[Dict]:
 async def get_collection_data(start_date: date, end_date: date) -> List[Dict]:
     """Obtém dados de coletas no período"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('coletas')
+        response = await (
+            db.table('coletas')
             .select('*')
             .gte('iniciada_em', str(start_date))
             .lte('iniciada_em', str(end_date))
-            .execute
+            .execute()
         )
         return response.data or []
     except Exception as e:
@@ -382,12 +417,15 @@ def detect_price_anomalies(df: pd.DataFrame) -> List[Dict]:
     if df.empty or 'preco_produto' not in df.columns:
         return anomalies
 
-    # Agrupar por produto e mercado
-    grouped = df.groupby(['nome_produto_normalizado', 'nome_supermercado'])
+    # Agrupar por produto e mercado (ids inteiros)
+    df = codificar_dataframe(df)
+    grouped = df.groupby(['produto_id', 'mercado_id'], sort=False)
 
-    for (produto, mercado), group in grouped:
+    for _, group in grouped:
         if len(group) < 5:  # Mínimo de pontos para análise
             continue
+        produto = group['nome_produto_normalizado'].iloc[0]
+        mercado = group['nome_supermercado'].iloc[0]
 
         prices = group['preco_produto'].dropna()
         if len(prices) < 2:
@@ -483,19 +521,7 @@ def calculate_trend_analysis(df: pd.DataFrame) -> Dict[str, Any]:
 async def get_available_dates() -> List[date]:
     """Obtém as datas disponíveis para análise baseado nas coletas"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('produtos')
-            .select('data_coleta')
-            .order('data_coleta', desc=True)
-            .execute
-        )
-
-        if not response.data:
-            return []
-
-        dates = list(set([item['data_coleta'] for item in response.data]))
-        date_objects = [datetime.fromisoformat(date_str).date() for date_str in dates]
-        return sorted(date_objects, reverse=True)
+        return await repositorio.datas_com_produtos()
 
     except Exception as e:
         logging.error(f"Erro ao buscar datas disponíveis: {e}")
@@ -504,23 +530,17 @@ async def get_available_dates() -> List[date]:
 async def _fetch_summary_data() -> Dict[str, Any]:
     """Busca todos os dados de resumo em uma única função RPC ou consultas separadas."""
     try:
-        mercados_res = await asyncio.to_thread(
-            supabase.table('supermercados').select('id', count='exact').execute
-        )
+        mercados_res = await db.table('supermercados').select('id', count='exact').execute()
         total_mercados = mercados_res.count if mercados_res.count else 0
 
-        summary_res = await asyncio.to_thread(
-            supabase_admin.rpc, 'get_dashboard_summary', {}
-        ).execute()
+        summary_res = await db_admin.rpc('get_dashboard_summary', {}).execute()
 
         if summary_res.data and len(summary_res.data) > 0:
             data = summary_res.data[0]
         else:
             data = {}
 
-        status_res = await asyncio.to_thread(
-            supabase.table('coletas_status').select('status').order('id', desc=True).limit(1).execute
-        )
+        status_res = await db.table('coletas_status').select('status').order('id', desc=True).limit(1).execute()
         coleta_status = status_res.data[0]['status'] if status_res.data else 'IDLE'
 
         variacao_produtos = data.get('variacao_produtos', 0.0)
@@ -548,9 +568,7 @@ async def _fetch_summary_data() -> Dict[str, Any]:
 async def _fetch_top_products(limit: int) -> List[Dict[str, Any]]:
     """Busca produtos mais frequentes e suas métricas chave."""
     try:
-        data = await asyncio.to_thread(
-            supabase_admin.rpc, 'get_top_products', {'limit_input': limit}
-        ).execute()
+        data = await db_admin.rpc('get_top_products', {'limit_input': limit}).execute()
         return data.data if data.data else []
     except Exception as e:
         logging.error(f"Erro ao buscar top produtos: {e}")
@@ -559,9 +577,7 @@ async def _fetch_top_products(limit: int) -> List[Dict[str, Any]]:
 async def _fetch_price_anomalies(threshold: float) -> List[Dict[str, Any]]:
     """Busca anomalias de preço (preços que estão muito distantes do preço médio histórico)."""
     try:
-        data = await asyncio.to_thread(
-            supabase_admin.rpc, 'get_price_anomalies', {'z_score_threshold': threshold}
-        ).execute()
+        data = await db_admin.rpc('get_price_anomalies', {'z_score_threshold': threshold}).execute()
         return data.data if data.data else []
     except Exception as e:
         logging.error(f"Erro ao buscar anomalias de preço: {e}")
@@ -700,13 +716,15 @@ async def get_products_by_market(
         if not data:
             return []
 
-        df = pd.DataFrame(data)
-        market_products = df.groupby('nome_supermercado').agg({
-            'codigo_barras': 'nunique',
-            'preco_produto': 'mean'
-        }).reset_index()
-
-        market_products.columns = ['nome_supermercado', 'total_produtos', 'preco_medio']
+        df = codificar_dataframe(pd.DataFrame(data))
+        df['preco_produto'] = pd.to_numeric(df['preco_produto'], errors='coerce')
+        # Produtos sem GTIN também contam, pelo id do nome normalizado
+        market_products = df.groupby('mercado_id', sort=False).agg(
+            nome_supermercado=('nome_supermercado', 'first'),
+            total_produtos=('produto_id', 'nunique'),
+            preco_medio=('preco_produto', 'mean')
+        ).reset_index(drop=True)
+        market_products['nome_supermercado'] = market_products['nome_supermercado'].astype(str)
         market_products = market_products.sort_values('total_produtos', ascending=False)
 
         return market_products.to_dict('records')
@@ -722,23 +740,23 @@ async def get_recent_collections(
 ):
     """Retorna as coletas mais recentes"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('coletas')
+        response = await (
+            db.table('coletas')
             .select('*')
             .order('iniciada_em', desc=True)
             .limit(limit)
-            .execute
+            .execute()
         )
 
         collections = response.data if response.data else []
 
         for collection in collections:
             if collection.get('mercados_selecionados'):
-                markets_response = await asyncio.to_thread(
-                    supabase.table('supermercados')
+                markets_response = await (
+                    db.table('supermercados')
                     .select('nome')
                     .in_('cnpj', collection['mercados_selecionados'])
-                    .execute
+                    .execute()
                 )
                 market_names = [market['nome'] for market in markets_response.data] if markets_response.data else []
                 collection['nomes_mercados'] = market_names
@@ -758,32 +776,32 @@ async def get_market_stats(
 ):
     """Retorna estatísticas gerais dos mercados"""
     try:
-        markets_response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        markets_response = await (
+            db.table('supermercados')
             .select('cnpj', count='exact')
-            .execute
+            .execute()
         )
 
         thirty_days_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        products_response = await asyncio.to_thread(
-            supabase.table('produtos')
+        products_response = await (
+            db.table('produtos')
             .select('codigo_barras', count='exact')
             .gte('data_coleta', thirty_days_ago)
-            .execute
+            .execute()
         )
 
-        collections_response = await asyncio.to_thread(
-            supabase.table('coletas')
+        collections_response = await (
+            db.table('coletas')
             .select('id', count='exact')
-            .execute
+            .execute()
         )
 
-        last_collection_response = await asyncio.to_thread(
-            supabase.table('coletas')
+        last_collection_response = await (
+            db.table('coletas')
             .select('iniciada_em')
             .order('iniciada_em', desc=True)
             .limit(1)
-            .execute
+            .execute()
         )
 
         return {
@@ -888,24 +906,23 @@ async def get_advanced_metrics(
         inflacao_mensal = ((current_avg - previous_avg) / previous_avg * 100) if previous_avg > 0 else 0
         volatilidade_geral = df['preco_produto'].std() / df['preco_produto'].mean()
 
-        price_variations = []
-        for product in df['nome_produto_normalizado'].unique():
-            product_prices = df[df['nome_produto_normalizado'] == product]['preco_produto']
-            if len(product_prices) > 1:
-                variation = product_prices.std() / product_prices.mean()
-                price_variations.append(variation)
+        # Um único groupby por id em vez de filtrar o DataFrame inteiro para cada produto
+        df = codificar_dataframe(df)
+        por_produto = df.groupby('produto_id', sort=False)['preco_produto'].agg(['std', 'mean', 'count'])
+        por_produto = por_produto[por_produto['count'] > 1]
+        price_variations = (por_produto['std'] / por_produto['mean']).tolist()
 
         indice_confianca = 1 - (np.mean(price_variations) if price_variations else 0)
 
         produtos_em_alta = 0
         produtos_em_baixa = 0
 
-        market_stats = df.groupby('nome_supermercado').agg({
-            'preco_produto': 'mean',
-            'id_registro': 'count'
-        })
+        market_stats = df.groupby('mercado_id', sort=False).agg(
+            nome_supermercado=('nome_supermercado', 'first'),
+            preco_produto=('preco_produto', 'mean')
+        )
         if not market_stats.empty:
-            mercado_mais_competitivo = market_stats['preco_produto'].idxmin()
+            mercado_mais_competitivo = str(market_stats.loc[market_stats['preco_produto'].idxmin(), 'nome_supermercado'])
         else:
             mercado_mais_competitivo = "N/A"
 
@@ -974,32 +991,36 @@ async def get_price_alerts(
             prev_df['preco_produto'] = pd.to_numeric(prev_df['preco_produto'], errors='coerce')
             prev_df = prev_df.dropna(subset=['preco_produto'])
 
-            current_prices = df.groupby('nome_produto_normalizado')['preco_produto'].mean()
-            previous_prices = prev_df.groupby('nome_produto_normalizado')['preco_produto'].mean()
-
-            for product in current_prices.index:
-                if product in previous_prices.index:
-                    current_price = current_prices[product]
-                    previous_price = previous_prices[product]
-
-                    if previous_price > 0:
-                        variation = ((current_price - previous_price) / previous_price) * 100
-
-                        if abs(variation) >= PRICE_ALERT_THRESHOLD * 100:
-                            current_market = df[df['nome_produto_normalizado'] == product]['nome_supermercado'].mode()
-                            market = current_market[0] if len(current_market) > 0 else "N/A"
-
-                            alert = PriceAlert(
-                                produto=product,
-                                codigo_barras=df[df['nome_produto_normalizado'] == product]['codigo_barras'].iloc[0] if 'codigo_barras' in df.columns else "",
-                                variacao=round(variation, 2),
-                                tipo="ALTA" if variation > 0 else "BAIXA",
-                                mercado=market,
-                                preco_atual=round(current_price, 2),
-                                preco_anterior=round(previous_price, 2),
-                                gravidade="ALTA" if abs(variation) > 15 else "MEDIA"
-                            )
-                            alerts.append(alert)
+            # Os dois períodos são comparados pelo id canônico do produto
+            df = codificar_dataframe(df)
+            prev_df = codificar_dataframe(prev_df)
+            current_prices = df.groupby('produto_id', sort=False)['preco_produto'].mean()
+            previous_prices = prev_df.groupby('produto_id', sort=False)['preco_produto'].mean()
+            linhas_por_produto = df.groupby('produto_id', sort=False).indices
+
+            for produto_id in current_prices.index.intersection(previous_prices.index):
+                current_price = current_prices[produto_id]
+                previous_price = previous_prices[produto_id]
+
+                if previous_price > 0:
+                    variation = ((current_price - previous_price) / previous_price) * 100
+
+                    if abs(variation) >= PRICE_ALERT_THRESHOLD * 100:
+                        linhas = df.iloc[linhas_por_produto[produto_id]]
+                        current_market = linhas['nome_supermercado'].mode()
+                        market = current_market[0] if len(current_market) > 0 else "N/A"
+
+                        alert = PriceAlert(
+                            produto=linhas['nome_produto_normalizado'].iloc[0],
+                            codigo_barras=linhas['codigo_barras'].iloc[0] if 'codigo_barras' in df.columns else "",
+                            variacao=round(variation, 2),
+                            tipo="ALTA" if variation > 0 else "BAIXA",
+                            mercado=market,
+                            preco_atual=round(current_price, 2),
+                            preco_anterior=round(previous_price, 2),
+                            gravidade="ALTA" if abs(variation) > 15 else "MEDIA"
+                        )
+                        alerts.append(alert)
 
         return sorted(alerts, key=lambda x: abs(x.variacao), reverse=True)[:20]
 
@@ -1017,17 +1038,17 @@ async def get_markets_for_analysis(
 ):
     """Retorna lista de mercados com estatísticas para seleção"""
     try:
-        markets_response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        markets_response = await (
+            db.table('supermercados')
             .select('cnpj, nome, endereco')
             .order('nome')
-            .execute
+            .execute()
         )
 
-        products_response = await asyncio.to_thread(
-            supabase.table('produtos')
+        products_response = await (
+            db.table('produtos')
             .select('cnpj_supermercado, data_coleta')
-            .execute
+            .execute()
         )
 
         products_data = products_response.data if products_response.data else []
@@ -1065,14 +1086,14 @@ async def get_barcode_analysis(
 ):
     """Análise simplificada de produtos por código de barras para dashboard"""
     try:
-        query = supabase.table('produtos').select('*')
+        query = db.table('produtos').select('*')
         query = query.in_('codigo_barras', request.product_barcodes)
         query = query.in_('cnpj_supermercado', request.markets_cnpj)
         query = query.gte('data_coleta', str(request.start_date))
         query = query.lte('data_coleta', str(request.end_date))
         query = query.order('data_coleta')
 
-        response = await asyncio.to_thread(query.execute)
+        response = await query.execute()
         data = response.data
 
         if not data:
@@ -1117,14 +1138,14 @@ async def get_advanced_product_analysis(
 ):
     """Análise avançada de produtos por código de barras com múltiplas métricas"""
     try:
-        query = supabase.table('produtos').select('*')
+        query = db.table('produtos').select('*')
         query = query.in_('codigo_barras', request.product_barcodes)
         query = query.in_('cnpj_supermercado', request.markets_cnpj)
         query = query.gte('data_coleta', str(request.start_date))
         query = query.lte('data_coleta', str(request.end_date))
         query = query.order('data_coleta')
 
-        response = await asyncio.to_thread(query.execute)
+        response = await query.execute()
         data = response.data
 
         if not data:
@@ -1135,11 +1156,11 @@ async def get_advanced_product_analysis(
         df['preco_produto'] = pd.to_numeric(df['preco_produto'], errors='coerce')
         df = df.dropna(subset=['preco_produto'])
 
-        markets_response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        markets_response = await (
+            db.table('supermercados')
             .select('cnpj, nome, endereco')
             .in_('cnpj', request.markets_cnpj)
-            .execute
+            .execute()
         )
 
         markets_map = {market['cnpj']: market for market in markets_response.data}
@@ -1237,16 +1258,20 @@ async def generate_comprehensive_report(
         df['preco_produto'] = pd.to_numeric(df['preco_produto'], errors='coerce')
         df = df.dropna(subset=['preco_produto'])
 
+        df = codificar_dataframe(df)
         total_produtos = len(df)
-        total_mercados = df['nome_supermercado'].nunique()
+        total_mercados = df['mercado_id'].nunique()
         preco_medio_geral = df['preco_produto'].mean()
 
-        market_analysis = df.groupby('nome_supermercado').agg({
-            'id_registro': 'count',
-            'preco_produto': ['mean', 'min', 'max', 'std']
-        }).reset_index()
-
-        market_analysis.columns = ['mercado', 'total_produtos', 'preco_medio', 'preco_minimo', 'preco_maximo', 'desvio_padrao']
+        market_analysis = df.groupby('mercado_id', sort=False).agg(
+            mercado=('nome_supermercado', 'first'),
+            total_produtos=('id_registro', 'count'),
+            preco_medio=('preco_produto', 'mean'),
+            preco_minimo=('preco_produto', 'min'),
+            preco_maximo=('preco_produto', 'max'),
+            desvio_padrao=('preco_produto', 'std')
+        ).reset_index(drop=True)
+        market_analysis['mercado'] = market_analysis['mercado'].astype(str)
         market_analysis['volatilidade'] = (market_analysis['desvio_padrao'] / market_analysis['preco_medio']).round(4)
 
         produtos_mais_caros = df.nlargest(10, 'preco_produto')[['nome_produto', 'preco_produto', 'nome_supermercado']].to_dict('records')
@@ -1362,11 +1387,16 @@ async def export_advanced_dashboard_data(
                 }
                 pd.DataFrame(summary_data).to_excel(writer, sheet_name='Resumo', index=False)
 
-                market_analysis = df.groupby('nome_supermercado').agg({
-                    'preco_produto': ['count', 'mean', 'min', 'max']
-                }).round(2)
-                market_analysis.columns = ['Total Produtos', 'Preço Médio', 'Preço Mínimo', 'Preço Máximo']
-                market_analysis.reset_index().to_excel(writer, sheet_name='Análise por Mercado', index=False)
+                df = codificar_dataframe(df)
+                market_analysis = df.groupby('mercado_id', sort=False).agg(
+                    nome_supermercado=('nome_supermercado', 'first'),
+                    total=('preco_produto', 'count'),
+                    media=('preco_produto', 'mean'),
+                    minimo=('preco_produto', 'min'),
+                    maximo=('preco_produto', 'max')
+                ).round(2).sort_values('nome_supermercado')
+                market_analysis.columns = ['nome_supermercado', 'Total Produtos', 'Preço Médio', 'Preço Mínimo', 'Preço Máximo']
+                market_analysis.to_excel(writer, sheet_name='Análise por Mercado', index=False)
 
             content = output.getvalue()
             output.close()
@@ -1408,13 +1438,13 @@ async def get_product_intelligence(
         end_date = date.today()
         start_date = end_date - timedelta(days=days)
 
-        query = supabase.table('produtos').select('*')
+        query = db.table('produtos').select('*')
         query = query.eq('codigo_barras', barcode)
         query = query.gte('data_coleta', str(start_date))
         query = query.lte('data_coleta', str(end_date))
         query = query.order('data_coleta')
 
-        response = await asyncio.to_thread(query.execute)
+        response = await query.execute()
         data = response.data
 
         if not data:
@@ -1489,11 +1519,11 @@ async def get_collection_analysis(
 ):
     """Análise avançada de coletas por mercado com filtros personalizados"""
     try:
-        markets_response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        markets_response = await (
+            db.table('supermercados')
             .select('cnpj, nome, endereco')
             .in_('cnpj', request.market_cnpjs)
-            .execute
+            .execute()
         )
 
         if not markets_response.data:
@@ -1595,11 +1625,11 @@ async def get_available_markets(
 ):
     """Retorna lista de mercados disponíveis para análise"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        response = await (
+            db.table('supermercados')
             .select('cnpj, nome, endereco')
             .order('nome')
-            .execute
+            .execute()
         )
 
         markets = []
@@ -1634,9 +1664,7 @@ async def health_check():
     try:
         for table in required_tables:
             try:
-                await asyncio.to_thread(
-                    supabase.table(table).select('id', count='exact').limit(1).execute
-                )
+                await db.table(table).select('id', count='exact').limit(1).execute()
                 health_status['components'][table] = {
                     'status': 'healthy',
                     'message': f"Tabela '{table}' acessível"
@@ -1676,9 +1704,7 @@ async def advanced_health_check(user: UserProfile = Depends(require_page_access(
         for table in tables_to_check:
             try:
                 start_time = datetime.now()
-                response = await asyncio.to_thread(
-                    supabase.table(table).select('id', count='exact').limit(1).execute
-                )
+                response = await db.table(table).select('id', count='exact').limit(1).execute()
                 response_time = (datetime.now() - start_time).total_seconds()
 
                 health_status['components'][table] = {
@@ -1693,11 +1719,11 @@ async def advanced_health_check(user: UserProfile = Depends(require_page_access(
                 }
 
         try:
-            products_response = await asyncio.to_thread(
-                supabase.table('produtos')
+            products_response = await (
+                db.table('produtos')
                 .select('preco_produto, data_coleta')
                 .limit(1000)
-                .execute
+                .execute()
             )
 
             if products_response.data:
@@ -1736,9 +1762,7 @@ async def startup_event():
     logging.info("🔄 Inicializando módulo de dashboard...")
 
     try:
-        await asyncio.to_thread(
-            supabase.table('produtos').select('id_registro', count='exact').limit(1).execute
-        )
+        await db.table('produtos').select('id_registro', count='exact').limit(1).execute()
         logging.info("✅ Conexão com o banco de dados estabelecida")
     except Exception as e:
         logging.error(f"❌ Erro na conexão com o banco: {e}")
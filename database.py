@@ -0,0 +1,129 @@
+# database.py - Acesso assíncrono ao PostgREST do Supabase com pool de conexões compartilhado
+import os
+import time
+import logging
+from typing import Any, Dict
+
+import httpx
+from postgrest import AsyncPostgrestClient
+
+# --- Configurações ---
+SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip('/')
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SERVICE_ROLE_KEY = os.getenv("SERVICE_ROLE_KEY")
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", "50"))
+DB_POOL_MAX_KEEPALIVE = int(os.getenv("DB_POOL_MAX_KEEPALIVE", "20"))
+DB_POOL_KEEPALIVE_SECONDS = float(os.getenv("DB_POOL_KEEPALIVE_SECONDS", "30"))
+DB_POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT_SECONDS", "10"))
+DB_REQUEST_TIMEOUT_SECONDS = float(os.getenv("DB_REQUEST_TIMEOUT_SECONDS", "30"))
+DB_HTTP2 = os.getenv("DB_HTTP2", "false").lower() == "true"
+
+class MetricasPool:
+    """Contadores de uso do pool: requisições em andamento, pico, saturação e tempo de resposta"""
+    def __init__(self, max_conexoes: int):
+        self.max_conexoes = max_conexoes
+        self.em_andamento = 0
+        self.pico = 0
+        self.requisicoes = 0
+        self.saturadas = 0
+        self.timeouts_pool = 0
+        self.erros = 0
+        self.tempo_total = 0.0
+
+    def iniciar(self):
+        self.requisicoes += 1
+        # Com todas as conexões ocupadas a requisição espera na fila do pool
+        if self.em_andamento >= self.max_conexoes:
+            self.saturadas += 1
+        self.em_andamento += 1
+        self.pico = max(self.pico, self.em_andamento)
+
+    def finalizar(self, duracao: float):
+        self.em_andamento -= 1
+        self.tempo_total += duracao
+
+    def resumo(self) -> Dict[str, Any]:
+        return {
+            'max_conexoes': self.max_conexoes,
+            'em_andamento': self.em_andamento,
+            'pico': self.pico,
+            'ocupacao': round(self.em_andamento / self.max_conexoes, 3) if self.max_conexoes else 0,
+            'requisicoes': self.requisicoes,
+            'saturadas': self.saturadas,
+            'timeouts_pool': self.timeouts_pool,
+            'erros': self.erros,
+            'tempo_medio_ms': round(self.tempo_total / self.requisicoes * 1000, 2) if self.requisicoes else 0
+        }
+
+class _TransporteMonitorado(httpx.AsyncHTTPTransport):
+    """Transporte httpx que registra as métricas do pool a cada requisição"""
+    def __init__(self, metricas: MetricasPool, **kwargs):
+        super().__init__(**kwargs)
+        self.metricas = metricas
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.metricas.iniciar()
+        inicio = time.perf_counter()
+        try:
+            return await super().handle_async_request(request)
+        except httpx.PoolTimeout:
+            self.metricas.timeouts_pool += 1
+            raise
+        except httpx.HTTPError:
+            self.metricas.erros += 1
+            raise
+        finally:
+            self.metricas.finalizar(time.perf_counter() - inicio)
+
+# Um único pool atende os dois clientes (anon e service role): mesmo host, mesmas conexões
+metricas_pool = MetricasPool(DB_POOL_MAX_CONNECTIONS)
+_transporte = _TransporteMonitorado(
+    metricas_pool,
+    http2=DB_HTTP2,
+    limits=httpx.Limits(
+        max_connections=DB_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=DB_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=DB_POOL_KEEPALIVE_SECONDS
+    )
+)
+
+class _ClientePostgrestCompartilhado(AsyncPostgrestClient):
+    """AsyncPostgrestClient cuja sessão usa o transporte compartilhado em vez de abrir um pool próprio"""
+    def create_session(self, base_url, headers, timeout, *args, **kwargs) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            transport=_transporte,
+            timeout=httpx.Timeout(DB_REQUEST_TIMEOUT_SECONDS, pool=DB_POOL_ACQUIRE_TIMEOUT_SECONDS)
+        )
+
+def criar_cliente_postgrest(chave: str) -> AsyncPostgrestClient:
+    """Cliente PostgREST assíncrono autenticado com a chave informada, usando o pool compartilhado"""
+    headers = {
+        'apikey': chave,
+        'Authorization': f'Bearer {chave}',
+        'Accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+    # O postgrest acrescenta Accept-Profile/Content-Profile do schema ao criar a sessão
+    return _ClientePostgrestCompartilhado(f"{SUPABASE_URL}/rest/v1", schema='public', headers=headers)
+
+# Equivalentes assíncronos de dependencies.supabase (chave anon) e dependencies.supabase_admin (service role)
+db: AsyncPostgrestClient = criar_cliente_postgrest(SUPABASE_KEY or '')
+db_admin: AsyncPostgrestClient = criar_cliente_postgrest(SERVICE_ROLE_KEY or '')
+
+def relacao_inexistente(erro: Exception) -> bool:
+    """Erro do PostgREST para tabela/view ausente (migração ainda não aplicada)"""
+    return getattr(erro, 'code', None) in ('PGRST205', '42P01')
+
+def estatisticas_pool() -> Dict[str, Any]:
+    return metricas_pool.resumo()
+
+async def fechar():
+    """Fecha as conexões do pool (chamado no shutdown da aplicação)"""
+    # As sessões de db e db_admin não têm outro recurso além do transporte compartilhado: fechá-lo
+    # uma única vez encerra todas as conexões (session.aclose() o fecharia de novo)
+    try:
+        await _transporte.aclose()
+    except Exception as e:
+        logging.error(f"Erro ao fechar o pool de conexões do banco: {e}")
@@ -2,12 +2,17 @@
 import os
 from supabase import create_client, Client
 from fastapi import HTTPException, Header, Depends
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import date, timedelta, datetime
 import logging
 from pydantic import BaseModel
-from postgrest.exceptions import APIError
+from postgrest.exceptions import APIError as PostgrestAPIError
 import asyncio
+import auth_service
+from user_directory import UserDirectory
+from access_sweeper import AccessSweeper
+from database import db, db_admin
+from postgrest import AsyncPostgrestClient
 
 # --- Configurações do Supabase ---
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -21,6 +26,12 @@ if not all([SUPABASE_URL, SUPABASE_KEY, SERVICE_ROLE_KEY]):
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 supabase_admin: Client = create_client(SUPABASE_URL, SERVICE_ROLE_KEY)
 
+# Validação local dos JWTs (com fallback para o Supabase Auth quando não há chave configurada)
+jwt_verifier = auth_service.VerificadorJWT(supabase)
+
+# E-mails dos usuários do Auth em memória (evita get_user_by_id por linha nas listagens)
+user_directory = UserDirectory(supabase_admin)
+
 # --- Modelos compartilhados ---
 class UserProfile(BaseModel):
     id: str
@@ -39,66 +50,213 @@ def calcular_data_expiracao(dias_acesso: int) -> date:
     """Calcula a data de expiração baseada nos dias de acesso"""
     return date.today() + timedelta(days=dias_acesso)
 
-async def verificar_acesso_usuario(user_id: str) -> bool:
-    """Verifica se o usuário tem acesso ativo baseado nos grupos - VERSÃO CORRIGIDA"""
-    try:
-        # ✅ PRIMEIRO: Verificar se é admin - se for, retorna acesso imediato
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('role').eq('id', user_id).single().execute
-        )
-        if profile_response.data and profile_response.data.get('role') == 'admin':
-            logging.info(f"✅ Usuário admin {user_id} - acesso irrestrito concedido")
-            return True
-
-        today = date.today()
+# Limite de ids por filtro in_() para não estourar o tamanho da URL do PostgREST
+IN_FILTER_CHUNK_SIZE = 200
 
-        # Buscar todos os grupos do usuário com informações de validade
-        response = await asyncio.to_thread(
-            supabase.table('user_groups')
-            .select('''
+async def buscar_por_ids(client: AsyncPostgrestClient, tabela: str, colunas: str, coluna_id: str, ids) -> List[Dict[str, Any]]:
+    """Busca as linhas de uma tabela cujo coluna_id está em ids, em blocos de in_() consultados em paralelo"""
+    ids = list(dict.fromkeys(valor for valor in ids if valor is not None))
+    if not ids:
+        return []
+    blocos = [ids[i:i + IN_FILTER_CHUNK_SIZE] for i in range(0, len(ids), IN_FILTER_CHUNK_SIZE)]
+    respostas = await asyncio.gather(*(
+        client.table(tabela).select(colunas).in_(coluna_id, bloco).execute()
+        for bloco in blocos
+    ))
+    return [linha for resposta in respostas for linha in (resposta.data or [])]
+
+# --- Contexto de acesso consolidado ---
+# None = ainda não verificado; False = função get_user_access_context ausente no banco
+_contexto_rpc_disponivel: Optional[bool] = None
+# False = get_user_access_context sem p_memberships (migração sql/003_user_access.sql não aplicada)
+_acesso_materializado_disponivel: Optional[bool] = None
+
+async def _carregar_contexto_acesso_legado(user_id: str) -> Dict[str, Any]:
+    """Monta o mesmo contexto de get_user_access_context usando consultas separadas (em paralelo)"""
+    profile_query = db.table('profiles').select('role, full_name, allowed_pages').eq('id', user_id).execute()
+    admin_query = db.table('group_admins').select('group_ids').eq('user_id', user_id).execute()
+    groups_query = (
+        db.table('user_groups')
+        .select('''
+            id,
+            data_expiracao,
+            grupos!inner(
                 id,
-                data_expiracao,
-                grupos!inner(
-                    id,
-                    dias_acesso,
-                    ativo
-                )
-            ''')
-            .eq('user_id', user_id)
-            .eq('grupos.ativo', True)  # Grupo deve estar ativo
-            .execute
-        )
+                nome,
+                dias_acesso,
+                ativo,
+                data_expiracao_grupo
+            )
+        ''')
+        .eq('user_id', user_id)
+        .execute()
+    )
+    # As três consultas são independentes: a latência passa a ser a da mais lenta
+    profile_response, admin_response, groups_response = await asyncio.gather(profile_query, admin_query, groups_query)
 
-        if not response.data:
-            return False
+    perfil = profile_response.data[0] if profile_response.data else None
+    return {
+        'profile_exists': perfil is not None,
+        'role': (perfil or {}).get('role') or 'user',
+        'full_name': (perfil or {}).get('full_name'),
+        'allowed_pages': (perfil or {}).get('allowed_pages') or [],
+        'managed_groups': (admin_response.data[0].get('group_ids') or []) if admin_response.data else [],
+        'memberships': [
+            {
+                'user_group_id': user_group['id'],
+                'group_id': user_group.get('grupos', {}).get('id'),
+                'group_name': user_group.get('grupos', {}).get('nome'),
+                'dias_acesso': user_group.get('grupos', {}).get('dias_acesso'),
+                'grupo_ativo': user_group.get('grupos', {}).get('ativo', True),
+                'data_expiracao_user': user_group['data_expiracao'],
+                'data_expiracao_grupo': user_group.get('grupos', {}).get('data_expiracao_grupo')
+            }
+            for user_group in groups_response.data or []
+        ]
+    }
 
-        # Verificar se pelo menos um grupo está válido
-        for user_group in response.data:
-            data_expiracao = user_group['data_expiracao']
+async def carregar_contexto_acesso(user_id: str, incluir_associacoes: bool = True) -> Dict[str, Any]:
+    """
+    Obtém role, páginas, grupos gerenciados, acesso materializado e associações a grupos do usuário
+    em uma única consulta. Sem incluir_associacoes, as associações só vêm se não houver acesso materializado.
+    """
+    global _contexto_rpc_disponivel, _acesso_materializado_disponivel
+    if _contexto_rpc_disponivel is not False:
+        parametros = {'p_user_id': user_id}
+        if not incluir_associacoes and _acesso_materializado_disponivel is not False:
+            parametros['p_memberships'] = False
+        try:
+            response = await db_admin.rpc('get_user_access_context', parametros).execute()
+            _contexto_rpc_disponivel = True
+            return response.data
+        except PostgrestAPIError as e:
+            # PGRST202: função inexistente (migração sql/002_get_user_access_context.sql não aplicada)
+            if e.code != 'PGRST202':
+                raise
+            if 'p_memberships' in parametros:
+                # Assinatura antiga (sem user_access): segue com as associações completas
+                _acesso_materializado_disponivel = False
+                return await carregar_contexto_acesso(user_id)
+            logging.warning("⚠️ Função get_user_access_context não encontrada; usando consultas separadas")
+            _contexto_rpc_disponivel = False
+    return await _carregar_contexto_acesso_legado(user_id)
+
+def _avaliar_acesso(contexto: Dict[str, Any], hoje: Optional[date] = None) -> Dict[str, Any]:
+    """Classifica as associações do usuário em grupos ativos e expirados e decide o acesso"""
+    if contexto.get('role') == 'admin':
+        return {
+            'has_access': True,
+            'reason': 'Usuário admin tem acesso irrestrito',
+            'active_groups': [],
+            'expired_groups': [],
+            'is_admin': True
+        }
 
-            # Se a data de expiração individual é válida
-            if (isinstance(data_expiracao, str) and 
-                datetime.fromisoformat(data_expiracao).date() >= today):
-                return True
+    memberships = contexto.get('memberships') or []
+    if not memberships:
+        return {
+            'has_access': False,
+            'reason': 'Usuário não está em nenhum grupo',
+            'active_groups': [],
+            'expired_groups': [],
+            'is_admin': False
+        }
 
-        return False
+    today = hoje or date.today()
+    grupos_ativos = []
+    grupos_expirados = []
+
+    for membership in memberships:
+        data_expiracao_user = membership.get('data_expiracao_user')
+        data_expiracao_grupo = membership.get('data_expiracao_grupo')
+
+        # Verificar validade do usuário no grupo
+        user_expired = (isinstance(data_expiracao_user, str) and 
+                      datetime.fromisoformat(data_expiracao_user).date() < today)
+
+        # Verificar validade do grupo
+        grupo_ativo = membership.get('grupo_ativo', True)
+        grupo_expirado = (isinstance(data_expiracao_grupo, str) and 
+                          datetime.fromisoformat(data_expiracao_grupo).date() < today)
+
+        # Se grupo está inativo ou expirado, considerar expirado
+        if not grupo_ativo or grupo_expirado:
+            grupos_expirados.append({
+                'group_id': membership.get('group_id'),
+                'group_name': membership.get('group_name'),
+                'reason': 'Grupo expirado ou inativo',
+                'data_expiracao_user': data_expiracao_user,
+                'data_expiracao_grupo': data_expiracao_grupo
+            })
+            continue
+
+        # Se usuário está expirado no grupo
+        if user_expired:
+            grupos_expirados.append({
+                'group_id': membership.get('group_id'),
+                'group_name': membership.get('group_name'),
+                'reason': 'Acesso do usuário expirado neste grupo',
+                'data_expiracao_user': data_expiracao_user,
+                'data_expiracao_grupo': data_expiracao_grupo
+            })
+            continue
 
-    except Exception as e:
-        logging.error(f"Erro ao verificar acesso do usuário {user_id}: {e}")
-        return False
+        # Grupo e usuário estão válidos
+        grupos_ativos.append({
+            'group_id': membership.get('group_id'),
+            'group_name': membership.get('group_name'),
+            'data_expiracao_user': data_expiracao_user,
+            'dias_acesso': membership.get('dias_acesso') or 0,
+            'data_expiracao_grupo': data_expiracao_grupo
+        })
+
+    has_access = len(grupos_ativos) > 0
+
+    return {
+        'has_access': has_access,
+        'reason': 'Acesso ativo' if has_access else 'Todos os grupos estão expirados',
+        'active_groups': grupos_ativos,
+        'expired_groups': grupos_expirados,
+        'total_active': len(grupos_ativos),
+        'total_expired': len(grupos_expirados),
+        'is_admin': False
+    }
+
+def _avaliar_acesso_materializado(acesso: Dict[str, Any], hoje: Optional[date] = None) -> Dict[str, Any]:
+    """Decide o acesso pela linha de user_access; a data de expiração vale mesmo antes da próxima varredura"""
+    expira_em = acesso.get('access_expires_at')
+    vigente = bool(acesso.get('has_access')) and (
+        not expira_em or date.fromisoformat(expira_em[:10]) >= (hoje or date.today())
+    )
+    if vigente:
+        motivo = 'Acesso ativo'
+    elif acesso.get('active_groups') or acesso.get('expired_groups'):
+        motivo = 'Todos os grupos estão expirados'
+    else:
+        motivo = 'Usuário não está em nenhum grupo'
+    return {
+        'has_access': vigente,
+        'reason': motivo,
+        'total_active': (acesso.get('active_groups') or 0) if vigente else 0
+    }
+
+async def verificar_acesso_usuario(user_id: str) -> bool:
+    """Verifica se o usuário tem acesso ativo baseado nos grupos"""
+    acesso = await verificar_acesso_completo(user_id)
+    return acesso['has_access']
 
 async def verificar_acesso_grupo(group_id: int) -> bool:
     """Verifica se um grupo está ativo e válido"""
     try:
         today = date.today()
 
-        response = await asyncio.to_thread(
-            supabase.table('grupos')
+        response = await (
+            db.table('grupos')
             .select('id, dias_acesso, ativo, data_expiracao_grupo')
             .eq('id', group_id)
             .eq('ativo', True)
             .single()
-            .execute
+            .execute()
         )
 
         if not response.data:
@@ -123,55 +281,9 @@ async def verificar_acesso_grupo(group_id: int) -> bool:
 async def get_user_active_groups(user_id: str) -> List[Dict[str, Any]]:
     """Obtém os grupos ativos do usuário"""
     try:
-        # ✅ Se for admin, retorna lista vazia (não precisa de grupos)
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('role').eq('id', user_id).single().execute
-        )
-        if profile_response.data and profile_response.data.get('role') == 'admin':
-            return []
-
-        today = date.today()
-
-        response = await asyncio.to_thread(
-            supabase.table('user_groups')
-            .select('''
-                id,
-                data_expiracao,
-                grupos!inner(
-                    id,
-                    nome,
-                    dias_acesso,
-                    ativo,
-                    data_expiracao_grupo
-                )
-            ''')
-            .eq('user_id', user_id)
-            .eq('grupos.ativo', True)
-            .gte('data_expiracao', today.isoformat())
-            .execute
-        )
-
-        grupos_ativos = []
-        for user_group in response.data:
-            grupo_info = user_group.get('grupos', {})
-
-            # Verificar se o grupo em si está válido
-            if grupo_info.get('data_expiracao_grupo'):
-                data_expiracao_grupo = grupo_info['data_expiracao_grupo']
-                if isinstance(data_expiracao_grupo, str):
-                    if datetime.fromisoformat(data_expiracao_grupo).date() < today:
-                        continue  # Grupo expirado, pular
-
-            grupos_ativos.append({
-                'group_id': grupo_info.get('id'),
-                'group_name': grupo_info.get('nome'),
-                'data_expiracao_user': user_group['data_expiracao'],
-                'dias_acesso': grupo_info.get('dias_acesso', 0),
-                'data_expiracao_grupo': grupo_info.get('data_expiracao_grupo')
-            })
-
-        return grupos_ativos
-
+        contexto = await carregar_contexto_acesso(user_id)
+        # ✅ Admin retorna lista vazia (não precisa de grupos)
+        return _avaliar_acesso(contexto)['active_groups']
     except Exception as e:
         logging.error(f"Erro ao buscar grupos ativos do usuário {user_id}: {e}")
         return []
@@ -179,111 +291,11 @@ async def get_user_active_groups(user_id: str) -> List[Dict[str, Any]]:
 async def verificar_acesso_completo(user_id: str) -> Dict[str, Any]:
     """Verificação completa de acesso do usuário considerando grupos"""
     try:
-        # ✅ VERIFICAÇÃO IMEDIATA: Se for admin, retorna acesso irrestrito
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('role').eq('id', user_id).single().execute
-        )
-        if profile_response.data and profile_response.data.get('role') == 'admin':
+        contexto = await carregar_contexto_acesso(user_id)
+        acesso = _avaliar_acesso(contexto)
+        if acesso['is_admin']:
             logging.info(f"✅ ADMIN DETECTADO: {user_id} - acesso irrestrito concedido")
-            return {
-                'has_access': True,
-                'reason': 'Usuário admin tem acesso irrestrito',
-                'active_groups': [],
-                'expired_groups': [],
-                'is_admin': True
-            }
-
-        today = date.today()
-
-        # Buscar todos os grupos do usuário
-        response = await asyncio.to_thread(
-            supabase.table('user_groups')
-            .select('''
-                id,
-                data_expiracao,
-                grupos!inner(
-                    id,
-                    nome,
-                    dias_acesso,
-                    ativo,
-                    data_expiracao_grupo
-                )
-            ''')
-            .eq('user_id', user_id)
-            .execute
-        )
-
-        if not response.data:
-            return {
-                'has_access': False,
-                'reason': 'Usuário não está em nenhum grupo',
-                'active_groups': [],
-                'expired_groups': [],
-                'is_admin': False
-            }
-
-        grupos_ativos = []
-        grupos_expirados = []
-
-        for user_group in response.data:
-            grupo_info = user_group.get('grupos', {})
-            data_expiracao_user = user_group['data_expiracao']
-
-            # Verificar validade do usuário no grupo
-            user_expired = (isinstance(data_expiracao_user, str) and 
-                          datetime.fromisoformat(data_expiracao_user).date() < today)
-
-            # Verificar validade do grupo
-            grupo_ativo = grupo_info.get('ativo', True)
-            grupo_expirado = False
-
-            if grupo_info.get('data_expiracao_grupo'):
-                data_expiracao_grupo = grupo_info['data_expiracao_grupo']
-                if isinstance(data_expiracao_grupo, str):
-                    grupo_expirado = (datetime.fromisoformat(data_expiracao_grupo).date() < today)
-
-            # Se grupo está inativo ou expirado, considerar expirado
-            if not grupo_ativo or grupo_expirado:
-                grupos_expirados.append({
-                    'group_id': grupo_info.get('id'),
-                    'group_name': grupo_info.get('nome'),
-                    'reason': 'Grupo expirado ou inativo',
-                    'data_expiracao_user': data_expiracao_user,
-                    'data_expiracao_grupo': grupo_info.get('data_expiracao_grupo')
-                })
-                continue
-
-            # Se usuário está expirado no grupo
-            if user_expired:
-                grupos_expirados.append({
-                    'group_id': grupo_info.get('id'),
-                    'group_name': grupo_info.get('nome'),
-                    'reason': 'Acesso do usuário expirado neste grupo',
-                    'data_expiracao_user': data_expiracao_user,
-                    'data_expiracao_grupo': grupo_info.get('data_expiracao_grupo')
-                })
-                continue
-
-            # Grupo e usuário estão válidos
-            grupos_ativos.append({
-                'group_id': grupo_info.get('id'),
-                'group_name': grupo_info.get('nome'),
-                'data_expiracao_user': data_expiracao_user,
-                'dias_acesso': grupo_info.get('dias_acesso', 0),
-                'data_expiracao_grupo': grupo_info.get('data_expiracao_grupo')
-            })
-
-        has_access = len(grupos_ativos) > 0
-
-        return {
-            'has_access': has_access,
-            'reason': 'Acesso ativo' if has_access else 'Todos os grupos estão expirados',
-            'active_groups': grupos_ativos,
-            'expired_groups': grupos_expirados,
-            'total_active': len(grupos_ativos),
-            'total_expired': len(grupos_expirados),
-            'is_admin': False
-        }
+        return acesso
 
     except Exception as e:
         logging.error(f"Erro na verificação completa de acesso do usuário {user_id}: {e}")
@@ -292,26 +304,76 @@ async def verificar_acesso_completo(user_id: str) -> Dict[str, Any]:
             'reason': f'Erro na verificação: {str(e)}',
             'active_groups': [],
             'expired_groups': [],
-            'is_admin': False
+            'is_admin': False,
+            'error': True
         }
 
 async def get_user_managed_groups(user_id: str) -> List[int]:
     """Obtém a lista de grupos que um usuário pode gerenciar como subadmin"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('group_admins')
-            .select('group_ids')
-            .eq('user_id', user_id)
-            .single()
-            .execute
-        )
-        if response.data:
-            return response.data.get('group_ids', [])
-        return []
+        contexto = await carregar_contexto_acesso(user_id)
+        return contexto.get('managed_groups') or []
     except Exception as e:
         logging.error(f"Erro ao buscar grupos gerenciados pelo usuário {user_id}: {e}")
         return []
 
+async def _resolver_perfil_usuario(user_id: str, email: Optional[str]) -> Dict[str, Any]:
+    """Resolve role, páginas, grupos gerenciados e decisão de acesso do usuário (resultado vai para o cache)"""
+    contexto = await carregar_contexto_acesso(user_id, incluir_associacoes=False)
+
+    if not contexto.get('profile_exists'):
+        # Criar perfil padrão se não existir
+        try:
+            logging.info(f"📝 Criando perfil padrão para usuário {user_id}")
+            new_profile = {
+                'id': user_id,
+                'full_name': email or 'Usuário',
+                'role': 'user',
+                'allowed_pages': []
+            }
+            await db.table('profiles').insert(new_profile).execute()
+        except Exception as e:
+            logging.error(f"❌ Erro ao criar perfil padrão: {e}")
+
+    # CORREÇÃO: Garantir que role e allowed_pages sempre tenham valores
+    role = contexto.get('role') or 'user'
+    allowed_pages = contexto.get('allowed_pages') or []
+    managed_groups = contexto.get('managed_groups') or []
+
+    # Se tem grupos gerenciados E a role não é admin, definir como group_admin
+    if managed_groups and role != 'admin':
+        role = 'group_admin'
+
+    access = None
+    if role != 'admin' and not managed_groups:
+        if contexto.get('access') is not None:
+            access = _avaliar_acesso_materializado(contexto['access'])
+        else:
+            access_check = _avaliar_acesso(contexto)
+            access = {
+                'has_access': access_check['has_access'],
+                'reason': access_check['reason'],
+                'total_active': len(access_check['active_groups'])
+            }
+            # Usuário ainda sem linha em user_access: materializa para as próximas resoluções
+            access_sweeper.agendar_recalculo([user_id])
+
+    return {
+        'role': role,
+        'allowed_pages': allowed_pages,
+        'managed_groups': managed_groups,
+        'access': access
+    }
+
+async def _autenticar_e_resolver_perfil(token: str) -> Tuple[auth_service.UsuarioAutenticado, Dict[str, Any]]:
+    """
+    Valida o token e só então resolve o perfil (cache por usuário): o contexto de acesso é lido com a
+    service role, portanto nunca a partir de um 'sub' ainda não verificado
+    """
+    user = await jwt_verifier.verificar(token)
+    perfil = await user_profile_cache.get(user.id, _resolver_perfil_usuario, user.id, user.email)
+    return user, perfil
+
 # --- Funções de dependência principais ---
 async def get_current_user(authorization: str = Header(None)) -> UserProfile:
     """Obtém o usuário atual com base no token JWT - VERSÃO CORRIGIDA COM TRATAMENTO DE ERRO MELHORADO"""
@@ -325,71 +387,34 @@ async def get_current_user(authorization: str = Header(None)) -> UserProfile:
     logging.info(f"🔐 Validando token: {jwt[:10]}...")
 
     try:
-        # CORREÇÃO: Usar await para chamadas assíncronas
-        user_response = await asyncio.to_thread(
-            lambda: supabase.auth.get_user(jwt)
-        )
-
-        if not user_response.user:
-            logging.warning("❌ Token inválido ou expirado - usuário não encontrado")
+        try:
+            # Falhas na resolução não ficam em cache (a exceção é tratada abaixo como token inválido)
+            user, perfil = await _autenticar_e_resolver_perfil(jwt)
+        except auth_service.TokenInvalidoError as e:
+            logging.warning(f"❌ {e}")
             raise HTTPException(status_code=401, detail="Token inválido ou expirado")
+        except PostgrestAPIError as e:
+            # Falha ao ler o contexto de acesso: nega o acesso (403), como a verificação de grupos sempre fez
+            logging.error(f"❌ Erro ao verificar o acesso do usuário: {e}")
+            raise HTTPException(
+                status_code=403,
+                detail="Não foi possível verificar seu acesso à plataforma. Tente novamente ou entre em contato com o suporte."
+            )
 
-        user = user_response.user
         user_id = user.id
 
         logging.info(f"✅ Token válido para usuário: {user.email}")
 
-        # Buscar o perfil completo
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('*').eq('id', user_id).single().execute
-        )
-
-        if not profile_response.data:
-            # Criar perfil padrão se não existir
-            try:
-                logging.info(f"📝 Criando perfil padrão para usuário {user_id}")
-                new_profile = {
-                    'id': user_id,
-                    'full_name': user.email or 'Usuário',
-                    'role': 'user',
-                    'allowed_pages': []
-                }
-                await asyncio.to_thread(
-                    supabase.table('profiles').insert(new_profile).execute
-                )
-                profile_data = new_profile
-            except Exception as e:
-                logging.error(f"❌ Erro ao criar perfil padrão: {e}")
-                profile_data = {'role': 'user', 'allowed_pages': []}
-        else:
-            profile_data = profile_response.data
-
-        # CORREÇÃO: Garantir que role e allowed_pages sempre tenham valores
-        role = profile_data.get('role', 'user')
-        allowed_pages = profile_data.get('allowed_pages', []) or []
-
-        # CORREÇÃO: Buscar grupos gerenciados de forma mais permissiva
-        managed_groups = []
-        try:
-            # Verificar se é subadmin
-            admin_response = await asyncio.to_thread(
-                supabase.table('group_admins').select('group_ids').eq('user_id', user_id).execute
-            )
-            if admin_response.data:
-                managed_groups = admin_response.data[0].get('group_ids', [])
-                # Se tem grupos gerenciados E a role não é admin, definir como group_admin
-                if managed_groups and role != 'admin':
-                    role = 'group_admin'
-        except Exception as e:
-            logging.error(f"⚠️ Erro ao buscar grupos gerenciados: {e}")
+        role = perfil['role']
+        managed_groups = perfil['managed_groups']
+        access_check = perfil['access']
 
         # ✅ CORREÇÃO CRÍTICA: Admin não precisa de verificação de grupos
         if role == 'admin':
             # Admin tem acesso irrestrito, não precisa verificar grupos
             logging.info(f"✅ USUÁRIO ADMIN {user_id} - ACESSO IRRESTRITO CONCEDIDO")
-        elif role != 'admin' and not managed_groups:
+        elif access_check is not None:
             # Apenas usuários normais (não admin e não group_admin) precisam de verificação de grupos
-            access_check = await verificar_acesso_completo(user_id)
             if not access_check['has_access']:
                 logging.warning(f"❌ Acesso negado para usuário {user_id}. Motivo: {access_check['reason']}")
                 raise HTTPException(
@@ -397,7 +422,7 @@ async def get_current_user(authorization: str = Header(None)) -> UserProfile:
                     detail="Seu acesso à plataforma expirou. Entre em contato com o suporte para renovação."
                 )
             else:
-                logging.info(f"✅ Usuário {user_id} tem acesso ativo. Grupos ativos: {len(access_check['active_groups'])}")
+                logging.info(f"✅ Usuário {user_id} tem acesso ativo. Grupos ativos: {access_check['total_active']}")
         elif role == 'group_admin' and managed_groups:
             # Group admin tem acesso através dos grupos gerenciados
             logging.info(f"✅ Group admin {user_id} acessando o sistema. Grupos gerenciados: {managed_groups}")
@@ -405,9 +430,9 @@ async def get_current_user(authorization: str = Header(None)) -> UserProfile:
         return UserProfile(
             id=user_id, 
             role=role,
-            allowed_pages=allowed_pages,
+            allowed_pages=list(perfil['allowed_pages']),
             email=user.email,
-            managed_groups=managed_groups
+            managed_groups=list(managed_groups)
         )
     except HTTPException:
         raise
@@ -426,54 +451,18 @@ async def get_current_user_optional(authorization: str = Header(None)) -> Option
 
     jwt = authorization.split(" ")[1]
     try:
-        # CORREÇÃO: Usar await para chamadas assíncronas
-        user_response = await asyncio.to_thread(
-            lambda: supabase.auth.get_user(jwt)
-        )
-
-        if not user_response.user:
+        try:
+            # Reaproveita o perfil resolvido por get_current_user (sem aplicar a verificação de acesso)
+            user, perfil = await _autenticar_e_resolver_perfil(jwt)
+        except auth_service.TokenInvalidoError:
             return None
 
-        user = user_response.user
-        user_id = user.id
-
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('*').eq('id', user_id).single().execute
-        )
-
-        if not profile_response.data:
-            return UserProfile(
-                id=user_id,
-                role='user',
-                allowed_pages=[],
-                email=user.email,
-                managed_groups=[]
-            )
-
-        profile_data = profile_response.data
-
-        # Garantir valores não nulos
-        role = profile_data.get('role', 'user')
-        allowed_pages = profile_data.get('allowed_pages', []) or []
-
-        # Buscar grupos gerenciados se for subadmin
-        managed_groups = []
-        if role == 'group_admin' or role != 'admin':
-            try:
-                admin_response = await asyncio.to_thread(
-                    supabase.table('group_admins').select('group_ids').eq('user_id', user_id).execute
-                )
-                if admin_response.data:
-                    managed_groups = admin_response.data[0].get('group_ids', [])
-            except Exception as e:
-                logging.error(f"Erro ao buscar grupos gerenciados: {e}")
-
         return UserProfile(
-            id=user_id, 
-            role=role,
-            allowed_pages=allowed_pages,
+            id=user.id, 
+            role=perfil['role'],
+            allowed_pages=list(perfil['allowed_pages']),
             email=user.email,
-            managed_groups=managed_groups
+            managed_groups=list(perfil['managed_groups'])
         )
     except Exception as e:
         logging.debug(f"Erro na validação opcional de token: {e}")
@@ -495,15 +484,12 @@ def require_page_access(page_key: str):
 async def verify_group_admin_access(user_id: str, group_id: int) -> bool:
     """Verifica se um usuário tem permissão de subadmin para um grupo específico"""
     try:
+        contexto = await carregar_contexto_acesso(user_id)
         # ✅ Admin tem acesso a todos os grupos
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('role').eq('id', user_id).single().execute
-        )
-        if profile_response.data and profile_response.data.get('role') == 'admin':
+        if contexto.get('role') == 'admin':
             return True
 
-        managed_groups = await get_user_managed_groups(user_id)
-        return group_id in managed_groups
+        return group_id in (contexto.get('managed_groups') or [])
     except Exception as e:
         logging.error(f"Erro ao verificar acesso de subadmin: {e}")
         return False
@@ -514,7 +500,8 @@ async def get_group_admin_user(current_user: UserProfile = Depends(get_current_u
     if current_user.role == 'admin':
         return current_user
 
-    managed_groups = await get_user_managed_groups(current_user.id)
+    # Os grupos gerenciados já vêm resolvidos (e em cache) por get_current_user
+    managed_groups = current_user.managed_groups
     if not managed_groups:
         raise HTTPException(
             status_code=403, 
@@ -600,12 +587,8 @@ def log_user_activity(user_id: str, action: str, details: dict = None):
             "created_at": datetime.now().isoformat()
         }
 
-        # Executar em thread separada para não bloquear
-        asyncio.create_task(
-            asyncio.to_thread(
-                supabase_admin.table('user_activity_logs').insert(log_data).execute
-            )
-        )
+        # Executar em background para não bloquear
+        asyncio.create_task(db_admin.table('user_activity_logs').insert(log_data).execute())
     except Exception as e:
         logging.error(f"Erro ao registrar atividade do usuário: {e}")
 
@@ -639,9 +622,7 @@ async def get_user_accessible_groups(user: UserProfile) -> List[int]:
     """Retorna os grupos que o usuário pode acessar"""
     if user.role == 'admin':
         # ✅ Admin geral acessa todos os grupos
-        response = await asyncio.to_thread(
-            supabase.table('grupos').select('id').execute
-        )
+        response = await db.table('grupos').select('id').execute()
         return [group['id'] for group in response.data] if response.data else []
     else:
         # Subadmin acessa apenas seus grupos designados
@@ -651,12 +632,12 @@ async def get_group_users_count(group_id: int) -> int:
     """Retorna a quantidade de usuários ativos em um grupo"""
     try:
         today = date.today().isoformat()
-        response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        response = await (
+            db.table('user_groups')
             .select('user_id', count='exact')
             .eq('group_id', group_id)
             .gte('data_expiracao', today)
-            .execute
+            .execute()
         )
         return response.count or 0
     except Exception as e:
@@ -667,17 +648,15 @@ async def get_user_groups_info(user_id: str) -> List[dict]:
     """Retorna informações detalhadas sobre os grupos do usuário"""
     try:
         # ✅ Se for admin, retorna lista vazia (não precisa de grupos)
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('role').eq('id', user_id).single().execute
-        )
+        profile_response = await db.table('profiles').select('role').eq('id', user_id).single().execute()
         if profile_response.data and profile_response.data.get('role') == 'admin':
             return []
 
-        response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        response = await (
+            db.table('user_groups')
             .select('group_id, data_expiracao, grupos(nome, dias_acesso)')
             .eq('user_id', user_id)
-            .execute
+            .execute()
         )
 
         groups_info = []
@@ -699,7 +678,7 @@ async def get_user_groups_info(user_id: str) -> List[dict]:
 async def get_dashboard_data(start_date: date, end_date: date, cnpjs: Optional[List[str]] = None) -> List[Dict]:
     """Função auxiliar para obter dados do dashboard de forma segura"""
     try:
-        query = supabase.table('produtos').select('*')
+        query = db.table('produtos').select('*')
 
         # Aplicar filtros de forma segura
         try:
@@ -713,7 +692,7 @@ async def get_dashboard_data(start_date: date, end_date: date, cnpjs: Optional[L
             except Exception as e:
                 logging.warning(f"Filtro de CNPJ não aplicado: {e}")
 
-        response = await asyncio.to_thread(query.execute)
+        response = await query.execute()
         return response.data or []
     except Exception as e:
         logging.error(f"Erro ao buscar dados do dashboard: {e}")
@@ -728,9 +707,7 @@ async def check_database_health() -> Dict[str, Any]:
 
         for table in tables_to_check:
             try:
-                response = await asyncio.to_thread(
-                    supabase.table(table).select('id', count='exact').limit(1).execute
-                )
+                response = await db.table(table).select('id', count='exact').limit(1).execute()
                 health_status[table] = {
                     'status': 'healthy',
                     'count': response.count or 0
@@ -761,6 +738,12 @@ class DataCache:
     def __init__(self, ttl_seconds: int = 300):
         self.cache = {}
         self.ttl = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Versões por chave e geral: um valor buscado antes de uma invalidação não é guardado
+        self._versoes: Dict[str, int] = {}
+        self._geracao = 0
 
     async def get(self, key: str, fetch_func=None, *args, **kwargs):
         """Obtém dados do cache ou executa função para buscar dados"""
@@ -769,23 +752,85 @@ class DataCache:
         if key in self.cache:
             data, timestamp = self.cache[key]
             if (now - timestamp).total_seconds() < self.ttl:
+                self.hits += 1
                 return data
 
+        self.misses += 1
         if fetch_func:
+            versao = (self._geracao, self._versoes.get(key, 0))
             data = await fetch_func(*args, **kwargs)
-            self.cache[key] = (data, now)
+            if versao == (self._geracao, self._versoes.get(key, 0)):
+                self.cache[key] = (data, now)
             return data
 
         return None
 
     def invalidate(self, key: str):
         """Remove item do cache"""
+        self._versoes[key] = self._versoes.get(key, 0) + 1
         if key in self.cache:
             del self.cache[key]
+            self.invalidations += 1
+
+    def clear(self):
+        """Remove todos os itens do cache"""
+        self.invalidations += len(self.cache)
+        self._geracao += 1
+        self._versoes.clear()
+        self.cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Estatísticas de uso do cache"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.cache),
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'invalidations': self.invalidations
+        }
 
 # Instância global do cache
 dashboard_cache = DataCache(ttl_seconds=300)  # 5 minutos
 
+# Perfil resolvido (role, páginas, grupos gerenciados e decisão de acesso) por usuário
+USER_PROFILE_CACHE_TTL_SECONDS = int(os.getenv("USER_PROFILE_CACHE_TTL_SECONDS", "60"))
+user_profile_cache = DataCache(ttl_seconds=USER_PROFILE_CACHE_TTL_SECONDS)
+
+def _descartar_perfil_em_cache(user_id: Optional[str]):
+    if user_id is None:
+        user_profile_cache.clear()
+    else:
+        user_profile_cache.invalidate(user_id)
+
+# Acesso materializado em user_access: varredura periódica de expirações e recálculo após mutações
+access_sweeper = AccessSweeper(db_admin, _descartar_perfil_em_cache)
+
+def invalidar_cache_usuario(user_id: Optional[str]):
+    """Descarta o perfil em cache de um usuário após alterações de role, páginas ou grupos"""
+    if user_id:
+        user_profile_cache.invalidate(user_id)
+        access_sweeper.agendar_recalculo([user_id])
+
+def invalidar_cache_usuarios():
+    """Descarta todos os perfis em cache e recalcula o acesso de todos os usuários"""
+    user_profile_cache.clear()
+    access_sweeper.agendar_recalculo()
+
+async def membros_do_grupo(group_id: int) -> List[str]:
+    response = await db_admin.table('user_groups').select('user_id').eq('group_id', group_id).execute()
+    return list({linha['user_id'] for linha in response.data or []})
+
+def invalidar_cache_grupo(membros: List[str]):
+    """
+    Alterações que afetam um grupo inteiro: descarta os perfis em cache (os subadmins do grupo também
+    guardam os grupos gerenciados) e recalcula o acesso materializado só dos membros do grupo
+    """
+    user_profile_cache.clear()
+    if membros:
+        access_sweeper.agendar_recalculo(membros)
+
 # --- Funções de validação de permissões para dashboard ---
 async def validate_dashboard_access(user: UserProfile) -> bool:
     """Valida se o usuário tem acesso ao dashboard"""
@@ -812,11 +857,11 @@ async def get_user_dashboard_data(user: UserProfile, start_date: date, end_date:
         # Para subadmins, filtra pelos grupos gerenciados
         if user.managed_groups:
             # Obter CNPJs dos mercados dos grupos gerenciados
-            groups_response = await asyncio.to_thread(
-                supabase.table('grupos')
+            groups_response = await (
+                db.table('grupos')
                 .select('id, mercados_associados')
                 .in_('id', user.managed_groups)
-                .execute
+                .execute()
             )
 
             allowed_cnpjs = set()
@@ -929,9 +974,7 @@ async def export_group_data(group_id: int) -> Dict[str, Any]:
     """Exporta dados completos de um grupo para relatório"""
     try:
         # Buscar informações do grupo
-        group_response = await asyncio.to_thread(
-            supabase.table('grupos').select('*').eq('id', group_id).single().execute
-        )
+        group_response = await db.table('grupos').select('*').eq('id', group_id).single().execute()
 
         if not group_response.data:
             raise ValueError("Grupo não encontrado")
@@ -939,11 +982,11 @@ async def export_group_data(group_id: int) -> Dict[str, Any]:
         group_data = group_response.data
 
         # Buscar usuários do grupo
-        user_groups_response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        user_groups_response = await (
+            db.table('user_groups')
             .select('user_id, data_expiracao, created_at, profiles(full_name, email)')
             .eq('group_id', group_id)
-            .execute
+            .execute()
         )
 
         users_data = []
@@ -982,13 +1025,15 @@ async def update_group_members_expiration(group_id: int, dias_acesso: int):
         nova_data_expiracao = calcular_data_expiracao(dias_acesso)
 
         # Atualizar todos os user_groups deste grupo
-        response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        response = await (
+            db.table('user_groups')
             .update({'data_expiracao': nova_data_expiracao.isoformat()})
             .eq('group_id', group_id)
-            .execute
+            .execute()
         )
 
+        for user_group in response.data or []:
+            invalidar_cache_usuario(user_group.get('user_id'))
         logging.info(f"Datas de expiração atualizadas para o grupo {group_id}: {len(response.data)} usuários")
         return len(response.data)
     except Exception as e:
@@ -999,11 +1044,11 @@ async def renew_group_access(group_id: int, dias_adicionais: int):
     """Renova o acesso de todos os membros do grupo adicionando dias"""
     try:
         # Buscar todas as associações do grupo
-        user_groups_response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        user_groups_response = await (
+            db.table('user_groups')
             .select('*')
             .eq('group_id', group_id)
-            .execute
+            .execute()
         )
 
         if not user_groups_response.data:
@@ -1024,12 +1069,13 @@ async def renew_group_access(group_id: int, dias_adicionais: int):
                 nova_data = data_expiracao + timedelta(days=dias_adicionais)
 
             # Atualizar no banco
-            await asyncio.to_thread(
-                lambda: supabase.table('user_groups')
+            await (
+                db.table('user_groups')
                 .update({'data_expiracao': nova_data.isoformat()})
                 .eq('id', user_group['id'])
                 .execute()
             )
+            invalidar_cache_usuario(user_group['user_id'])
             updated_count += 1
 
         logging.info(f"Acesso renovado para {updated_count} usuários do grupo {group_id}")
@@ -1043,32 +1089,32 @@ async def get_group_statistics(group_id: int) -> Dict[str, int]:
     """Obtém estatísticas de um grupo para renovação em massa"""
     try:
         # Total de usuários no grupo
-        total_response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        total_response = await (
+            db.table('user_groups')
             .select('user_id', count='exact')
             .eq('group_id', group_id)
-            .execute
+            .execute()
         )
         total_users = total_response.count or 0
 
         # Usuários ativos (não expirados)
         today = date.today().isoformat()
-        active_response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        active_response = await (
+            db.table('user_groups')
             .select('user_id', count='exact')
             .eq('group_id', group_id)
             .gte('data_expiracao', today)
-            .execute
+            .execute()
         )
         active_users = active_response.count or 0
 
         # Usuários expirados
-        expired_response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        expired_response = await (
+            db.table('user_groups')
             .select('user_id', count='exact')
             .eq('group_id', group_id)
             .lt('data_expiracao', today)
-            .execute
+            .execute()
         )
         expired_users = expired_response.count or 0
 
@@ -1091,9 +1137,7 @@ async def create_user_group_association(user_id: str, group_id: int, data_expira
     try:
         # Se não foi fornecida data de expiração, buscar dias de acesso do grupo
         if not data_expiracao:
-            group_response = await asyncio.to_thread(
-                supabase.table('grupos').select('dias_acesso').eq('id', group_id).single().execute
-            )
+            group_response = await db.table('grupos').select('dias_acesso').eq('id', group_id).single().execute()
             if not group_response.data:
                 raise ValueError("Grupo não encontrado")
 
@@ -1106,10 +1150,9 @@ async def create_user_group_association(user_id: str, group_id: int, data_expira
             'data_expiracao': data_expiracao.isoformat()
         }
 
-        response = await asyncio.to_thread(
-            supabase.table('user_groups').insert(user_group_data).execute
-        )
+        response = await db.table('user_groups').insert(user_group_data).execute()
 
+        invalidar_cache_usuario(user_id)
         logging.info(f"Usuário {user_id} associado ao grupo {group_id} com expiração em {data_expiracao}")
         return response.data[0] if response.data else None
 
@@ -0,0 +1,147 @@
+# fuzzy_search.py - Busca tolerante a erros de digitação por similaridade de n-gramas de caracteres
+import os
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+    import scipy.sparse as sp
+except ImportError:  # numpy/scipy são opcionais: sem eles a busca aproximada fica desativada
+    np = None
+    sp = None
+
+# --- Configurações ---
+FUZZY_SEARCH_ENABLED = os.getenv("FUZZY_SEARCH_ENABLED", "true").lower() == "true" and sp is not None
+# Fração (ponderada por idf) dos n-gramas do termo que precisa existir no nome
+FUZZY_MIN_SCORE = float(os.getenv("FUZZY_MIN_SCORE", "0.55"))
+FUZZY_TOP_K = int(os.getenv("FUZZY_TOP_K", "200"))
+FUZZY_NGRAM_SIZES = (2, 3)
+# Nomes novos acumulados antes de serem incorporados à matriz principal
+FUZZY_PENDENTES_MAX = 2000
+
+def ngramas(texto: str) -> List[str]:
+    """N-gramas de caracteres de cada palavra, com espaço nas bordas ('leite' -> ' l', 'le', ..., 'te ')"""
+    gramas = []
+    for palavra in texto.split():
+        palavra = f" {palavra} "
+        for n in FUZZY_NGRAM_SIZES:
+            gramas.extend(palavra[i:i + n] for i in range(len(palavra) - n + 1))
+    return gramas
+
+class FuzzyNameMatcher:
+    """
+    Matriz esparsa binária nomes x n-gramas (CSR). A pontuação de um nome é a fração dos n-gramas
+    do termo, ponderados por idf, que aparecem no nome: um único produto matriz-vetor sobre todo o
+    catálogo, seguido de um corte top-K com argpartition. Nomes novos ficam numa matriz pendente
+    pequena, pontuada à parte, e são incorporados à matriz principal em lote.
+    """
+    def __init__(self):
+        self._vocabulario: Dict[str, int] = {}
+        self._nomes: List[str] = []
+        self._posicao: Dict[str, int] = {}
+        self._matriz = None
+        self._df = None
+        self._pendentes: List[str] = []
+        self._matriz_pendentes = None
+
+    def __len__(self) -> int:
+        return len(self._nomes) + len(self._pendentes)
+
+    def _linhas(self, nomes: List[str]):
+        """Linhas binárias dos nomes; n-gramas ainda não vistos ganham uma coluna nova"""
+        indices: List[int] = []
+        ponteiros = [0]
+        for nome in nomes:
+            colunas = {self._vocabulario.setdefault(grama, len(self._vocabulario)) for grama in ngramas(nome)}
+            indices.extend(sorted(colunas))
+            ponteiros.append(len(indices))
+        dados = np.ones(len(indices), dtype=np.float32)
+        return sp.csr_matrix((dados, np.array(indices, dtype=np.int32), np.array(ponteiros, dtype=np.int64)),
+                             shape=(len(nomes), len(self._vocabulario)))
+
+    def construir(self, nomes: Iterable[str]):
+        self._nomes = list(dict.fromkeys(nome for nome in nomes if nome))
+        self._posicao = {nome: i for i, nome in enumerate(self._nomes)}
+        self._pendentes = []
+        self._matriz_pendentes = None
+        self._matriz = self._linhas(self._nomes)
+        self._df = np.bincount(self._matriz.indices, minlength=len(self._vocabulario)).astype(np.float32)
+
+    def adicionar(self, nomes: Iterable[str]):
+        for nome in nomes:
+            if nome and nome not in self._posicao:
+                self._posicao[nome] = -1
+                self._pendentes.append(nome)
+                self._matriz_pendentes = None
+        if len(self._pendentes) >= FUZZY_PENDENTES_MAX:
+            self._incorporar_pendentes()
+
+    def _incorporar_pendentes(self):
+        if not self._pendentes:
+            return
+        novos, self._pendentes = self._pendentes, []
+        self._matriz_pendentes = None
+        linhas = self._linhas(novos)
+        if self._matriz is None:
+            self._matriz = linhas
+        else:
+            # Colunas de n-gramas novos: a matriz existente só ganha largura
+            self._matriz.resize((self._matriz.shape[0], len(self._vocabulario)))
+            self._matriz = sp.vstack([self._matriz, linhas], format='csr')
+        for nome in novos:
+            self._posicao[nome] = len(self._nomes)
+            self._nomes.append(nome)
+        self._df = np.bincount(self._matriz.indices, minlength=len(self._vocabulario)).astype(np.float32)
+
+    def buscar(self, termo: str, top_k: int = FUZZY_TOP_K, minimo: float = FUZZY_MIN_SCORE) -> List[Tuple[str, float]]:
+        """Nomes mais parecidos com o termo (já normalizado), do maior para o menor score"""
+        if self._pendentes and self._matriz_pendentes is None:
+            self._matriz_pendentes = self._linhas(self._pendentes)
+        if self._matriz is None:
+            return []
+        gramas = set(ngramas(termo))
+        if not gramas:
+            return []
+
+        df = self._df
+        if self._pendentes:
+            df = np.bincount(self._matriz_pendentes.indices, minlength=len(self._vocabulario)).astype(np.float32)
+            df[:len(self._df)] += self._df
+        total_nomes = len(self._nomes) + len(self._pendentes)
+
+        colunas, pesos, ausentes = [], [], 0
+        for grama in gramas:
+            coluna = self._vocabulario.get(grama)
+            if coluna is None or coluna >= len(df) or not df[coluna]:
+                ausentes += 1
+                continue
+            colunas.append(coluna)
+            pesos.append(math.log((1 + total_nomes) / (1 + df[coluna])) + 1)
+        if not colunas:
+            return []
+        # N-gramas que não existem no catálogo (típicos do erro de digitação) pesam a média dos demais,
+        # e não o idf máximo, que dominaria o denominador
+        peso_total = sum(pesos) * (1 + ausentes / len(pesos))
+
+        consulta = np.zeros(len(self._vocabulario), dtype=np.float32)
+        consulta[colunas] = np.array(pesos, dtype=np.float32) / peso_total
+        # A matriz principal pode ser mais estreita que o vocabulário (n-gramas vistos só nos pendentes)
+        scores = self._matriz @ consulta[:self._matriz.shape[1]]
+        nomes = self._nomes
+        if self._pendentes:
+            scores = np.concatenate([scores, self._matriz_pendentes @ consulta[:self._matriz_pendentes.shape[1]]])
+            nomes = self._nomes + self._pendentes
+
+        candidatos = np.flatnonzero(scores >= minimo)
+        if len(candidatos) > top_k:
+            candidatos = candidatos[np.argpartition(scores[candidatos], -top_k)[-top_k:]]
+        ordem = candidatos[np.argsort(-scores[candidatos], kind='stable')]
+        return [(nomes[i], min(float(scores[i]), 1.0)) for i in ordem]
+
+    def estatisticas(self) -> Dict[str, Optional[int]]:
+        return {
+            'nomes': len(self._nomes),
+            'pendentes': len(self._pendentes),
+            'ngramas': len(self._vocabulario),
+            'nao_zeros': int(self._matriz.nnz) if self._matriz is not None else 0
+        }
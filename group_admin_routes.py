@@ -1,6 +1,6 @@
 # group_admin_routes.py - Funções específicas para gerenciamento de subadministradores
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from typing import List, Optional
 from datetime import datetime, date, timedelta
 from pydantic import BaseModel, Field
@@ -10,9 +10,11 @@ import asyncio
 # Importar dependências compartilhadas
 from dependencies import (
     get_current_user, UserProfile, require_page_access, 
-    supabase, supabase_admin, APIError, calcular_data_expiracao,
-    get_user_managed_groups, verify_group_admin_access, get_group_admin_user
+    supabase_admin, APIError, calcular_data_expiracao,
+    get_user_managed_groups, verify_group_admin_access, get_group_admin_user,
+    invalidar_cache_usuario, user_directory, buscar_por_ids
 )
+from database import db, db_admin
 
 # Criar router específico para group admins
 group_admin_router = APIRouter(prefix="/api/group-admin", tags=["group-admin"])
@@ -74,16 +76,12 @@ async def create_group_admin(
 
     try:
         # Verifica se o usuário existe
-        user_response = await asyncio.to_thread(
-            supabase.table('profiles').select('id, full_name').eq('id', admin_data.user_id).single().execute
-        )
+        user_response = await db.table('profiles').select('id, full_name').eq('id', admin_data.user_id).single().execute()
         if not user_response.data:
             raise HTTPException(status_code=404, detail="Usuário não encontrado")
 
         # Verifica se os grupos existem
-        groups_response = await asyncio.to_thread(
-            supabase.table('grupos').select('id').in_('id', admin_data.group_ids).execute
-        )
+        groups_response = await db.table('grupos').select('id').in_('id', admin_data.group_ids).execute()
         existing_group_ids = [group['id'] for group in groups_response.data]
         invalid_groups = set(admin_data.group_ids) - set(existing_group_ids)
 
@@ -96,9 +94,8 @@ async def create_group_admin(
             'group_ids': admin_data.group_ids
         }
 
-        response = await asyncio.to_thread(
-            supabase.table('group_admins').insert(admin_record).execute
-        )
+        response = await db.table('group_admins').insert(admin_record).execute()
+        invalidar_cache_usuario(admin_data.user_id)
 
         return response.data[0]
 
@@ -117,37 +114,25 @@ async def list_group_admins(
         raise HTTPException(status_code=403, detail="Apenas administradores gerais podem listar subadministradores")
 
     try:
-        response = await asyncio.to_thread(
-            supabase.table('group_admins').select('*').order('created_at').execute
-        )
+        response = await db.table('group_admins').select('*').order('created_at').execute()
 
         admins_with_details = []
 
-        for admin in response.data:
-            # Busca informações do usuário
-            user_response = await asyncio.to_thread(
-                supabase.table('profiles').select('full_name').eq('id', admin['user_id']).execute
-            )
-            user_name = user_response.data[0]['full_name'] if user_response.data else 'N/A'
-
-            # Busca email do usuário
-            user_email = "N/A"
-            try:
-                auth_response = await asyncio.to_thread(
-                    lambda: supabase_admin.auth.admin.get_user_by_id(admin['user_id'])
-                )
-                if auth_response.user:
-                    user_email = auth_response.user.email
-            except Exception as e:
-                logging.error(f"Erro ao buscar email do usuário {admin['user_id']}: {e}")
+        # Perfis, grupos e e-mails de todos os subadmins em lote
+        user_ids = [admin['user_id'] for admin in response.data]
+        todos_group_ids = {gid for admin in response.data for gid in (admin['group_ids'] or [])}
+        profiles, grupos, emails = await asyncio.gather(
+            buscar_por_ids(db, 'profiles', 'id, full_name', 'id', user_ids),
+            buscar_por_ids(db, 'grupos', 'id, nome', 'id', todos_group_ids),
+            user_directory.obter_emails(user_ids)
+        )
+        nomes_usuarios = {profile['id']: profile['full_name'] for profile in profiles}
+        nomes_grupos = {grupo['id']: grupo['nome'] for grupo in grupos}
 
-            # Busca nomes dos grupos
-            group_names = []
-            if admin['group_ids']:
-                groups_response = await asyncio.to_thread(
-                    supabase.table('grupos').select('nome').in_('id', admin['group_ids']).execute
-                )
-                group_names = [group['nome'] for group in groups_response.data]
+        for admin in response.data:
+            user_name = nomes_usuarios.get(admin['user_id'], 'N/A')
+            user_email = emails.get(admin['user_id']) or "N/A"
+            group_names = [nomes_grupos[gid] for gid in (admin['group_ids'] or []) if gid in nomes_grupos]
 
             admin_with_details = GroupAdminWithDetails(
                 user_id=admin['user_id'],
@@ -178,16 +163,12 @@ async def update_group_admin(
 
     try:
         # Verifica se o subadmin existe
-        existing_response = await asyncio.to_thread(
-            supabase.table('group_admins').select('*').eq('user_id', user_id).single().execute
-        )
+        existing_response = await db.table('group_admins').select('*').eq('user_id', user_id).single().execute()
         if not existing_response.data:
             raise HTTPException(status_code=404, detail="Subadministrador não encontrado")
 
         # Verifica se os grupos existem
-        groups_response = await asyncio.to_thread(
-            supabase.table('grupos').select('id').in_('id', admin_data.group_ids).execute
-        )
+        groups_response = await db.table('grupos').select('id').in_('id', admin_data.group_ids).execute()
         existing_group_ids = [group['id'] for group in groups_response.data]
         invalid_groups = set(admin_data.group_ids) - set(existing_group_ids)
 
@@ -200,9 +181,8 @@ async def update_group_admin(
             'updated_at': datetime.now().isoformat()
         }
 
-        response = await asyncio.to_thread(
-            supabase.table('group_admins').update(update_data).eq('user_id', user_id).execute
-        )
+        response = await db.table('group_admins').update(update_data).eq('user_id', user_id).execute()
+        invalidar_cache_usuario(user_id)
 
         return response.data[0]
 
@@ -222,9 +202,8 @@ async def delete_group_admin(
         raise HTTPException(status_code=403, detail="Apenas administradores gerais podem remover subadministradores")
 
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('group_admins').delete().eq('user_id', user_id).execute()
-        )
+        await db.table('group_admins').delete().eq('user_id', user_id).execute()
+        invalidar_cache_usuario(user_id)
         return
     except Exception as e:
         logging.error(f"Erro ao deletar subadministrador: {e}")
@@ -236,59 +215,55 @@ async def delete_group_admin(
 
 @group_admin_router.get("/users", response_model=List[dict])
 async def get_group_users(
+    response: Response,
     group_id: int = Query(..., description="ID do grupo para listar usuários"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(1000, ge=1, le=1000),
     current_user: UserProfile = Depends(get_group_admin_user)
 ):
-    """Lista usuários de um grupo específico (subadmin)"""
+    """Lista usuários de um grupo específico (subadmin), paginado; o total vem no cabeçalho X-Total-Count"""
     try:
         # Verifica se o subadmin tem acesso ao grupo
-        if current_user.role != 'admin' and not await verify_group_admin_access(current_user.id, group_id):
+        if current_user.role != 'admin' and group_id not in current_user.managed_groups:
             raise HTTPException(status_code=403, detail="Acesso negado a este grupo")
 
-        # Busca usuários do grupo
-        user_groups_response = await asyncio.to_thread(
-            supabase_admin.table('user_groups')
-            .select('user_id, data_expiracao, created_at')
+        # Busca usuários do grupo (uma página)
+        inicio = (page - 1) * page_size
+        user_groups_response = await (
+            db_admin.table('user_groups')
+            .select('user_id, data_expiracao, created_at', count='exact')
             .eq('group_id', group_id)
-            .execute
+            .order('created_at', desc=True)
+            .range(inicio, inicio + page_size - 1)
+            .execute()
         )
+        response.headers['X-Total-Count'] = str(user_groups_response.count or 0)
 
         if not user_groups_response.data:
             return []
 
+        # Perfis e e-mails de toda a página em lote, unidos em memória
+        user_ids = [ug['user_id'] for ug in user_groups_response.data]
+        profiles, emails = await asyncio.gather(
+            buscar_por_ids(db_admin, 'profiles', 'id, full_name, role, allowed_pages, avatar_url', 'id', user_ids),
+            user_directory.obter_emails(user_ids)
+        )
+        profiles_por_id = {profile['id']: profile for profile in profiles}
+
         users_with_details = []
 
         for user_group in user_groups_response.data:
             user_id = user_group['user_id']
+            profile = profiles_por_id.get(user_id)
 
-            # Busca informações do perfil
-            profile_response = await asyncio.to_thread(
-                supabase_admin.table('profiles')
-                .select('full_name, role, allowed_pages, avatar_url')
-                .eq('id', user_id)
-                .single()
-                .execute
-            )
-
-            # Busca email do usuário
-            user_email = "N/A"
-            try:
-                auth_response = await asyncio.to_thread(
-                    lambda: supabase_admin.auth.admin.get_user_by_id(user_id)
-                )
-                if auth_response.user:
-                    user_email = auth_response.user.email
-            except Exception as e:
-                logging.error(f"Erro ao buscar email do usuário {user_id}: {e}")
-
-            if profile_response.data:
+            if profile:
                 user_data = {
                     "id": user_id,
-                    "full_name": profile_response.data.get('full_name'),
-                    "email": user_email,
-                    "role": profile_response.data.get('role'),
-                    "allowed_pages": profile_response.data.get('allowed_pages', []),
-                    "avatar_url": profile_response.data.get('avatar_url'),
+                    "full_name": profile.get('full_name'),
+                    "email": emails.get(user_id) or "N/A",
+                    "role": profile.get('role'),
+                    "allowed_pages": profile.get('allowed_pages', []),
+                    "avatar_url": profile.get('avatar_url'),
                     "data_expiracao": user_group['data_expiracao'],
                     "created_at": user_group['created_at']
                 }
@@ -296,6 +271,8 @@ async def get_group_users(
 
         return users_with_details
 
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Erro ao listar usuários do grupo: {e}")
         raise HTTPException(status_code=500, detail="Erro ao listar usuários do grupo")
@@ -312,9 +289,7 @@ async def create_group_user(
             raise HTTPException(status_code=403, detail="Acesso negado a este grupo")
 
         # Verifica se o grupo existe
-        group_response = await asyncio.to_thread(
-            supabase.table('grupos').select('dias_acesso').eq('id', user_data.group_id).single().execute
-        )
+        group_response = await db.table('grupos').select('dias_acesso').eq('id', user_data.group_id).single().execute()
         if not group_response.data:
             raise HTTPException(status_code=404, detail="Grupo não encontrado")
 
@@ -329,15 +304,16 @@ async def create_group_user(
         )
 
         user_id = created_user_res.user.id
+        user_directory.registrar(user_id, user_data.email)
         logging.info(f"Usuário criado no Auth com ID: {user_id}")
 
         # Atualiza o perfil com role 'user' (subadmins só podem criar usuários comuns)
-        profile_update_response = await asyncio.to_thread(
-            supabase_admin.table('profiles').update({
+        profile_update_response = await (
+            db_admin.table('profiles').update({
                 'role': 'user',
                 'allowed_pages': user_data.allowed_pages,
                 'full_name': user_data.full_name
-            }).eq('id', user_id).execute
+            }).eq('id', user_id).execute()
         )
 
         if not profile_update_response.data:
@@ -354,9 +330,8 @@ async def create_group_user(
             'data_expiracao': data_expiracao.isoformat()
         }
 
-        await asyncio.to_thread(
-            supabase_admin.table('user_groups').insert(user_group_data).execute
-        )
+        await db_admin.table('user_groups').insert(user_group_data).execute()
+        invalidar_cache_usuario(user_id)
 
         logging.info(f"Usuário {user_id} criado e associado ao grupo {user_data.group_id} pelo subadmin {current_user.id}")
         return {"message": "Usuário criado com sucesso no grupo"}
@@ -377,11 +352,11 @@ async def update_group_user(
     """Atualiza um usuário em um grupo específico (subadmin)"""
     try:
         # Verifica se o usuário pertence a algum grupo gerenciado pelo subadmin
-        user_groups_response = await asyncio.to_thread(
-            supabase_admin.table('user_groups')
+        user_groups_response = await (
+            db_admin.table('user_groups')
             .select('group_id')
             .eq('user_id', user_id)
-            .execute
+            .execute()
         )
 
         if not user_groups_response.data:
@@ -401,8 +376,8 @@ async def update_group_user(
             update_data['allowed_pages'] = user_data.allowed_pages
 
         if update_data:
-            await asyncio.to_thread(
-                lambda: supabase_admin.table('profiles')
+            await (
+                db_admin.table('profiles')
                 .update(update_data)
                 .eq('id', user_id)
                 .execute()
@@ -417,6 +392,7 @@ async def update_group_user(
                         {"email": user_data.email}
                     )
                 )
+                user_directory.registrar(user_id, user_data.email)
             except Exception as e:
                 logging.error(f"Erro ao atualizar email do usuário: {e}")
 
@@ -425,14 +401,15 @@ async def update_group_user(
             # Atualiza em todos os grupos do usuário que o subadmin gerencia
             for group_id in user_group_ids:
                 if current_user.role == 'admin' or await verify_group_admin_access(current_user.id, group_id):
-                    await asyncio.to_thread(
-                        lambda: supabase_admin.table('user_groups')
+                    await (
+                        db_admin.table('user_groups')
                         .update({'data_expiracao': user_data.data_expiracao})
                         .eq('user_id', user_id)
                         .eq('group_id', group_id)
                         .execute()
                     )
 
+        invalidar_cache_usuario(user_id)
         return {"message": "Usuário atualizado com sucesso"}
 
     except HTTPException:
@@ -449,11 +426,11 @@ async def delete_group_user(
     """Remove um usuário de um grupo específico (subadmin)"""
     try:
         # Verifica se o usuário pertence a algum grupo gerenciado pelo subadmin
-        user_groups_response = await asyncio.to_thread(
-            supabase_admin.table('user_groups')
+        user_groups_response = await (
+            db_admin.table('user_groups')
             .select('group_id')
             .eq('user_id', user_id)
-            .execute
+            .execute()
         )
 
         if not user_groups_response.data:
@@ -468,8 +445,8 @@ async def delete_group_user(
         # Remove o usuário de todos os grupos gerenciados pelo subadmin
         for group_id in user_group_ids:
             if current_user.role == 'admin' or await verify_group_admin_access(current_user.id, group_id):
-                await asyncio.to_thread(
-                    lambda: supabase_admin.table('user_groups')
+                await (
+                    db_admin.table('user_groups')
                     .delete()
                     .eq('user_id', user_id)
                     .eq('group_id', group_id)
@@ -477,6 +454,7 @@ async def delete_group_user(
                 )
 
         # Não deleta o usuário do Auth, apenas remove dos grupos
+        invalidar_cache_usuario(user_id)
         logging.info(f"Usuário {user_id} removido dos grupos pelo subadmin {current_user.id}")
         return
 
@@ -493,11 +471,11 @@ async def renew_user_access(
     """Renova o acesso de um usuário em um grupo específico (subadmin) - CORRIGIDO"""
     try:
         # Buscar todas as associações do usuário
-        user_groups_response = await asyncio.to_thread(
-            supabase_admin.table('user_groups')
+        user_groups_response = await (
+            db_admin.table('user_groups')
             .select('id, group_id, data_expiracao')
             .eq('user_id', user_id)
-            .execute
+            .execute()
         )
 
         if not user_groups_response.data:
@@ -534,8 +512,8 @@ async def renew_user_access(
                     nova_data = data_expiracao + timedelta(days=dias_adicionais)
 
                 # Atualizar no banco
-                await asyncio.to_thread(
-                    lambda: supabase_admin.table('user_groups')
+                await (
+                    db_admin.table('user_groups')
                     .update({'data_expiracao': nova_data.isoformat()})
                     .eq('id', user_group['id'])
                     .execute()
@@ -545,6 +523,8 @@ async def renew_user_access(
         if updated_count == 0:
             raise HTTPException(status_code=403, detail="Nenhuma associação pôde ser renovada")
 
+        invalidar_cache_usuario(user_id)
+
         return {"message": f"Acesso renovado por {dias_adicionais} dias para {updated_count} associação(ões)"}
 
     except HTTPException:
@@ -565,9 +545,7 @@ async def get_my_groups(
     try:
         if current_user.role == 'admin':
             # Admin geral vê todos os grupos
-            groups_response = await asyncio.to_thread(
-                supabase.table('grupos').select('*').order('nome').execute
-            )
+            groups_response = await db.table('grupos').select('*').order('nome').execute()
             return groups_response.data or []
         else:
             # Subadmin vê apenas seus grupos designados
@@ -575,23 +553,23 @@ async def get_my_groups(
             if not managed_groups:
                 return []
 
-            groups_response = await asyncio.to_thread(
-                supabase.table('grupos')
+            groups_response = await (
+                db.table('grupos')
                 .select('*')
                 .in_('id', managed_groups)
                 .order('nome')
-                .execute
+                .execute()
             )
 
             groups_with_details = []
             for group in groups_response.data:
                 # Contar usuários ativos no grupo
-                user_groups_response = await asyncio.to_thread(
-                    supabase_admin.table('user_groups')
+                user_groups_response = await (
+                    db_admin.table('user_groups')
                     .select('user_id', count='exact')
                     .eq('group_id', group['id'])
                     .gte('data_expiracao', date.today().isoformat())
-                    .execute
+                    .execute()
                 )
 
                 group_with_details = {
@@ -1,19 +1,29 @@
 # main.py (completo e atualizado com análise gráfica) - VERSÃO 3.5.0
 import os
 import asyncio
+import time
+import json
+import base64
+import bisect
+from collections import Counter
 from datetime import date, timedelta, datetime
 import logging
 from fastapi import FastAPI, BackgroundTasks, HTTPException, Query, Depends, Header, Request
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from supabase import create_client, Client
 from postgrest.exceptions import APIError
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Set
 import pandas as pd
 import collector_service
+from activity_log import ActivityLogWriter
+from search_index import SearchIndexManager, SUGGEST_LIMITE, normalizar_gtin
+from search_cache import SearchResultCache
+from cache_warmer import SearchCacheWarmer
+from product_clusters import ProductClusterService
 from dashboard_routes import dashboard_router
 import uuid
 from fastapi import UploadFile, File, Form
@@ -22,8 +32,15 @@ from fastapi import UploadFile, File, Form
 from dependencies import (
     get_current_user, get_current_user_optional, require_page_access, 
     UserProfile, supabase, supabase_admin, calcular_data_expiracao,
-    update_group_members_expiration, renew_group_access, get_group_statistics
+    update_group_members_expiration, renew_group_access, get_group_statistics,
+    user_profile_cache, invalidar_cache_usuario, invalidar_cache_usuarios, invalidar_cache_grupo, membros_do_grupo, user_directory,
+    access_sweeper,
+    buscar_por_ids
 )
+import database
+from database import db, db_admin
+import repository
+from repository import repositorio
 from group_admin_routes import group_admin_router
 
 # --------------------------------------------------------------------------
@@ -77,6 +94,48 @@ initial_status = {
 }
 collection_status: Dict[str, Any] = initial_status.copy()
 
+# Resultados das buscas em tempo real são gravados em lote na tabela produtos
+REALTIME_WRITEBACK_ENABLED = os.getenv("REALTIME_WRITEBACK_ENABLED", "true").lower() == "true"
+realtime_writeback = collector_service.RealtimeWriteBack(supabase_admin)
+
+def registrar_resultados_realtime(registros: List[Dict[str, Any]]):
+    """Envia resultados de buscas em tempo real para o write-back, se habilitado"""
+    if REALTIME_WRITEBACK_ENABLED and registros:
+        realtime_writeback.adicionar(registros)
+    _ao_salvar_registros(registros)
+
+def _ao_salvar_registros(registros: List[Dict[str, Any]]):
+    """Registros novos (coleta ou tempo real): entram no índice e invalidam as buscas dos mercados afetados"""
+    if not registros:
+        return
+    search_index.adicionar(registros)
+    product_clusters.adicionar(registros)
+    search_cache.invalidar_mercados({r.get('cnpj_supermercado') for r in registros if r.get('cnpj_supermercado')})
+
+async def _ao_finalizar_coleta():
+    total = search_cache.limpar()
+    logging.info(f"🧹 Coleta finalizada: {total} buscas em cache descartadas")
+    search_cache_warmer.agendar()
+    if product_clusters.pronto:
+        product_clusters.agendar()
+
+# Cache dos resultados em tempo real por (termo, cnpj), reaproveitado na precificação de cestas
+REALTIME_CACHE_TTL_SECONDS = int(os.getenv("REALTIME_CACHE_TTL_SECONDS", "600"))
+BASKET_REALTIME_CONCURRENCY = int(os.getenv("BASKET_REALTIME_CONCURRENCY", "8"))
+realtime_cache = collector_service.RealtimeCache(ttl_segundos=REALTIME_CACHE_TTL_SECONDS)
+
+# Índice de busca em memória (produtos mais recentes por mercado), atualizado pela coleta e pelo tempo real
+search_index = SearchIndexManager(db)
+
+# Resultados processados de /api/search por (termo, mercados), invalidados pela coleta e pelo tempo real
+search_cache = SearchResultCache()
+
+# Clusters de produtos equivalentes sem GTIN (MinHash + LSH), usados na busca, na comparação e nas cestas
+product_clusters = ProductClusterService(db_admin)
+
+# Logs de atividade (log_de_usuarios) gravados em lote por um consumidor em background
+activity_log_writer = ActivityLogWriter(db_admin, user_directory)
+
 app.add_middleware(
     CORSMiddleware, 
     allow_origins=ALLOWED_ORIGINS,
@@ -149,6 +208,26 @@ class CustomActionRequest(BaseModel):
     details: Dict[str, Any] = Field(default_factory=dict)
     timestamp: str
 
+LOG_EVENTS_MAX_BATCH = int(os.getenv("LOG_EVENTS_MAX_BATCH", "200"))
+
+class ActivityEvent(BaseModel):
+    type: str = Field(..., pattern="^(page_access|custom_action)$")
+    page: str = Field(..., max_length=200)
+    action_type: Optional[str] = Field(None, max_length=100)
+    details: Dict[str, Any] = Field(default_factory=dict)
+    timestamp: Optional[str] = None
+
+class ActivityEventBatch(BaseModel):
+    events: List[ActivityEvent] = Field(..., max_items=LOG_EVENTS_MAX_BATCH)
+    # navigator.sendBeacon não envia cabeçalhos; o token pode vir no corpo
+    access_token: Optional[str] = None
+
+BARCODE_BATCH_MAX = int(os.getenv("BARCODE_BATCH_MAX", "200"))
+
+class BarcodeBatchRequest(BaseModel):
+    gtins: List[str] = Field(..., min_items=1, max_items=BARCODE_BATCH_MAX)
+    cnpjs: Optional[List[str]] = None
+
 # NOVOS MODELOS PARA CESTA BÁSICA
 class CestaItem(BaseModel):
     nome_produto: str = Field(..., max_length=150)
@@ -261,110 +340,32 @@ class PriceAnalysisResponse(BaseModel):
 # --- 5. FUNÇÕES DE LOG ---
 # --------------------------------------------------------------------------
 def log_search(term: str, type: str, cnpjs: Optional[List[str]], count: int, user: Optional[UserProfile] = None):
-    """Função para registrar logs de busca, rodando em background."""
-    try:
-        user_id = user.id if user else None
-        user_name = None
-        user_email = None
-
-        if user_id:
-            try:
-                profile_response = supabase_admin.table('profiles').select('full_name').eq('id', user_id).single().execute
-                if profile_response.data:
-                    user_name = profile_response.data.get('full_name')
-
-                auth_response = supabase_admin.auth.admin.get_user_by_id(user_id)
-                if auth_response.user:
-                    user_email = auth_response.user.email
-                    if not user_name:
-                        user_name = user_email
-            except Exception as e:
-                logging.error(f"Erro ao buscar informações do usuário {user_id}: {e}")
-
-        log_data = {
-            "user_id": user_id,
-            "user_name": user_name,
-            "user_email": user_email,
-            "action_type": "search" if type == 'database' else "realtime_search",
-            "search_term": term,
-            "selected_markets": cnpjs if cnpjs else [],
-            "result_count": count
-        }
-
-        supabase_admin.table('log_de_usuarios').insert(log_data).execute()
-        logging.info(f"Log de busca salvo para usuário {user_id}: {term}")
-
-    except Exception as e: 
-        logging.error(f"Erro ao salvar log de busca: {e}")
+    """Registra o log de busca no pipeline de logs (gravação em lote, em background)."""
+    activity_log_writer.registrar({
+        "user_id": user.id if user else None,
+        "action_type": "search" if type == 'database' else "realtime_search",
+        "search_term": term,
+        "selected_markets": cnpjs if cnpjs else [],
+        "result_count": count
+    })
 
 def log_page_access(page_key: str, user: UserProfile):
-    """Função para registrar o acesso à página, rodando em background."""
-    try:
-        user_name = None
-        user_email = None
-
-        if user.id:
-            try:
-                profile_response = supabase_admin.table('profiles').select('full_name').eq('id', user.id).single().execute
-                if profile_response.data:
-                    user_name = profile_response.data.get('full_name')
-
-                auth_response = supabase_admin.auth.admin.get_user_by_id(user.id)
-                if auth_response.user:
-                    user_email = auth_response.user.email
-                    if not user_name:
-                        user_name = user_email
-            except Exception as e:
-                logging.error(f"Erro ao buscar informações do usuário {user.id}: {e}")
-
-        log_data = {
-            "user_id": user.id,
-            "user_name": user_name,
-            "user_email": user_email,
-            "action_type": "access",
-            "page_accessed": page_key,
-        }
-        supabase_admin.table('log_de_usuarios').insert(log_data).execute()
-        logging.info(f"Log de acesso salvo para usuário {user.id}: {page_key}")
-    except Exception as e:
-        logging.error(f"Erro ao salvar log de acesso à página {page_key} para {user.id}: {e}")
+    """Registra o acesso à página no pipeline de logs."""
+    activity_log_writer.registrar({
+        "user_id": user.id,
+        "action_type": "access",
+        "page_accessed": page_key,
+    })
 
 def log_custom_action_internal(request: CustomActionRequest, user: Optional[UserProfile]):
-    """Função interna para registrar ações customizadas."""
-    try:
-        user_id = user.id if user else None
-        user_name = None
-        user_email = None
-
-        if user_id:
-            try:
-                profile_response = supabase_admin.table('profiles').select('full_name').eq('id', user_id).single().execute
-                if profile_response.data:
-                    user_name = profile_response.data.get('full_name')
-
-                auth_response = supabase_admin.auth.admin.get_user_by_id(user_id)
-                if auth_response.user:
-                    user_email = auth_response.user.email
-                    if not user_name:
-                        user_name = user_email
-            except Exception as e:
-                logging.error(f"Erro ao buscar informações do usuário {user_id}: {e}")
-
-        log_data = {
-            "user_id": user_id,
-            "user_name": user_name,
-            "user_email": user_email,
-            "action_type": request.action_type,
-            "page_accessed": request.page,
-            "details": request.details,
-            "created_at": request.timestamp
-        }
-
-        supabase_admin.table('log_de_usuarios').insert(log_data).execute()
-        logging.info(f"Ação customizada registrada: {request.action_type} para usuário {user_id}")
-
-    except Exception as e:
-        logging.error(f"Erro ao salvar ação customizada: {e}")
+    """Registra uma ação customizada no pipeline de logs."""
+    activity_log_writer.registrar({
+        "user_id": user.id if user else None,
+        "action_type": request.action_type,
+        "page_accessed": request.page,
+        "details": request.details,
+        "created_at": request.timestamp
+    })
 
 # --------------------------------------------------------------------------
 # --- 6. ENDPOINTS DA APLICAÇÃO ---
@@ -454,9 +455,7 @@ async def upload_avatar(
 @app.get("/api/users/me")
 async def get_my_profile(current_user: UserProfile = Depends(get_current_user)):
     try:
-        response = await asyncio.to_thread(
-            supabase.table('profiles').select('*').eq('id', current_user.id).single().execute
-        )
+        response = await db.table('profiles').select('*').eq('id', current_user.id).single().execute()
 
         profile_data = response.data
 
@@ -516,15 +515,11 @@ async def update_my_profile(profile_data: ProfileUpdateWithCredentials, current_
 
         if profile_update_data:
             logging.info(f"Atualizando perfil {current_user.id} com os dados: {profile_update_data}")
-            response = await asyncio.to_thread(
-                lambda: supabase.table('profiles').update(profile_update_data).eq('id', current_user.id).execute()
-            )
+            response = await db.table('profiles').update(profile_update_data).eq('id', current_user.id).execute()
             if response.data:
                 return response.data[0]
 
-        response = await asyncio.to_thread(
-            lambda: supabase.table('profiles').select('*').eq('id', current_user.id).single().execute()
-        )
+        response = await db.table('profiles').select('*').eq('id', current_user.id).single().execute()
         return response.data
 
     except HTTPException:
@@ -552,15 +547,16 @@ async def create_user(user_data: UserCreate, admin_user: UserProfile = Depends(r
         )
 
         user_id = created_user_res.user.id
+        user_directory.registrar(user_id, user_data.email)
         logging.info(f"Usuário criado no Auth com ID: {user_id}")
 
         # Atualizar perfil com role e páginas permitidas
-        profile_update_response = await asyncio.to_thread(
-            supabase_admin.table('profiles').update({
+        profile_update_response = await (
+            db_admin.table('profiles').update({
                 'role': user_data.role, 
                 'allowed_pages': user_data.allowed_pages,
                 'full_name': user_data.full_name
-            }).eq('id', user_id).execute
+            }).eq('id', user_id).execute()
         )
 
         if not profile_update_response.data:
@@ -573,9 +569,7 @@ async def create_user(user_data: UserCreate, admin_user: UserProfile = Depends(r
                 'user_id': user_id,
                 'group_ids': user_data.managed_groups
             }
-            await asyncio.to_thread(
-                supabase_admin.table('group_admins').insert(admin_record).execute
-            )
+            await db_admin.table('group_admins').insert(admin_record).execute()
             logging.info(f"Admin de grupo criado com ID {user_id} para grupos: {user_data.managed_groups}")
 
         logging.info(f"Perfil do usuário {user_id} atualizado com a role: {user_data.role}")
@@ -593,9 +587,7 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
         print(f"DEBUG: Atualizando usuário {user_id} com dados: {user_data}")
 
         # Verificar se o usuário existe
-        user_resp = await asyncio.to_thread(
-            lambda: supabase.table('profiles').select('id, role, allowed_pages, full_name').eq('id', user_id).execute()
-        )
+        user_resp = await db.table('profiles').select('id, role, allowed_pages, full_name').eq('id', user_id).execute()
         if not user_resp.data:
             raise HTTPException(status_code=404, detail="Usuário não encontrado")
 
@@ -611,9 +603,7 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
         print(f"DEBUG: Dados de atualização do perfil: {profile_update_data}")
 
         # CORREÇÃO: Usar supabase_admin para operações de atualização
-        profile_response = await asyncio.to_thread(
-            lambda: supabase_admin.table('profiles').update(profile_update_data).eq('id', user_id).execute()
-        )
+        profile_response = await db_admin.table('profiles').update(profile_update_data).eq('id', user_id).execute()
 
         # CORREÇÃO: Verificar erro da forma correta para a biblioteca Supabase
         if hasattr(profile_response, 'error') and profile_response.error:
@@ -629,9 +619,7 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
 
             if user_data.managed_groups:
                 # Verificar se todos os grupos existem
-                groups_response = await asyncio.to_thread(
-                    lambda: supabase.table('grupos').select('id').in_('id', user_data.managed_groups).execute()
-                )
+                groups_response = await db.table('grupos').select('id').in_('id', user_data.managed_groups).execute()
                 existing_group_ids = [group['id'] for group in groups_response.data]
                 invalid_groups = set(user_data.managed_groups) - set(existing_group_ids)
 
@@ -639,9 +627,7 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
                     raise HTTPException(status_code=404, detail=f"Grupos não encontrados: {invalid_groups}")
 
             # Verificar se já existe registro
-            existing_admin = await asyncio.to_thread(
-                lambda: supabase.table('group_admins').select('*').eq('user_id', user_id).execute()
-            )
+            existing_admin = await db.table('group_admins').select('*').eq('user_id', user_id).execute()
 
             admin_record = {
                 'user_id': user_id,
@@ -651,9 +637,7 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
 
             if existing_admin.data:
                 # Atualizar
-                update_result = await asyncio.to_thread(
-                    lambda: supabase.table('group_admins').update(admin_record).eq('user_id', user_id).execute()
-                )
+                update_result = await db.table('group_admins').update(admin_record).eq('user_id', user_id).execute()
                 if hasattr(update_result, 'error') and update_result.error:
                     error_msg = getattr(update_result.error, 'message', str(update_result.error))
                     print(f"DEBUG: Erro ao atualizar group_admins: {error_msg}")
@@ -661,9 +645,7 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
                     print(f"DEBUG: Group admin atualizado: {update_result.data}")
             else:
                 # Criar novo
-                insert_result = await asyncio.to_thread(
-                    lambda: supabase.table('group_admins').insert(admin_record).execute()
-                )
+                insert_result = await db.table('group_admins').insert(admin_record).execute()
                 if hasattr(insert_result, 'error') and insert_result.error:
                     error_msg = getattr(insert_result.error, 'message', str(insert_result.error))
                     print(f"DEBUG: Erro ao criar group_admins: {error_msg}")
@@ -672,13 +654,12 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
         elif user_data.role != "group_admin":
             print("DEBUG: Removendo de group_admins (não é mais admin de grupo)")
             # Remover da tabela group_admins se não for mais admin de grupo
-            delete_result = await asyncio.to_thread(
-                lambda: supabase.table('group_admins').delete().eq('user_id', user_id).execute()
-            )
+            delete_result = await db.table('group_admins').delete().eq('user_id', user_id).execute()
             if hasattr(delete_result, 'error') and delete_result.error:
                 error_msg = getattr(delete_result.error, 'message', str(delete_result.error))
                 print(f"DEBUG: Erro ao remover group_admins: {error_msg}")
 
+        invalidar_cache_usuario(user_id)
         print("DEBUG: Usuário atualizado com sucesso")
         return {"message": "Usuário atualizado com sucesso"}
 
@@ -692,36 +673,29 @@ async def update_user(user_id: str, user_data: UserUpdate, admin_user: UserProfi
 @app.get("/api/users")
 async def list_users(admin_user: UserProfile = Depends(require_page_access('users'))):
     try:
-        profiles_response = await asyncio.to_thread(
-            supabase.table('profiles').select(
+        profiles_response = await (
+            db.table('profiles').select(
                 'id, full_name, role, allowed_pages, avatar_url'
-            ).execute
+            ).execute()
         )
         profiles = profiles_response.data or []
 
-        users = []
-        for profile in profiles:
-            email = None
+        emails = await user_directory.obter_emails(profile['id'] for profile in profiles)
+
+        # Grupos gerenciados de todos os admins de grupo em uma única consulta
+        grupos_por_admin = {}
+        ids_group_admin = [profile['id'] for profile in profiles if profile.get('role') == 'group_admin']
+        if ids_group_admin:
             try:
-                auth_response = await asyncio.to_thread(
-                    lambda: supabase_admin.auth.admin.get_user_by_id(profile['id'])
-                )
-                if auth_response.user:
-                    email = auth_response.user.email
+                admin_response = await db_admin.table('group_admins').select('user_id, group_ids').in_('user_id', ids_group_admin).execute()
+                grupos_por_admin = {a['user_id']: a.get('group_ids', []) for a in admin_response.data or []}
             except Exception as e:
-                logging.error(f"Erro ao buscar e-mail do usuário {profile['id']}: {e}")
+                logging.error(f"Erro ao buscar grupos gerenciados: {e}")
 
-            # Buscar grupos gerenciados se for admin de grupo
-            managed_groups = []
-            if profile.get('role') == 'group_admin':
-                try:
-                    admin_response = await asyncio.to_thread(
-                        supabase_admin.table('group_admins').select('group_ids').eq('user_id', profile['id']).execute
-                    )
-                    if admin_response.data:
-                        managed_groups = admin_response.data[0].get('group_ids', [])
-                except Exception as e:
-                    logging.error(f"Erro ao buscar grupos gerenciados: {e}")
+        users = []
+        for profile in profiles:
+            email = emails.get(profile['id'])
+            managed_groups = grupos_por_admin.get(profile['id'], [])
 
             users.append({
                 "id": profile["id"],
@@ -750,9 +724,7 @@ async def get_user(
         print(f"DEBUG: Buscando usuário {user_id}")
 
         # Buscar perfil do usuário
-        profile_response = await asyncio.to_thread(
-            supabase.table('profiles').select('*').eq('id', user_id).single().execute
-        )
+        profile_response = await db.table('profiles').select('*').eq('id', user_id).single().execute()
 
         if not profile_response.data:
             raise HTTPException(status_code=404, detail="Usuário não encontrado")
@@ -761,23 +733,13 @@ async def get_user(
         print(f"DEBUG: Perfil encontrado: {profile}")
 
         # Buscar email do usuário
-        email = None
-        try:
-            auth_response = await asyncio.to_thread(
-                lambda: supabase_admin.auth.admin.get_user_by_id(user_id)
-            )
-            if auth_response.user:
-                email = auth_response.user.email
-        except Exception as e:
-            logging.error(f"Erro ao buscar email do usuário {user_id}: {e}")
+        email = await user_directory.obter_email(user_id)
 
         # Buscar grupos gerenciados se for admin de grupo
         managed_groups = []
         if profile.get('role') == 'group_admin':
             try:
-                admin_response = await asyncio.to_thread(
-                    supabase_admin.table('group_admins').select('group_ids').eq('user_id', user_id).execute
-                )
+                admin_response = await db_admin.table('group_admins').select('group_ids').eq('user_id', user_id).execute()
                 if admin_response.data:
                     managed_groups = admin_response.data[0].get('group_ids', [])
             except Exception as e:
@@ -806,14 +768,14 @@ async def get_user(
 async def delete_user(user_id: str, admin_user: UserProfile = Depends(require_page_access('users'))):
     try:
         # Remover de group_admins se existir
-        await asyncio.to_thread(
-            lambda: supabase_admin.table('group_admins').delete().eq('user_id', user_id).execute()
-        )
+        await db_admin.table('group_admins').delete().eq('user_id', user_id).execute()
 
         # Deletar usuário
         await asyncio.to_thread(
             lambda: supabase_admin.auth.admin.delete_user(user_id)
         )
+        invalidar_cache_usuario(user_id)
+        user_directory.remover(user_id)
         logging.info(f"Usuário com ID {user_id} foi excluído pelo admin {admin_user.id}")
         return
     except Exception as e:
@@ -823,32 +785,24 @@ async def delete_user(user_id: str, admin_user: UserProfile = Depends(require_pa
 # --- Gerenciamento de Categorias ---
 @app.get("/api/categories", response_model=List[Categoria])
 async def list_categories(user: UserProfile = Depends(get_current_user)):
-    resp = await asyncio.to_thread(
-        supabase.table('categorias').select('*').order('nome').execute
-    )
+    resp = await db.table('categorias').select('*').order('nome').execute()
     return resp.data
 
 @app.post("/api/categories", response_model=Categoria)
 async def create_category(categoria: Categoria, admin_user: UserProfile = Depends(require_page_access('users'))):
-    resp = await asyncio.to_thread(
-        supabase.table('categorias').insert(categoria.dict(exclude={'id'})).execute
-    )
+    resp = await db.table('categorias').insert(categoria.dict(exclude={'id'})).execute()
     return resp.data[0]
 
 @app.put("/api/categories/{id}", response_model=Categoria)
 async def update_category(id: int, categoria: Categoria, admin_user: UserProfile = Depends(require_page_access('users'))):
-    resp = await asyncio.to_thread(
-        supabase.table('categorias').update(categoria.dict(exclude={'id', 'created_at'})).eq('id', id).execute
-    )
+    resp = await db.table('categorias').update(categoria.dict(exclude={'id', 'created_at'})).eq('id', id).execute()
     if not resp.data: 
         raise HTTPException(status_code=404, detail="Categoria não encontrada")
     return resp.data[0]
 
 @app.delete("/api/categories/{id}", status_code=204)
 async def delete_category(id: int, admin_user: UserProfile = Depends(require_page_access('users'))):
-    await asyncio.to_thread(
-        lambda: supabase.table('categorias').delete().eq('id', id).execute()
-    )
+    await db.table('categorias').delete().eq('id', id).execute()
     return
 
 # --- ENDPOINTS DE NOTIFICAÇÕES COMPLETAMENTE CORRIGIDOS (SEM updated_at) ---
@@ -866,7 +820,7 @@ async def get_user_notifications(
         end_index = start_index + limit - 1
 
         # Query para buscar notificações do usuário OU globais (user_id = null)
-        query = supabase_admin.table('notifications').select('*', count='exact')
+        query = db_admin.table('notifications').select('*', count='exact')
 
         # Filtro por usuário: notificações globais (sem user_id) ou específicas do usuário
         query = query.or_(f"user_id.eq.{current_user.id},user_id.is.null")
@@ -874,9 +828,7 @@ async def get_user_notifications(
         if unread_only:
             query = query.eq('is_read', False)
 
-        response = await asyncio.to_thread(
-            query.order('created_at', desc=True).range(start_index, end_index).execute
-        )
+        response = await query.order('created_at', desc=True).range(start_index, end_index).execute()
 
         # Buscar informações dos criadores
         notifications_with_creators = []
@@ -884,12 +836,12 @@ async def get_user_notifications(
             creator_name = None
             if notification.get('created_by'):
                 try:
-                    creator_resp = await asyncio.to_thread(
-                        supabase_admin.table('profiles')
+                    creator_resp = await (
+                        db_admin.table('profiles')
                         .select('full_name')
                         .eq('id', notification['created_by'])
                         .single()
-                        .execute
+                        .execute()
                     )
                     if creator_resp.data:
                         creator_name = creator_resp.data.get('full_name')
@@ -917,12 +869,12 @@ async def get_user_notifications(
 async def get_unread_count(current_user: UserProfile = Depends(get_current_user)):
     """Conta notificações não lidas do usuário - VERSÃO CORRIGIDA"""
     try:
-        response = await asyncio.to_thread(
-            supabase_admin.table('notifications')
+        response = await (
+            db_admin.table('notifications')
             .select('id', count='exact')
             .or_(f"user_id.eq.{current_user.id},user_id.is.null")
             .eq('is_read', False)
-            .execute
+            .execute()
         )
 
         return {"unread_count": response.count or 0}
@@ -942,12 +894,12 @@ async def update_notification(
         print(f"🔔 DEBUG: Tentando marcar notificação {notification_id} como lida para usuário {current_user.id}")
 
         # Verificar se a notificação existe e pertence ao usuário ou é global
-        notif_response = await asyncio.to_thread(
-            supabase_admin.table('notifications')
+        notif_response = await (
+            db_admin.table('notifications')
             .select('*')
             .eq('id', notification_id)
             .or_(f"user_id.eq.{current_user.id},user_id.is.null")
-            .execute
+            .execute()
         )
 
         if not notif_response.data:
@@ -964,11 +916,11 @@ async def update_notification(
         print(f"✅ DEBUG: Dados de atualização (SEM updated_at): {update_data}")
 
         # Atualizar a notificação específica
-        response = await asyncio.to_thread(
-            supabase_admin.table('notifications')
+        response = await (
+            db_admin.table('notifications')
             .update(update_data)
             .eq('id', notification_id)
-            .execute
+            .execute()
         )
 
         # Verificar erro de forma compatível com a biblioteca Supabase
@@ -1004,12 +956,12 @@ async def mark_all_notifications_read(current_user: UserProfile = Depends(get_cu
         }
 
         # Atualizar notificações do usuário específico e globais não lidas
-        response = await asyncio.to_thread(
-            supabase_admin.table('notifications')
+        response = await (
+            db_admin.table('notifications')
             .update(update_data)
             .or_(f"user_id.eq.{current_user.id},user_id.is.null")
             .eq('is_read', False)
-            .execute
+            .execute()
         )
 
         # Verificar erro de forma compatível
@@ -1067,9 +1019,7 @@ async def create_notification(
             notifications_to_create.append(notification)
 
         # Inserir notificações
-        response = await asyncio.to_thread(
-            supabase_admin.table('notifications').insert(notifications_to_create).execute
-        )
+        response = await db_admin.table('notifications').insert(notifications_to_create).execute()
 
         if hasattr(response, 'error') and response.error:
             error_msg = getattr(response.error, 'message', str(response.error))
@@ -1125,14 +1075,12 @@ async def get_all_notifications_admin(
         start_index = (page - 1) * limit
         end_index = start_index + limit - 1
 
-        query = supabase_admin.table('notifications').select('*', count='exact')
+        query = db_admin.table('notifications').select('*', count='exact')
 
         if search:
             query = query.or_(f"title.ilike.%{search}%,message.ilike.%{search}%")
 
-        response = await asyncio.to_thread(
-            query.order('created_at', desc=True).range(start_index, end_index).execute
-        )
+        response = await query.order('created_at', desc=True).range(start_index, end_index).execute()
 
         # Buscar informações dos criadores
         notifications_with_creators = []
@@ -1140,12 +1088,12 @@ async def get_all_notifications_admin(
             creator_name = None
             if notification.get('created_by'):
                 try:
-                    creator_resp = await asyncio.to_thread(
-                        supabase_admin.table('profiles')
+                    creator_resp = await (
+                        db_admin.table('profiles')
                         .select('full_name')
                         .eq('id', notification['created_by'])
                         .single()
-                        .execute
+                        .execute()
                     )
                     if creator_resp.data:
                         creator_name = creator_resp.data.get('full_name')
@@ -1180,8 +1128,8 @@ async def delete_notification_admin(
             raise HTTPException(status_code=403, detail="Apenas administradores gerais podem excluir notificações")
 
         # Deletar todas as notificações com este ID
-        response = await asyncio.to_thread(
-            lambda: supabase_admin.table('notifications')
+        response = await (
+            db_admin.table('notifications')
             .delete()
             .eq('id', notification_id)
             .execute()
@@ -1215,9 +1163,7 @@ async def trigger_collection(
     logging.info(f"🎯 SOLICITAÇÃO DE COLETA RECEBIDA - Dias: {dias_pesquisa}, Mercados: {len(request.selected_markets) if request.selected_markets else 'todos'}")
 
     if request.selected_markets:
-        resp = await asyncio.to_thread(
-            supabase.table('supermercados').select('cnpj').in_('cnpj', request.selected_markets).execute
-        )
+        resp = await db.table('supermercados').select('cnpj').in_('cnpj', request.selected_markets).execute()
         existing_markets = [market['cnpj'] for market in resp.data]
         invalid_markets = set(request.selected_markets) - set(existing_markets)
 
@@ -1230,7 +1176,9 @@ async def trigger_collection(
         ECONOMIZA_ALAGOAS_TOKEN, 
         collection_status,
         request.selected_markets,
-        dias_pesquisa
+        dias_pesquisa,
+        _ao_salvar_registros,
+        _ao_finalizar_coleta
     )
 
     market_count = len(request.selected_markets) if request.selected_markets else "todos"
@@ -1245,9 +1193,7 @@ async def get_collection_status(user: UserProfile = Depends(get_current_user)):
 # --- Gerenciamento de Supermercados ---
 @app.get("/api/supermarkets", response_model=List[Supermercado])
 async def list_supermarkets_admin(user: UserProfile = Depends(get_current_user)):
-    resp = await asyncio.to_thread(
-        supabase.table('supermercados').select('id, nome, cnpj, endereco').order('nome').execute
-    )
+    resp = await db.table('supermercados').select('id, nome, cnpj, endereco').order('nome').execute()
     return resp.data
 
 @app.post("/api/supermarkets", status_code=201, response_model=Supermercado)
@@ -1255,9 +1201,7 @@ async def create_supermarket(market: Supermercado, user: UserProfile = Depends(r
     market_data = market.dict(exclude={'id'})
     market_data = {k: v for k, v in market_data.items() if v is not None}
 
-    resp = await asyncio.to_thread(
-        supabase.table('supermercados').insert(market_data).execute
-    )
+    resp = await db.table('supermercados').insert(market_data).execute()
     return resp.data[0]
 
 @app.put("/api/supermarkets/{id}", response_model=Supermercado)
@@ -1265,66 +1209,60 @@ async def update_supermarket(id: int, market: Supermercado, user: UserProfile =
     market_data = market.dict(exclude={'id'})
     market_data = {k: v for k, v in market_data.items() if v is not None}
 
-    resp = await asyncio.to_thread(
-        supabase.table('supermercados').update(market_data).eq('id', id).execute
-    )
+    resp = await db.table('supermercados').update(market_data).eq('id', id).execute()
     if not resp.data: 
         raise HTTPException(status_code=404, detail="Mercado não encontrada")
     return resp.data[0]
 
 @app.delete("/api/supermarkets/{id}", status_code=204)
 async def delete_supermarket(id: int, user: UserProfile = Depends(require_page_access('markets'))):
-    await asyncio.to_thread(
-        lambda: supabase.table('supermercados').delete().eq('id', id).execute()
-    )
+    await db.table('supermercados').delete().eq('id', id).execute()
     return
 
 # --- Endpoint Público de Supermercados ---
 @app.get("/api/supermarkets/public", response_model=List[Supermercado])
 async def list_supermarkets_public():
-    resp = await asyncio.to_thread(
-        supabase.table('supermercados').select('id, nome, cnpj, endereco').order('nome').execute
-    )
+    resp = await db.table('supermercados').select('id, nome, cnpj, endereco').order('nome').execute()
     return resp.data
 
 # --- Gerenciamento de Dados Históricos ---
 @app.get("/api/collections")
 async def list_collections(user: UserProfile = Depends(require_page_access('collections'))):
-    response = await asyncio.to_thread(
-        supabase.table('coletas').select('*').order('iniciada_em', desc=True).execute
-    )
+    response = await db.table('coletas').select('*').order('iniciada_em', desc=True).execute()
     return response.data
 
 @app.get("/api/collections/{collection_id}/details")
 async def get_collection_details(collection_id: int, user: UserProfile = Depends(require_page_access('collections'))):
-    response = await asyncio.to_thread(
-        lambda: supabase.rpc('get_collection_details', {'p_coleta_id': collection_id}).execute()
-    )
+    response = await db.rpc('get_collection_details', {'p_coleta_id': collection_id}).execute()
     return response.data
 
+async def _recarregar_apos_exclusao():
+    """Exclusões em produtos: o snapshot é recalculado no banco (sql/004); índice e cache são refeitos a partir dele"""
+    search_cache.limpar()
+    await search_index.recarregar()
+    # Buscas servidas pelo índice antigo durante a recarga também são descartadas
+    search_cache.limpar()
+
 @app.delete("/api/collections/{collection_id}", status_code=204)
-async def delete_collection(collection_id: int, user: UserProfile = Depends(require_page_access('collections'))):
-    await asyncio.to_thread(
-        lambda: supabase.table('coletas').delete().eq('id', collection_id).execute()
-    )
+async def delete_collection(collection_id: int, background_tasks: BackgroundTasks, user: UserProfile = Depends(require_page_access('collections'))):
+    await db.table('coletas').delete().eq('id', collection_id).execute()
+    background_tasks.add_task(_recarregar_apos_exclusao)
     return
 
 @app.post("/api/prune-by-collections")
-async def prune_by_collections(request: PruneByCollectionsRequest, user: UserProfile = Depends(require_page_access('prune'))):
+async def prune_by_collections(request: PruneByCollectionsRequest, background_tasks: BackgroundTasks, user: UserProfile = Depends(require_page_access('prune'))):
     if not request.collection_ids:
         raise HTTPException(status_code=400, detail="Pelo menos uma coleta deve ser selecionada.")
-    response = await asyncio.to_thread(
-        lambda: supabase.table('produtos').delete().eq('cnpj_supermercado', request.cnpj).in_('coleta_id', request.collection_ids).execute()
-    )
+    response = await db.table('produtos').delete().eq('cnpj_supermercado', request.cnpj).in_('coleta_id', request.collection_ids).execute()
     deleted_count = len(response.data) if response.data else 0
     logging.info(f"Limpeza de dados: {deleted_count} registros apagados para o CNPJ {request.cnpj} das coletas {request.collection_ids}.")
+    if deleted_count:
+        background_tasks.add_task(_recarregar_apos_exclusao)
     return {"message": "Operação de limpeza concluída com sucesso.", "deleted_count": deleted_count}
 
 @app.get("/api/collections-by-market/{cnpj}")
 async def get_collections_by_market(cnpj: str, user: UserProfile = Depends(require_page_access('prune'))):
-    response = await asyncio.to_thread(
-        lambda: supabase.rpc('get_collections_for_market', {'market_cnpj': cnpj}).execute()
-    )
+    response = await db.rpc('get_collections_for_market', {'market_cnpj': cnpj}).execute()
     return response.data
     
 # --- LOGS DE USUÁRIOS ---
@@ -1341,7 +1279,7 @@ async def get_user_logs(
         start_index = (page - 1) * page_size
         end_index = start_index + page_size - 1
 
-        query = supabase.table('log_de_usuarios').select('*', count='exact')
+        query = db.table('log_de_usuarios').select('*', count='exact')
 
         if user_id:
             query = query.eq('user_id', user_id)
@@ -1350,9 +1288,7 @@ async def get_user_logs(
         if action_type:
             query = query.eq('action_type', action_type)
 
-        response = await asyncio.to_thread(
-            query.order('created_at', desc=True).range(start_index, end_index).execute
-        )
+        response = await query.order('created_at', desc=True).range(start_index, end_index).execute()
 
         user_logs = []
         for log in response.data:
@@ -1382,9 +1318,7 @@ async def get_user_logs(
 @app.delete("/api/user-logs/{log_id}")
 async def delete_single_log(log_id: int, user: UserProfile = Depends(require_page_access('user_logs'))):
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('log_de_usuarios').delete().eq('id', log_id).execute()
-        )
+        response = await db.table('log_de_usuarios').delete().eq('id', log_id).execute()
         deleted_count = len(response.data) if response.data else 0
         return {"message": "Log excluído com sucesso", "deleted_count": deleted_count}
     except Exception as e:
@@ -1398,16 +1332,14 @@ async def delete_user_logs(
     user: UserProfile = Depends(require_page_access('user_logs'))
 ):
     try:
-        query = supabase.table('log_de_usuarios').delete()
+        query = db.table('log_de_usuarios').delete()
 
         if user_id:
             query = query.eq('user_id', user_id)
         if date:
             query = query.gte('created_at', f'{date}T00:00:00').lte('created_at', f'{date}T23:59:59')
 
-        response = await asyncio.to_thread(
-            query.execute
-        )
+        response = await query.execute()
         deleted_count = len(response.data) if response.data else 0
         return {"message": "Logs excluídos com sucesso", "deleted_count": deleted_count}
     except Exception as e:
@@ -1425,7 +1357,7 @@ async def export_user_logs(
         import csv
         import io
 
-        query = supabase.table('log_de_usuarios').select('*')
+        query = db.table('log_de_usuarios').select('*')
 
         if user_id:
             query = query.eq('user_id', user_id)
@@ -1434,9 +1366,7 @@ async def export_user_logs(
         if action_type:
             query = query.eq('action_type', action_type)
 
-        response = await asyncio.to_thread(
-            query.order('created_at', desc=True).execute
-        )
+        response = await query.order('created_at', desc=True).execute()
 
         if not response.data:
             raise HTTPException(status_code=404, detail="Nenhum log encontrado para exportação")
@@ -1480,9 +1410,7 @@ async def delete_logs_by_date(
         raise HTTPException(status_code=400, detail="Data é obrigatória para esta operação.")
 
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('log_de_usuarios').delete().lte('created_at', request.date.isoformat()).execute()
-        )
+        response = await db.table('log_de_usuarios').delete().lte('created_at', request.date.isoformat()).execute()
         deleted_count = len(response.data) if response.data else 0
         return {"message": f"Logs até a data {request.date.isoformat()} deletados com sucesso.", "deleted_count": deleted_count}
     except Exception as e:
@@ -1512,6 +1440,54 @@ async def log_custom_action(
     background_tasks.add_task(log_custom_action_internal, request, current_user)
     return {"message": "Ação customizada registrada"}
 
+@app.post("/api/log-events")
+async def log_events_batch(
+    batch: ActivityEventBatch,
+    authorization: str = Header(None)
+):
+    """
+    Recebe vários eventos de acesso/ação de uma vez (ex.: navigator.sendBeacon ao sair da página).
+    Uma única autenticação para o lote; eventos de acesso passam pelas mesmas verificações de
+    get_current_user (acesso expirado ou inativo é rejeitado) e recebem o horário do servidor.
+    """
+    if not authorization and batch.access_token:
+        authorization = f"Bearer {batch.access_token}"
+    usuario_com_acesso = None
+    if authorization and any(event.type == 'page_access' for event in batch.events):
+        try:
+            usuario_com_acesso = await get_current_user(authorization)
+        except HTTPException as e:
+            logging.info(f"Eventos de acesso rejeitados no lote: {e.detail}")
+    current_user = usuario_com_acesso or await get_current_user_optional(authorization)
+
+    eventos = []
+    rejeitados = 0
+    for event in batch.events:
+        if event.type == 'page_access':
+            if not usuario_com_acesso:
+                rejeitados += 1
+                continue
+            # Sem created_at: o writer usa o horário do servidor, como em /api/log-page-access
+            eventos.append({
+                "user_id": usuario_com_acesso.id,
+                "action_type": "access",
+                "page_accessed": event.page
+            })
+        else:
+            if not event.action_type:
+                rejeitados += 1
+                continue
+            eventos.append({
+                "user_id": current_user.id if current_user else None,
+                "action_type": event.action_type,
+                "page_accessed": event.page,
+                "details": event.details,
+                "created_at": event.timestamp
+            })
+
+    aceitos = await activity_log_writer.registrar_lote(eventos) if eventos else 0
+    return {"aceitos": aceitos, "rejeitados": rejeitados + len(eventos) - aceitos}
+
 @app.get("/api/usage-statistics")
 async def get_usage_statistics(
     start_date: date = Query(..., description="Data de início (YYYY-MM-DD)"),
@@ -1519,8 +1495,8 @@ async def get_usage_statistics(
     user: UserProfile = Depends(require_page_access('user_logs'))
 ):
     try:
-        page_stats_response = await asyncio.to_thread(
-            lambda: supabase_admin.table('log_de_usuarios') \
+        page_stats_response = await (
+            db_admin.table('log_de_usuarios') \
                 .select('page_accessed', count='exact') \
                 .eq('action_type', 'access') \
                 .gte('created_at', str(start_date)) \
@@ -1528,16 +1504,16 @@ async def get_usage_statistics(
                 .execute()
         )
 
-        active_users_response = await asyncio.to_thread(
-            lambda: supabase_admin.table('log_de_usuarios') \
+        active_users_response = await (
+            db_admin.table('log_de_usuarios') \
                 .select('user_id', count='exact') \
                 .gte('created_at', str(start_date)) \
                 .lte('created_at', f'{end_date} 23:59:59') \
                 .execute()
         )
 
-        top_actions_response = await asyncio.to_thread(
-            lambda: supabase_admin.table('log_de_usuarios') \
+        top_actions_response = await (
+            db_admin.table('log_de_usuarios') \
                 .select('action_type', count='exact') \
                 .gte('created_at', str(start_date)) \
                 .lte('created_at', f'{end_date} 23:59:59') \
@@ -1565,9 +1541,7 @@ async def get_usage_statistics(
 async def get_products_log(page: int = 1, page_size: int = 50, user: UserProfile = Depends(require_page_access('product_log'))):
     start_index = (page - 1) * page_size
     end_index = start_index + page_size - 1
-    response = await asyncio.to_thread(
-        supabase.table('produtos').select('*', count='exact').order('created_at', desc=True).range(start_index, end_index).execute
-    )
+    response = await db.table('produtos').select('*', count='exact').order('created_at', desc=True).range(start_index, end_index).execute()
     return {"data": response.data, "total_count": response.count}
 
 # --- NOVOS ENDPOINTS PARA VERIFICAÇÃO DE STATUS DE ACESSO ---
@@ -1615,30 +1589,51 @@ async def get_user_active_groups(current_user: UserProfile = Depends(get_current
         logging.error(f"Erro ao buscar grupos ativos: {e}")
         raise HTTPException(status_code=500, detail="Erro ao buscar grupos ativos")
 
-@app.get("/api/search")
-async def search_products(
-    q: str, 
-    background_tasks: BackgroundTasks, 
-    cnpjs: Optional[List[str]] = Query(None),
-    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
-):
-    termo_busca = f"%{q.lower().strip()}%"
-    query = supabase.table('produtos').select(
-    '*, supermercados(endereco)'
-).ilike('nome_produto_normalizado', termo_busca)
-    if cnpjs: 
-        query = query.in_('cnpj_supermercado', cnpjs)
-
-    response = await asyncio.to_thread(
-        query.limit(500).execute
-    )
-
-    background_tasks.add_task(log_search, q, 'database', cnpjs, len(response.data), current_user)
+@app.get("/api/admin/cache-stats")
+async def get_cache_stats(admin_user: UserProfile = Depends(require_page_access('users'))):
+    """Estatísticas dos caches em memória (taxa de acerto, entradas, invalidações)"""
+    from dependencies import dashboard_cache, jwt_verifier
+    return {
+        "user_profile": user_profile_cache.stats(),
+        "dashboard": dashboard_cache.stats(),
+        "realtime": {**realtime_cache.stats, "entries": len(realtime_cache)},
+        "jwt_verification": jwt_verifier.stats,
+        "user_directory": user_directory.estatisticas(),
+        "access_sweeper": access_sweeper.estatisticas(),
+        "search_index": search_index.estatisticas(),
+        "search_results": search_cache.estatisticas(),
+        "search_warmer": search_cache_warmer.estatisticas(),
+        "product_clusters": product_clusters.estatisticas()
+    }
 
-    if not response.data: 
-        return {"results": []}
+@app.get("/api/admin/activity-log-stats")
+async def get_activity_log_stats(user: UserProfile = Depends(require_page_access('user_logs'))):
+    """Contadores do pipeline de logs de atividade (enfileirados, gravados, descartados, falhas)"""
+    return activity_log_writer.estatisticas()
+
+@app.get("/api/admin/db-pool-stats")
+async def get_db_pool_stats(admin_user: UserProfile = Depends(require_page_access('users'))):
+    """Uso do pool de conexões do PostgREST: em andamento, pico, requisições que esperaram por conexão"""
+    return {**database.estatisticas_pool(), "repositorio": repository.estatisticas()}
+
+@app.post("/api/admin/cache-stats/clear-user-profiles")
+async def clear_user_profile_cache(admin_user: UserProfile = Depends(require_page_access('users'))):
+    """Descarta todos os perfis de usuário em cache"""
+    invalidar_cache_usuarios()
+    return {"message": "Cache de perfis de usuário limpo"}
+
+async def _consultar_produtos_db(q: str, cnpjs: Optional[List[str]]) -> List[Dict[str, Any]]:
+    """Busca os registros de produtos armazenados que casam com o termo (índice em memória, se carregado)"""
+    if search_index.pronto:
+        return search_index.buscar(q, cnpjs)
+    return await repositorio.buscar_produtos(q.lower().strip(), cnpjs)
+
+def _processar_resultados_busca(registros: List[Dict[str, Any]], limite: int = 100, por_relevancia: bool = False) -> List[Dict[str, Any]]:
+    """Calcula o status de preço e ordena os resultados do mais barato ao mais caro (ou por relevância, se houver)"""
+    if not registros:
+        return []
 
-    df = pd.DataFrame(response.data)
+    df = pd.DataFrame(registros)
     df['preco_produto'] = pd.to_numeric(df['preco_produto'], errors='coerce')
     df.dropna(subset=['preco_produto'], inplace=True)
 
@@ -1648,9 +1643,475 @@ async def search_products(
             lambda x: 'Barato' if x < preco_medio * 0.9 else ('Caro' if x > preco_medio * 1.1 else 'Na Média')
         )
 
-    df = df.sort_values(by='preco_produto', ascending=True)
-    results = df.head(100).to_dict(orient='records')
-    return {"results": results}
+    if por_relevancia and 'relevancia' in df.columns:
+        df = df.sort_values(by=['relevancia', 'preco_produto'], ascending=[False, True])
+    else:
+        df = df.sort_values(by='preco_produto', ascending=True)
+    # Converte NaN em None para manter o JSON válido
+    df = df.astype(object).where(pd.notna(df), None)
+    return df.head(limite).to_dict(orient='records')
+
+# --- Paginação por cursor de /api/search ---
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "100"))
+SEARCH_MAX_PAGE_SIZE = 500
+SEARCH_FIELDS = {
+    'id_registro', 'nome_produto', 'nome_produto_normalizado', 'codigo_barras', 'preco_produto',
+    'unidade_medida', 'tipo_unidade', 'nome_supermercado', 'cnpj_supermercado', 'endereco_supermercado',
+    'supermercados', 'data_ultima_venda', 'data_coleta', 'status_preco', 'relevancia', 'cluster_id',
+    'quantidade_embalagem', 'unidade_base', 'preco_unitario'
+}
+_CAMPOS_PRECO_UNITARIO = {'quantidade_embalagem', 'unidade_base', 'preco_unitario'}
+# Campos calculados pela aplicação (não existem em current_prices ou, sem a migração 008, podem faltar)
+_CAMPOS_CALCULADOS = {'status_preco', 'relevancia', 'supermercados', 'cluster_id'} | _CAMPOS_PRECO_UNITARIO
+# Ordenação por preço unitário: agrupa por unidade base antes de comparar os preços
+_ORDEM_UNIDADE_BASE = {'KG': 0, 'L': 1, 'UN': 2}
+
+def _preco(registro: Dict[str, Any]) -> Optional[float]:
+    try:
+        preco = float(registro.get('preco_produto'))
+    except (TypeError, ValueError):
+        return None
+    return None if preco != preco else preco
+
+def _com_preco_unitario(registro: Dict[str, Any]) -> Dict[str, Any]:
+    """Preço por unidade base gravado na ingestão; linhas anteriores à migração 008 são anotadas na leitura"""
+    if registro.get('unidade_base') is None:
+        collector_service.anotar_precos_unitarios([registro])
+    return registro
+
+def _classificar_preco(preco: float, media: float) -> str:
+    return 'Barato' if preco < media * 0.9 else ('Caro' if preco > media * 1.1 else 'Na Média')
+
+def _chave_ordenacao(registro: Dict[str, Any], ordem: str) -> tuple:
+    """Chave total de ordenação: desempata sempre pelo id_registro para o cursor ser estável"""
+    chave = (_preco(registro), str(registro.get('id_registro') or ''))
+    if ordem == 'relevance':
+        return (-float(registro.get('relevancia') or 0),) + chave
+    if ordem == 'unit_price':
+        unitario = _com_preco_unitario(registro).get('preco_unitario')
+        return (
+            float(_ORDEM_UNIDADE_BASE.get(registro.get('unidade_base'), len(_ORDEM_UNIDADE_BASE))),
+            float(unitario) if unitario is not None else float('inf'),
+            chave[1]
+        )
+    return chave
+
+def _codificar_cursor(ordem: str, chave: tuple, media: float) -> str:
+    dados = json.dumps({'o': ordem, 'k': list(chave), 'm': media}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(dados.encode()).decode().rstrip('=')
+
+def _decodificar_cursor(cursor: str, ordem: str) -> Dict[str, Any]:
+    try:
+        dados = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        chave = dados['k']
+        if dados['o'] != ordem or len(chave) != (3 if ordem in ('relevance', 'unit_price') else 2):
+            raise ValueError("ordem do cursor difere da busca")
+        chave = tuple(float(v) for v in chave[:-1]) + (str(chave[-1]),)
+        return {'chave': chave, 'media': float(dados['m'])}
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Cursor de busca inválido: {e}")
+        raise HTTPException(status_code=400, detail="Cursor inválido ou expirado. Refaça a busca.")
+
+def _validar_campos(fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    campos = list(dict.fromkeys(c.strip() for c in fields.split(',') if c.strip()))
+    invalidos = [c for c in campos if c not in SEARCH_FIELDS]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"Campos inválidos: {', '.join(invalidos)}")
+    return campos
+
+def _montar_pagina(registros: List[Dict[str, Any]], media: float, campos: Optional[List[str]]) -> List[Dict[str, Any]]:
+    """Anota o status de preço (relativo à média da busca toda) e o cluster dos produtos sem GTIN, e aplica a seleção de campos"""
+    pagina = [
+        {
+            **_com_preco_unitario(registro),
+            'status_preco': _classificar_preco(_preco(registro), media),
+            'cluster_id': None if registro.get('codigo_barras') else product_clusters.cluster_de(registro.get('nome_produto_normalizado'))
+        }
+        for registro in registros
+    ]
+    if campos:
+        pagina = [{campo: registro.get(campo) for campo in campos} for registro in pagina]
+    return pagina
+
+def _ordenados(entrada: Dict[str, Any], ordem: str):
+    """Chaves e registros na ordem pedida, calculados uma vez por entrada do cache"""
+    if ordem not in entrada['ordens']:
+        registros = sorted(entrada['registros'], key=lambda r: _chave_ordenacao(r, ordem))
+        entrada['ordens'][ordem] = ([_chave_ordenacao(r, ordem) for r in registros], registros)
+    return entrada['ordens'][ordem]
+
+async def _buscar_processado(q: str, cnpjs: Optional[List[str]], aproximada: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Todos os resultados da busca no índice em memória, já ordenados pela ordem padrão (preço), guardados no
+    cache para servir as páginas por bisseção (também usado pelo aquecimento). None sem o índice.
+    A busca exata sem resultados recai na aproximada (erros de digitação).
+    """
+    if not search_index.pronto:
+        return None
+    registros = [] if aproximada else search_index.buscar(q, cnpjs)
+    usou_aproximada = aproximada or not registros
+    if usou_aproximada:
+        registros = search_index.buscar_aproximado(q, cnpjs)
+    registros = [r for r in registros if _preco(r) is not None]
+    resultado = {
+        'total_registros': len(registros),
+        'media': sum(_preco(r) for r in registros) / len(registros) if registros else 0.0,
+        'registros': registros,
+        'aproximada': usou_aproximada and bool(registros),
+        'ordens': {}
+    }
+    _ordenados(resultado, 'price')
+    search_cache.guardar(q, cnpjs, resultado, 'aproximada' if aproximada else 'exata')
+    return resultado
+
+# Depois de cada coleta, recalcula as buscas mais frequentes dos logs para o cache começar quente
+search_cache_warmer = SearchCacheWarmer(db_admin, _buscar_processado, search_index.atualizar_popularidade)
+
+@app.get("/api/search/suggest")
+async def suggest_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(SUGGEST_LIMITE, ge=1, le=SUGGEST_LIMITE)
+):
+    """Sugestões de autocompletar por prefixo (nomes de produtos e termos mais buscados), em memória"""
+    if search_index.sugestoes is None:
+        return {"suggestions": []}
+    return {"suggestions": search_index.sugerir(q, limit)}
+
+async def _pagina_do_banco(q: str, cnpjs: Optional[List[str]], cursor: Optional[str], limit: int, campos: Optional[List[str]]) -> Dict[str, Any]:
+    """Sem o índice: página ordenada por preço direto do banco (keyset), média fixada na primeira página"""
+    apos = _decodificar_cursor(cursor, 'price') if cursor else None
+    colunas = None
+    if campos:
+        colunas = {c for c in campos if c not in _CAMPOS_CALCULADOS} | {'preco_produto', 'id_registro'}
+        if 'supermercados' in campos:
+            colunas.add('endereco_mercado')
+        if _CAMPOS_PRECO_UNITARIO & set(campos):
+            # Calculados a partir da descrição quando a linha ainda não os tem
+            colunas |= {'nome_produto', 'unidade_medida'}
+        colunas = sorted(colunas)
+    linhas = await repositorio.buscar_produtos_pagina(
+        q.lower().strip(), cnpjs, apos['chave'] if apos else None, limit + 1, colunas
+    )
+    linhas = [linha for linha in linhas if _preco(linha) is not None]
+    pagina, restantes = linhas[:limit], len(linhas) > limit
+    media = apos['media'] if apos else (sum(_preco(r) for r in pagina) / len(pagina) if pagina else 0.0)
+    return {
+        'results': _montar_pagina(pagina, media, campos),
+        'next_cursor': _codificar_cursor('price', _chave_ordenacao(pagina[-1], 'price'), media) if restantes else None,
+        'sort': 'price',
+        'total': None,
+        'fuzzy': False
+    }
+
+@app.get("/api/search")
+async def search_products(
+    q: str,
+    background_tasks: BackgroundTasks,
+    cnpjs: Optional[List[str]] = Query(None),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="Valor de next_cursor da página anterior."),
+    # Padrão por preço, como antes da paginação: relevância e preço unitário são opcionais
+    sort: str = Query('price', pattern="^(relevance|price|unit_price)$"),
+    fields: Optional[str] = Query(None, description="Campos do resultado, separados por vírgula."),
+    fuzzy: bool = Query(False, description="Busca aproximada, tolerante a erros de digitação."),
+    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
+):
+    """
+    Busca nos preços atuais com paginação por cursor (keyset). Ordenação por preço (padrão), por relevância ou
+    por preço unitário (KG, L, UN), sempre desempatada pelo id_registro; `fields` limita os campos devolvidos. Sem resultados exatos
+    (ou com fuzzy=true) a busca usa a similaridade de n-gramas e a resposta traz fuzzy=true.
+    """
+    campos = _validar_campos(fields)
+
+    modo = 'aproximada' if fuzzy else 'exata'
+    em_cache = search_cache.obter(q, cnpjs, modo) or await _buscar_processado(q, cnpjs, fuzzy)
+    if em_cache is None:
+        # Índice ainda carregando (ou desabilitado): pagina no banco, ordenado por preço
+        resposta = await _pagina_do_banco(q, cnpjs, cursor, limit, campos)
+    else:
+        apos = _decodificar_cursor(cursor, sort) if cursor else None
+        media = apos['media'] if apos else em_cache['media']
+        chaves, registros = _ordenados(em_cache, sort)
+        inicio = bisect.bisect_right(chaves, apos['chave']) if apos else 0
+        pagina = registros[inicio:inicio + limit]
+        resposta = {
+            'results': _montar_pagina(pagina, media, campos),
+            'next_cursor': _codificar_cursor(sort, chaves[inicio + limit - 1], media) if inicio + limit < len(registros) else None,
+            'sort': sort,
+            'total': em_cache['total_registros'],
+            'fuzzy': em_cache['aproximada']
+        }
+
+    # Só a primeira página conta como busca nos logs
+    if not cursor:
+        total = resposta['total'] if resposta['total'] is not None else len(resposta['results'])
+        background_tasks.add_task(log_search, q, 'database', cnpjs, total, current_user)
+
+    return resposta
+
+# --------------------------------------------------------------------------
+# --- BUSCA HÍBRIDA (STALE-WHILE-REVALIDATE) ---
+# --------------------------------------------------------------------------
+
+HYBRID_FRESHNESS_HOURS = float(os.getenv("HYBRID_FRESHNESS_HOURS", "24"))
+HYBRID_MAX_REFRESH_MARKETS = int(os.getenv("HYBRID_MAX_REFRESH_MARKETS", "10"))
+HYBRID_JOB_TTL_SECONDS = 15 * 60
+
+# Atualizações em tempo real disparadas pela busca híbrida, por refresh_id
+hybrid_refresh_jobs: Dict[str, Dict[str, Any]] = {}
+# Consultas em tempo real em andamento por (termo, cnpj), para não repetir a mesma consulta
+_hybrid_inflight: Dict[tuple, asyncio.Task] = {}
+
+def _idade_em_horas(valor: Any) -> Optional[float]:
+    """Retorna há quantas horas o registro foi coletado (None se a data for inválida)"""
+    if not valor:
+        return None
+    try:
+        coletado_em = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if coletado_em.tzinfo is not None:
+        agora = datetime.now(coletado_em.tzinfo)
+    else:
+        agora = datetime.now()
+    return max((agora - coletado_em).total_seconds() / 3600, 0.0)
+
+def _avaliar_frescor(registros: List[Dict[str, Any]], cnpjs: Optional[List[str]], max_age_hours: float) -> Dict[str, Dict[str, Any]]:
+    """Calcula, por mercado, a idade do registro mais recente e se ele está desatualizado"""
+    mais_recente: Dict[str, Optional[float]] = {cnpj: None for cnpj in (cnpjs or [])}
+    for registro in registros:
+        cnpj = registro.get('cnpj_supermercado')
+        idade = _idade_em_horas(registro.get('data_coleta'))
+        registro['idade_horas'] = round(idade, 1) if idade is not None else None
+        if idade is None:
+            mais_recente.setdefault(cnpj, None)
+            continue
+        atual = mais_recente.get(cnpj)
+        if atual is None or idade < atual:
+            mais_recente[cnpj] = idade
+
+    frescor = {}
+    for cnpj, idade in mais_recente.items():
+        if idade is None:
+            status = 'missing'
+        else:
+            status = 'stale' if idade > max_age_hours else 'fresh'
+        frescor[cnpj] = {
+            'idade_horas': round(idade, 1) if idade is not None else None,
+            'status': status
+        }
+    return frescor
+
+def _limpar_hybrid_jobs():
+    """Remove atualizações híbridas antigas da memória"""
+    limite = time.time() - HYBRID_JOB_TTL_SECONDS
+    for refresh_id in [rid for rid, job in hybrid_refresh_jobs.items() if job['criado_em'] < limite]:
+        hybrid_refresh_jobs.pop(refresh_id, None)
+
+async def _consultar_realtime_compartilhado(termo: str, mercado: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Consulta em tempo real reaproveitando uma consulta idêntica que já esteja em andamento"""
+    chave = (termo.lower().strip(), mercado['cnpj'])
+    tarefa = _hybrid_inflight.get(chave)
+    if tarefa is None or tarefa.done():
+        tarefa = asyncio.create_task(
+            collector_service.consultar_produto_realtime(
+                termo, mercado, datetime.now().isoformat(), ECONOMIZA_ALAGOAS_TOKEN, -1
+            )
+        )
+        _hybrid_inflight[chave] = tarefa
+        tarefa.add_done_callback(lambda _t, chave=chave: _hybrid_inflight.pop(chave, None))
+    resultados = await asyncio.shield(tarefa)
+    realtime_cache.guardar(termo, mercado['cnpj'], resultados)
+    return resultados
+
+async def _executar_refresh_hibrido(refresh_id: str, termo: str, mercados: List[Dict[str, str]]):
+    """Atualiza em segundo plano os mercados desatualizados e mescla com os dados do banco"""
+    job = hybrid_refresh_jobs[refresh_id]
+
+    async def atualizar_mercado(mercado: Dict[str, str]):
+        cnpj = mercado['cnpj']
+        try:
+            resultados = await _consultar_realtime_compartilhado(termo, mercado)
+            registrar_resultados_realtime(resultados)
+            for registro in resultados:
+                registro['idade_horas'] = 0.0
+                registro['origem'] = 'realtime'
+            job['fresh_by_market'][cnpj] = resultados
+            job['markets'][cnpj] = 'done'
+        except Exception as e:
+            logging.error(f"Falha na atualização híbrida de '{termo}' no CNPJ {cnpj}: {e}")
+            job['markets'][cnpj] = 'failed'
+
+    await asyncio.gather(*(atualizar_mercado(m) for m in mercados))
+
+    atualizados = set(job['fresh_by_market'].keys())
+    mesclados = [r for r in job['db_results'] if r.get('cnpj_supermercado') not in atualizados]
+    for resultados in job['fresh_by_market'].values():
+        mesclados.extend(resultados)
+
+    job['results'] = _processar_resultados_busca(mesclados)
+    job['status'] = 'COMPLETED'
+    job['finalizado_em'] = datetime.now().isoformat()
+    logging.info(f"Busca híbrida {refresh_id}: {len(atualizados)}/{len(mercados)} mercados atualizados para '{termo}'")
+
+@app.get("/api/product-clusters/{cluster_id}")
+async def get_product_cluster(
+    cluster_id: int,
+    cnpjs: Optional[List[str]] = Query(None),
+    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
+):
+    """Descrições equivalentes de um produto sem GTIN e o preço atual de cada uma, para comparação entre mercados"""
+    if not product_clusters.pronto:
+        raise HTTPException(status_code=503, detail="Agrupamento de produtos ainda não está disponível.")
+    nomes = product_clusters.membros(cluster_id)
+    if not nomes:
+        raise HTTPException(status_code=404, detail="Cluster de produtos não encontrado.")
+    registros = [r for r in await repositorio.precos_atuais_por_nomes(nomes, cnpjs) if _preco(r) is not None]
+    return {
+        'cluster_id': cluster_id,
+        'nomes': nomes,
+        'results': sorted(registros, key=lambda r: _chave_ordenacao(r, 'unit_price'))
+    }
+
+# --- Leitor de código de barras: GTIN -> preço atual por mercado ---
+def _gtin_valido(codigo: str) -> bool:
+    codigo = codigo.strip()
+    return codigo.isdigit() and 8 <= len(codigo) <= 14
+
+async def _precos_por_gtin(gtins: List[str], cnpjs: Optional[List[str]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Índice em memória quando pronto; senão uma única consulta ao snapshot com as grafias usuais de cada código"""
+    if search_index.pronto:
+        return search_index.buscar_gtins(gtins, cnpjs)
+    grafias = {
+        variante
+        for gtin in gtins
+        for variante in (gtin, normalizar_gtin(gtin), normalizar_gtin(gtin).zfill(13), normalizar_gtin(gtin).zfill(14))
+    }
+    registros = await repositorio.precos_atuais_por_codigos(sorted(grafias), cnpjs)
+    # Mais recentes primeiro: cada mercado fica com uma linha por GTIN, qualquer que seja a grafia gravada
+    registros.sort(key=lambda r: (str(r.get('data_ultima_venda') or ''), str(r.get('data_coleta') or '')), reverse=True)
+    por_gtin: Dict[str, Dict[str, Dict[str, Any]]] = {normalizar_gtin(gtin): {} for gtin in gtins}
+    for registro in registros:
+        encontrados = por_gtin.get(normalizar_gtin(registro.get('codigo_barras')))
+        if encontrados is not None:
+            encontrados.setdefault(registro.get('cnpj_supermercado') or '', registro)
+    return {
+        gtin: sorted(por_gtin[normalizar_gtin(gtin)].values(), key=lambda r: _preco(r) or 0)
+        for gtin in gtins
+    }
+
+def _resumo_gtin(gtin: str, registros: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Preços do GTIN do mais barato ao mais caro, com o status relativo à média entre os mercados"""
+    registros = [r for r in registros if _preco(r) is not None]
+    media = sum(_preco(r) for r in registros) / len(registros) if registros else 0.0
+    resultados = [
+        {**_com_preco_unitario(registro), 'status_preco': _classificar_preco(_preco(registro), media)}
+        for registro in registros
+    ]
+    mais_barato = resultados[0] if resultados else None
+    return {
+        'gtin': gtin,
+        'encontrado': bool(resultados),
+        'nome_produto': mais_barato.get('nome_produto') if mais_barato else None,
+        'menor_preco': _preco(mais_barato) if mais_barato else None,
+        'mercado_mais_barato': mais_barato.get('nome_supermercado') if mais_barato else None,
+        'preco_medio': round(media, 2) if resultados else None,
+        'results': resultados
+    }
+
+@app.get("/api/barcode/{gtin}")
+async def get_barcode_prices(
+    gtin: str,
+    cnpjs: Optional[List[str]] = Query(None),
+    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
+):
+    """Preço atual de um código de barras em cada mercado, servido pelo índice em memória"""
+    gtin = gtin.strip()
+    if not _gtin_valido(gtin):
+        raise HTTPException(status_code=400, detail="Código de barras inválido. Informe de 8 a 14 dígitos.")
+    precos = await _precos_por_gtin([gtin], cnpjs)
+    return _resumo_gtin(gtin, precos[gtin])
+
+@app.post("/api/barcode/batch")
+async def get_barcode_prices_batch(
+    request: BarcodeBatchRequest,
+    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
+):
+    """Vários códigos de uma vez (lista de compras lida no leitor); códigos malformados voltam em `invalidos`"""
+    codigos = list(dict.fromkeys(codigo.strip() for codigo in request.gtins))
+    validos = [codigo for codigo in codigos if _gtin_valido(codigo)]
+    precos = await _precos_por_gtin(validos, request.cnpjs) if validos else {}
+    return {
+        'results': [_resumo_gtin(gtin, precos[gtin]) for gtin in validos],
+        'invalidos': [codigo for codigo in codigos if not _gtin_valido(codigo)]
+    }
+
+@app.get("/api/search/hybrid")
+async def hybrid_search(
+    q: str,
+    background_tasks: BackgroundTasks,
+    cnpjs: Optional[List[str]] = Query(None),
+    max_age_hours: float = Query(HYBRID_FRESHNESS_HOURS, gt=0, le=24 * 30),
+    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
+):
+    """Retorna os preços armazenados imediatamente e atualiza em tempo real apenas os mercados desatualizados"""
+    registros = await _consultar_produtos_db(q, cnpjs)
+    frescor = _avaliar_frescor(registros, cnpjs, max_age_hours)
+
+    background_tasks.add_task(log_search, q, 'database', cnpjs, len(registros), current_user)
+
+    desatualizados = [cnpj for cnpj, info in frescor.items() if cnpj and info['status'] != 'fresh']
+    desatualizados = desatualizados[:HYBRID_MAX_REFRESH_MARKETS]
+
+    refresh_id = None
+    if desatualizados:
+        resp = await db.table('supermercados').select('cnpj, nome').in_('cnpj', desatualizados).execute()
+        mercados_map = {m['cnpj']: m['nome'] for m in resp.data}
+        mercados = [{"cnpj": cnpj, "nome": mercados_map.get(cnpj, cnpj)} for cnpj in desatualizados]
+
+        _limpar_hybrid_jobs()
+        refresh_id = str(uuid.uuid4())
+        hybrid_refresh_jobs[refresh_id] = {
+            'status': 'RUNNING',
+            'termo': q,
+            'criado_em': time.time(),
+            'finalizado_em': None,
+            'markets': {cnpj: 'pending' for cnpj in desatualizados},
+            'db_results': registros,
+            'fresh_by_market': {},
+            'results': None
+        }
+        hybrid_refresh_jobs[refresh_id]['task'] = asyncio.create_task(
+            _executar_refresh_hibrido(refresh_id, q, mercados)
+        )
+
+    return {
+        "results": _processar_resultados_busca(registros),
+        "freshness": frescor,
+        "max_age_hours": max_age_hours,
+        "refreshing": desatualizados,
+        "refresh_id": refresh_id
+    }
+
+@app.get("/api/search/hybrid/{refresh_id}")
+async def hybrid_search_refresh_status(
+    refresh_id: str,
+    current_user: Optional[UserProfile] = Depends(get_current_user_optional)
+):
+    """Consulta o andamento da atualização híbrida e, quando concluída, os resultados mesclados"""
+    job = hybrid_refresh_jobs.get(refresh_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Atualização não encontrada ou expirada.")
+
+    return {
+        "refresh_id": refresh_id,
+        "status": job['status'],
+        "markets": job['markets'],
+        "finished_at": job['finalizado_em'],
+        "results": job['results']
+    }
 
 @app.post("/api/realtime-search")
 async def realtime_search(
@@ -1662,9 +2123,7 @@ async def realtime_search(
         raise HTTPException(status_code=400, detail="Pelo menos um CNPJ deve ser fornecido.")
 
     # ✅ MANTIDO SEM ENDEREÇO (busca em tempo real)
-    resp = await asyncio.to_thread(
-        supabase.table('supermercados').select('cnpj, nome').in_('cnpj', request.cnpjs).execute
-    )
+    resp = await db.table('supermercados').select('cnpj, nome').in_('cnpj', request.cnpjs).execute()
     mercados_map = {m['cnpj']: m['nome'] for m in resp.data}  # ✅ Apenas nome, sem endereço
 
     tasks = [
@@ -1685,8 +2144,10 @@ async def realtime_search(
             cnpj_com_erro = request.cnpjs[i]
             logging.error(f"Falha na busca em tempo real para o CNPJ {cnpj_com_erro}: {resultado}")
         elif resultado:
+            realtime_cache.guardar(request.produto, request.cnpjs[i], resultado)
             resultados_finais.extend(resultado)
 
+    registrar_resultados_realtime(resultados_finais)
     background_tasks.add_task(log_search, request.produto, 'realtime', request.cnpjs, len(resultados_finais), current_user)
 
     return {"results": sorted(resultados_finais, key=lambda x: x.get('preco_produto', float('inf')))}
@@ -1698,21 +2159,14 @@ async def get_price_history(request: PriceHistoryRequest, user: UserProfile = De
     if (request.end_date - request.start_date).days > 30: 
         raise HTTPException(status_code=400, detail="O período não pode exceder 30 dias.")
 
-    query = supabase.table('produtos').select('nome_supermercado, preco_produto, data_ultima_venda').in_('cnpj_supermercado', request.cnpjs).gte('data_ultima_venda', str(request.start_date)).lte('data_ultima_venda', str(request.end_date))
+    por_codigo = request.product_identifier.isdigit() and len(request.product_identifier) > 7
+    identificador = request.product_identifier if por_codigo else request.product_identifier.lower()
+    registros = await repositorio.historico_precos(identificador, por_codigo, request.cnpjs, request.start_date, request.end_date)
 
-    if request.product_identifier.isdigit() and len(request.product_identifier) > 7:
-        query = query.eq('codigo_barras', request.product_identifier)
-    else:
-        query = query.like('nome_produto_normalizado', f"%{request.product_identifier.lower()}%")
-
-    response = await asyncio.to_thread(
-        query.execute
-    )
-
-    if not response.data: 
+    if not registros: 
         return {}
 
-    df = pd.DataFrame(response.data)
+    df = pd.DataFrame(registros)
     df['preco_produto'] = pd.to_numeric(df['preco_produto'], errors='coerce')
     df.dropna(subset=['preco_produto', 'data_ultima_venda'], inplace=True)
     df['data_ultima_venda'] = pd.to_datetime(df['data_ultima_venda']).dt.date
@@ -1736,15 +2190,7 @@ async def get_price_history(request: PriceHistoryRequest, user: UserProfile = De
 async def get_available_dates(user: UserProfile = Depends(get_current_user)):
     """Obtém as datas disponíveis para análise baseadas nas coletas"""
     try:
-        response = await asyncio.to_thread(
-            supabase.table('coletas')
-            .select('iniciada_em')
-            .order('iniciada_em', desc=True)
-            .execute
-        )
-
-        dates = list(set([collection['iniciada_em'][:10] for collection in response.data]))
-        return sorted(dates)
+        return await repositorio.datas_de_coleta()
 
     except Exception as e:
         logging.error(f"Erro ao buscar datas disponíveis: {e}")
@@ -1758,7 +2204,7 @@ async def price_analysis(
     """Realiza análise de preços para gráficos"""
     try:
         # Buscar dados do produto no período
-        query = supabase.table('produtos').select('*')
+        query = db.table('produtos').select('*')
 
         # Aplicar filtros
         if request.product_identifier.isdigit() and len(request.product_identifier) > 7:
@@ -1770,7 +2216,7 @@ async def price_analysis(
         query = query.gte('data_ultima_venda', request.start_date)
         query = query.lte('data_ultima_venda', request.end_date)
 
-        response = await asyncio.to_thread(query.execute)
+        response = await query.execute()
 
         if not response.data:
             return PriceAnalysisResponse(bar_chart_data=[], line_chart_data=[])
@@ -1791,10 +2237,14 @@ async def price_analysis(
         raise HTTPException(status_code=500, detail="Erro ao processar análise")
 
 async def process_bar_chart_data(products_data):
-    """Processa dados para gráfico de barras (preço médio por mercado)"""
+    """Processa dados para gráfico de barras (preço médio e preço médio por unidade base, por mercado)"""
     try:
         # Agrupar por mercado
         market_prices = {}
+        market_unit_prices = {}
+        # Embalagens de tamanhos diferentes só se comparam pelo preço por unidade da base mais comum
+        bases = Counter(_com_preco_unitario(product).get('unidade_base') for product in products_data)
+        base = bases.most_common(1)[0][0] if bases else None
 
         for product in products_data:
             market_name = product['nome_supermercado']
@@ -1804,15 +2254,20 @@ async def process_bar_chart_data(products_data):
                 if market_name not in market_prices:
                     market_prices[market_name] = []
                 market_prices[market_name].append(price)
+                if product.get('unidade_base') == base and product.get('preco_unitario') is not None:
+                    market_unit_prices.setdefault(market_name, []).append(float(product['preco_unitario']))
 
         # Calcular média por mercado
         bar_data = []
         for market, prices in market_prices.items():
             if prices:
                 avg_price = sum(prices) / len(prices)
+                unit_prices = market_unit_prices.get(market)
                 bar_data.append({
                     'market': market,
-                    'average_price': round(avg_price, 2)
+                    'average_price': round(avg_price, 2),
+                    'average_unit_price': round(sum(unit_prices) / len(unit_prices), 2) if unit_prices else None,
+                    'unit': base
                 })
 
         return bar_data
@@ -1825,11 +2280,11 @@ async def process_line_chart_data(products_data, cnpjs):
     """Processa dados para gráfico de linha (evolução temporal)"""
     try:
         # Buscar nomes dos mercados
-        markets_response = await asyncio.to_thread(
-            supabase.table('supermercados')
+        markets_response = await (
+            db.table('supermercados')
             .select('cnpj, nome')
             .in_('cnpj', cnpjs)
-            .execute
+            .execute()
         )
 
         market_names = {m['cnpj']: m['nome'] for m in markets_response.data}
@@ -1920,9 +2375,7 @@ async def create_basket(
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
     try:
-        count_response = await asyncio.to_thread(
-            supabase_admin.table('cestas_basicas').select('id', count='exact').eq('user_id', current_user.id).execute
-        )
+        count_response = await db_admin.table('cestas_basicas').select('id', count='exact').eq('user_id', current_user.id).execute()
         current_baskets_count = count_response.count if count_response.count is not None else 0
 
         if current_baskets_count >= BASKET_LIMIT_PER_USER:
@@ -1934,9 +2387,7 @@ async def create_basket(
             'produtos': [item.dict() for item in basket_data.produtos]
         }
 
-        resp = await asyncio.to_thread(
-            supabase_admin.table('cestas_basicas').insert(new_basket).execute
-        )
+        resp = await db_admin.table('cestas_basicas').insert(new_basket).execute()
 
         if not resp.data:
             raise HTTPException(status_code=500, detail="Nenhum dado retornado ao criar cesta")
@@ -1954,7 +2405,7 @@ async def list_baskets(
     current_user: UserProfile = Depends(require_page_access('baskets')),
     user_id: Optional[str] = Query(None)
 ):
-    query = supabase_admin.table('cestas_basicas').select('*').order('id', desc=False)
+    query = db_admin.table('cestas_basicas').select('*').order('id', desc=False)
 
     if current_user.role == 'admin':
         if user_id:
@@ -1962,7 +2413,7 @@ async def list_baskets(
     else:
         query = query.eq('user_id', current_user.id)
 
-    resp = await asyncio.to_thread(query.execute)
+    resp = await query.execute()
 
     return [Cesta(**data) for data in resp.data]
 
@@ -1972,11 +2423,11 @@ async def update_basket_name(
     basket_data: CestaUpdate,
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').update(basket_data.dict(exclude_none=True))
+    resp = await (
+        db_admin.table('cestas_basicas').update(basket_data.dict(exclude_none=True))
                  .eq('id', basket_id)
                  .eq('user_id', current_user.id)
-                 .execute
+                 .execute()
     )
 
     if not resp.data:
@@ -1990,9 +2441,7 @@ async def add_product_to_basket(
     product: CestaItem,
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    basket_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').select('user_id, produtos').eq('id', basket_id).single().execute
-    )
+    basket_resp = await db_admin.table('cestas_basicas').select('user_id, produtos').eq('id', basket_id).single().execute()
 
     basket_data = basket_resp.data
     if not basket_data or basket_data['user_id'] != current_user.id:
@@ -2005,9 +2454,7 @@ async def add_product_to_basket(
 
     new_product_list = current_products + [product.dict()]
 
-    update_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').update({'produtos': new_product_list}).eq('id', basket_id).execute
-    )
+    update_resp = await db_admin.table('cestas_basicas').update({'produtos': new_product_list}).eq('id', basket_id).execute()
     return update_resp.data[0]
 
 @app.put("/api/baskets/{basket_id}/products/{product_index}", response_model=Cesta)
@@ -2017,9 +2464,7 @@ async def edit_product_in_basket(
     product_update: CestaUpdateItem,
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    basket_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').select('user_id, produtos').eq('id', basket_id).single().execute
-    )
+    basket_resp = await db_admin.table('cestas_basicas').select('user_id, produtos').eq('id', basket_id).single().execute()
 
     basket_data = basket_resp.data
     if not basket_data or basket_data['user_id'] != current_user.id:
@@ -2039,9 +2484,7 @@ async def edit_product_in_basket(
 
     current_products[product_index] = product_to_update
 
-    update_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').update({'produtos': current_products}).eq('id', basket_id).execute
-    )
+    update_resp = await db_admin.table('cestas_basicas').update({'produtos': current_products}).eq('id', basket_id).execute()
     return update_resp.data[0]
 
 @app.delete("/api/baskets/{basket_id}/products/{product_index}", response_model=Cesta)
@@ -2050,9 +2493,7 @@ async def remove_product_from_basket(
     product_index: int,
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    basket_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').select('user_id, produtos').eq('id', basket_id).single().execute
-    )
+    basket_resp = await db_admin.table('cestas_basicas').select('user_id, produtos').eq('id', basket_id).single().execute()
 
     basket_data = basket_resp.data
     if not basket_data or basket_data['user_id'] != current_user.id:
@@ -2067,9 +2508,7 @@ async def remove_product_from_basket(
         item for i, item in enumerate(current_products) if i != product_index
     ]
 
-    update_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').update({'produtos': new_product_list}).eq('id', basket_id).execute
-    )
+    update_resp = await db_admin.table('cestas_basicas').update({'produtos': new_product_list}).eq('id', basket_id).execute()
     return update_resp.data[0]
 
 @app.delete("/api/baskets/{basket_id}/products", response_model=Cesta)
@@ -2077,16 +2516,12 @@ async def clear_basket_products(
     basket_id: int,
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    basket_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').select('user_id').eq('id', basket_id).single().execute
-    )
+    basket_resp = await db_admin.table('cestas_basicas').select('user_id').eq('id', basket_id).single().execute()
 
     if not basket_resp.data or basket_resp.data['user_id'] != current_user.id:
         raise HTTPException(status_code=404, detail="Cesta não encontrada ou você não tem permissão.")
 
-    update_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').update({'produtos': []}).eq('id', basket_id).execute
-    )
+    update_resp = await db_admin.table('cestas_basicas').update({'produtos': []}).eq('id', basket_id).execute()
     return update_resp.data[0]
 
 @app.delete("/api/baskets/{basket_id}", status_code=204)
@@ -2094,8 +2529,8 @@ async def delete_basket(
     basket_id: int,
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    resp = await asyncio.to_thread(
-        lambda: supabase_admin.table('cestas_basicas').delete()
+    resp = await (
+        db_admin.table('cestas_basicas').delete()
                         .eq('id', basket_id)
                         .eq('user_id', current_user.id)
                         .execute()
@@ -2104,6 +2539,34 @@ async def delete_basket(
         raise HTTPException(status_code=404, detail="Cesta não encontrada ou você não tem permissão para excluir.")
     return
 
+async def _carregar_cesta_para_precificacao(basket_id: int, cnpjs: List[str], current_user: UserProfile):
+    """Carrega a cesta (validando o dono) e os mercados selecionados para a busca em tempo real"""
+    basket_resp = await db_admin.table('cestas_basicas').select('user_id, nome, produtos').eq('id', basket_id).single().execute()
+
+    basket_data = basket_resp.data
+    if not basket_data or (basket_data['user_id'] != current_user.id and current_user.role != 'admin'):
+        raise HTTPException(status_code=404, detail="Cesta não encontrada ou você não tem permissão.")
+
+    resp_markets = await db.table('supermercados').select('cnpj, nome').in_('cnpj', cnpjs).execute()
+    mercados_map = {m['cnpj']: m['nome'] for m in resp_markets.data}
+    mercados = [{"cnpj": cnpj, "nome": mercados_map.get(cnpj, cnpj)} for cnpj in dict.fromkeys(cnpjs)]
+
+    produtos = [p['nome_produto'] for p in (basket_data['produtos'] or []) if p.get('nome_produto')]
+    return basket_data, produtos, mercados
+
+def _planejar_cesta(produtos: List[str], mercados: List[Dict[str, str]]):
+    return collector_service.planejar_cesta_realtime(
+        produtos,
+        mercados,
+        ECONOMIZA_ALAGOAS_TOKEN,
+        cache=realtime_cache,
+        concorrencia=BASKET_REALTIME_CONCURRENCY,
+        ao_consultar=registrar_resultados_realtime
+    )
+
+def _ordenar_resultados_cesta(resultados: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return sorted(resultados, key=lambda x: (x.get('nome_produto_normalizado', ''), x.get('preco_produto', float('inf'))))
+
 @app.post("/api/baskets/{basket_id}/realtime-prices")
 async def get_basket_realtime_prices(
     basket_id: int,
@@ -2111,56 +2574,80 @@ async def get_basket_realtime_prices(
     background_tasks: BackgroundTasks = BackgroundTasks(),
     current_user: UserProfile = Depends(require_page_access('baskets'))
 ):
-    basket_resp = await asyncio.to_thread(
-        supabase_admin.table('cestas_basicas').select('user_id, nome, produtos').eq('id', basket_id).single().execute
-    )
-
-    basket_data = basket_resp.data
-    if not basket_data or (basket_data['user_id'] != current_user.id and current_user.role != 'admin'):
-        raise HTTPException(status_code=404, detail="Cesta não encontrada ou você não tem permissão.")
+    basket_data, produtos, mercados = await _carregar_cesta_para_precificacao(basket_id, cnpjs, current_user)
 
-    products_to_search = basket_data['produtos'] or []
-    if not products_to_search:
+    if not basket_data['produtos']:
         return {"results": [], "message": "Nenhum produto na cesta para buscar."}
+    if not produtos:
+        return {"results": [], "message": "Nenhum produto válido encontrado para busca."}
 
-    resp_markets = await asyncio.to_thread(
-        supabase.table('supermercados').select('cnpj, nome').in_('cnpj', cnpjs).execute
-    )
-    mercados_map = {m['cnpj']: m['nome'] for m in resp_markets.data}
+    resultados_finais = []
+    async for evento in _planejar_cesta(produtos, mercados):
+        resultados_finais.extend(evento['resultados'])
 
-    all_tasks = []
+    basket_name = basket_data.get('nome', f"Cesta #{basket_id}")
+    background_tasks.add_task(log_search, f"[Cesta: {basket_name}]", 'realtime', cnpjs, len(resultados_finais), current_user)
 
-    for product in products_to_search:
-        if not product.get('nome_produto'):
-            continue 
+    return {"results": _ordenar_resultados_cesta(resultados_finais)}
 
-        product_tasks = [
-            collector_service.consultar_produto_realtime(
-                product['nome_produto'], 
-                {"cnpj": cnpj, "nome": mercados_map.get(cnpj, cnpj)}, 
-                datetime.now().isoformat(), 
-                ECONOMIZA_ALAGOAS_TOKEN, 
-                -1 
-            ) for cnpj in cnpjs
-        ]
-        all_tasks.extend(product_tasks)
-
-    if not all_tasks:
-        return {"results": [], "message": "Nenhum produto válido encontrado para busca."}
+@app.post("/api/baskets/{basket_id}/realtime-prices/stream")
+async def stream_basket_realtime_prices(
+    basket_id: int,
+    cnpjs: List[str] = Query(..., description="Lista de CNPJs dos mercados para pesquisa."),
+    current_user: UserProfile = Depends(require_page_access('baskets'))
+):
+    """Precifica a cesta em tempo real enviando o resultado de cada produto assim que fica pronto (NDJSON)"""
+    basket_data, produtos, mercados = await _carregar_cesta_para_precificacao(basket_id, cnpjs, current_user)
+    basket_name = basket_data.get('nome', f"Cesta #{basket_id}")
+    contagem = {'resultados': 0, 'produtos': 0}
 
-    resultados_por_mercado = await asyncio.gather(*all_tasks, return_exceptions=True)
-    resultados_finais = []
+    async def gerar_eventos():
+        try:
+            async for evento in _planejar_cesta(produtos, mercados):
+                contagem['resultados'] += len(evento['resultados'])
+                contagem['produtos'] = evento['total_produtos']
+                evento['resultados'] = _ordenar_resultados_cesta(evento['resultados'])
+                yield json.dumps(evento, default=str) + "\n"
+            yield json.dumps({"done": True, "total_produtos": contagem['produtos'], "total_resultados": contagem['resultados']}) + "\n"
+        finally:
+            # Também quando o cliente desconecta no meio do stream (com a contagem parcial);
+            # log_search apenas enfileira no pipeline de logs
+            log_search(f"[Cesta: {basket_name}]", 'realtime', cnpjs, contagem['resultados'], current_user)
+
+    return StreamingResponse(gerar_eventos(), media_type="application/x-ndjson")
+
+@app.post("/api/baskets/{basket_id}/current-prices")
+async def get_basket_current_prices(
+    basket_id: int,
+    background_tasks: BackgroundTasks,
+    cnpjs: List[str] = Query(..., description="Lista de CNPJs dos mercados para pesquisa."),
+    sort: str = Query('name', pattern="^(name|unit_price)$"),
+    current_user: UserProfile = Depends(require_page_access('baskets'))
+):
+    """Precifica a cesta com o último preço conhecido de cada produto (snapshot current_prices), sem consultar a SEFAZ"""
+    basket_data, _, _ = await _carregar_cesta_para_precificacao(basket_id, cnpjs, current_user)
+    if not basket_data['produtos']:
+        return {"results": [], "message": "Nenhum produto na cesta para buscar."}
 
-    for resultado in resultados_por_mercado:
-        if isinstance(resultado, Exception):
-            logging.error(f"Falha na busca em tempo real de cesta: {resultado}")
-        elif resultado:
-            resultados_finais.extend(resultado)
+    # Itens sem GTIN também buscam as descrições equivalentes do seu cluster nos outros mercados
+    equivalentes = {}
+    for item in basket_data['produtos']:
+        if item.get('nome_produto') and not item.get('codigo_barras'):
+            _, membros = product_clusters.equivalentes(item['nome_produto'])
+            if membros:
+                equivalentes[item['nome_produto']] = membros
+    resultados = await repositorio.precos_atuais_cesta(basket_data['produtos'], cnpjs, equivalentes)
+    for resultado in resultados:
+        if not resultado.get('codigo_barras'):
+            resultado['cluster_id'] = product_clusters.cluster_de(resultado.get('nome_produto_normalizado'))
 
     basket_name = basket_data.get('nome', f"Cesta #{basket_id}")
-    background_tasks.add_task(log_search, f"[Cesta: {basket_name}]", 'realtime', cnpjs, len(resultados_finais), current_user)
+    background_tasks.add_task(log_search, f"[Cesta: {basket_name}]", 'database', cnpjs, len(resultados), current_user)
 
-    return {"results": sorted(resultados_finais, key=lambda x: (x.get('nome_produto_normalizado', ''), x.get('preco_produto', float('inf'))))}
+    if sort == 'unit_price':
+        # Cada item da cesta com as opções do menor para o maior preço por quilo/litro/unidade
+        return {"results": sorted(resultados, key=lambda r: (r.get('produto_cesta') or '',) + _chave_ordenacao(r, 'unit_price'))}
+    return {"results": _ordenar_resultados_cesta(resultados)}
 
 # --------------------------------------------------------------------------
 # --- ENDPOINTS PARA GERENCIAMENTO DE GRUPOS ---
@@ -2173,9 +2660,7 @@ async def create_group(
 ):
     try:
         group_data = group.dict()
-        resp = await asyncio.to_thread(
-            supabase.table('grupos').insert(group_data).execute
-        )
+        resp = await db.table('grupos').insert(group_data).execute()
         return resp.data[0]
     except Exception as e:
         logging.error(f"Erro ao criar grupo: {e}")
@@ -2184,9 +2669,7 @@ async def create_group(
 @app.get("/api/groups", response_model=List[Grupo])
 async def list_groups(admin_user: UserProfile = Depends(require_page_access('group_admin_users'))):
     try:
-        resp = await asyncio.to_thread(
-            supabase.table('grupos').select('*').order('nome').execute
-        )
+        resp = await db.table('grupos').select('*').order('nome').execute()
         return resp.data
     except Exception as e:
         logging.error(f"Erro ao listar grupos: {e}")
@@ -2203,13 +2686,9 @@ async def update_group(
         group_data['updated_at'] = datetime.now().isoformat()
 
         # Buscar dados antigos do grupo
-        old_group_resp = await asyncio.to_thread(
-            supabase.table('grupos').select('dias_acesso').eq('id', group_id).single().execute
-        )
+        old_group_resp = await db.table('grupos').select('dias_acesso').eq('id', group_id).single().execute()
 
-        resp = await asyncio.to_thread(
-            supabase.table('grupos').update(group_data).eq('id', group_id).execute
-        )
+        resp = await db.table('grupos').update(group_data).eq('id', group_id).execute()
 
         if not resp.data:
             raise HTTPException(status_code=404, detail="Grupo não encontrado")
@@ -2219,6 +2698,8 @@ async def update_group(
             await update_group_members_expiration(group_id, group.dias_acesso)
             logging.info(f"Datas de expiração atualizadas automaticamente para o grupo {group_id}")
 
+        # Ativação/expiração do grupo muda o acesso de todos os membros
+        invalidar_cache_grupo(await membros_do_grupo(group_id))
         return resp.data[0]
     except HTTPException:
         raise
@@ -2232,16 +2713,15 @@ async def delete_group(
     admin_user: UserProfile = Depends(require_page_access('group_admin_users'))
 ):
     try:
-        group_resp = await asyncio.to_thread(
-            supabase.table('grupos').select('id').eq('id', group_id).execute
-        )
+        group_resp = await db.table('grupos').select('id').eq('id', group_id).execute()
 
         if not group_resp.data:
             raise HTTPException(status_code=404, detail="Grupo não encontrado")
 
-        await asyncio.to_thread(
-            lambda: supabase.table('grupos').delete().eq('id', group_id).execute()
-        )
+        # Membros lidos antes da exclusão (as associações ao grupo saem junto com ele)
+        membros = await membros_do_grupo(group_id)
+        await db.table('grupos').delete().eq('id', group_id).execute()
+        invalidar_cache_grupo(membros)
         return
     except HTTPException:
         raise
@@ -2258,16 +2738,12 @@ async def add_user_to_group(
         logging.info(f"Tentando adicionar usuário {user_group.user_id} ao grupo {user_group.group_id}")
 
         # Verificar se o usuário existe
-        user_resp = await asyncio.to_thread(
-            supabase.table('profiles').select('id, full_name').eq('id', user_group.user_id).execute
-        )
+        user_resp = await db.table('profiles').select('id, full_name').eq('id', user_group.user_id).execute()
         if not user_resp.data:
             raise HTTPException(status_code=404, detail="Usuário não encontrado")
 
         # Verificar se o grupo existe
-        group_resp = await asyncio.to_thread(
-            supabase.table('grupos').select('dias_acesso').eq('id', user_group.group_id).execute
-        )
+        group_resp = await db.table('grupos').select('dias_acesso').eq('id', user_group.group_id).execute()
         if not group_resp.data:
             raise HTTPException(status_code=404, detail="Grupo não encontrado")
 
@@ -2279,12 +2755,12 @@ async def add_user_to_group(
             data_expiracao = calcular_data_expiracao(dias_acesso)
 
         # Verificar se a associação já existe
-        existing_assoc = await asyncio.to_thread(
-            supabase.table('user_groups')
+        existing_assoc = await (
+            db.table('user_groups')
             .select('id')
             .eq('user_id', user_group.user_id)
             .eq('group_id', user_group.group_id)
-            .execute
+            .execute()
         )
 
         if existing_assoc.data:
@@ -2293,12 +2769,12 @@ async def add_user_to_group(
                 'data_expiracao': data_expiracao.isoformat()
             }
 
-            resp = await asyncio.to_thread(
-                supabase.table('user_groups')
+            resp = await (
+                db.table('user_groups')
                 .update(user_group_data)
                 .eq('user_id', user_group.user_id)
                 .eq('group_id', user_group.group_id)
-                .execute
+                .execute()
             )
         else:
             # Criar nova associação
@@ -2308,10 +2784,9 @@ async def add_user_to_group(
                 'data_expiracao': data_expiracao.isoformat()
             }
 
-            resp = await asyncio.to_thread(
-                supabase.table('user_groups').insert(user_group_data).execute
-            )
+            resp = await db.table('user_groups').insert(user_group_data).execute()
 
+        invalidar_cache_usuario(user_group.user_id)
         logging.info(f"Usuário {user_group.user_id} adicionado/atualizado no grupo {user_group.group_id}")
         return resp.data[0]
 
@@ -2323,52 +2798,46 @@ async def add_user_to_group(
 
 @app.get("/api/user-groups", response_model=List[UserGroupWithDetails])
 async def list_user_groups(
+    response: Response,
     user_id: Optional[str] = Query(None),
     group_id: Optional[int] = Query(None),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(1000, ge=1, le=1000),
     admin_user: UserProfile = Depends(require_page_access('group_admin_users'))
 ):
+    """Lista associações usuário-grupo, paginadas; o total vem no cabeçalho X-Total-Count"""
     try:
-        query = supabase_admin.table('user_groups').select('*')
+        query = db_admin.table('user_groups').select('*', count='exact')
 
         if user_id:
             query = query.eq('user_id', user_id)
         if group_id:
             query = query.eq('group_id', group_id)
 
-        user_groups_response = await asyncio.to_thread(
-            query.order('created_at', desc=True).execute
-        )
+        inicio = (page - 1) * page_size
+        user_groups_response = await query.order('created_at', desc=True).range(inicio, inicio + page_size - 1).execute()
+        response.headers['X-Total-Count'] = str(user_groups_response.count or 0)
 
         # Se não há dados, retornar lista vazia imediatamente
         if not user_groups_response.data:
             return []
 
+        # Grupos, perfis e e-mails da página inteira em lote, unidos em memória
+        user_ids = [ug['user_id'] for ug in user_groups_response.data]
+        grupos, profiles, emails = await asyncio.gather(
+            buscar_por_ids(db_admin, 'grupos', '*', 'id', (ug['group_id'] for ug in user_groups_response.data)),
+            buscar_por_ids(db_admin, 'profiles', 'id, full_name', 'id', user_ids),
+            user_directory.obter_emails(user_ids)
+        )
+        grupos_por_id = {grupo['id']: grupo for grupo in grupos}
+        nomes_usuarios = {profile['id']: profile['full_name'] for profile in profiles}
+        grupo_nao_encontrado = {'nome': 'Grupo Não Encontrado', 'dias_acesso': 0}
+
         user_groups_with_details = []
 
         for user_group in user_groups_response.data:
             try:
-                # Buscar informações do grupo
-                group_response = await asyncio.to_thread(
-                    supabase_admin.table('grupos').select('*').eq('id', user_group['group_id']).execute
-                )
-                grupo_data = group_response.data[0] if group_response.data else {'nome': 'Grupo Não Encontrado', 'dias_acesso': 0}
-
-                # Buscar informações do perfil
-                profile_response = await asyncio.to_thread(
-                    supabase_admin.table('profiles').select('full_name').eq('id', user_group['user_id']).execute
-                )
-                user_name = profile_response.data[0]['full_name'] if profile_response.data else 'N/A'
-
-                # Buscar email do usuário
-                user_email = "N/A"
-                try:
-                    auth_response = await asyncio.to_thread(
-                        lambda: supabase_admin.auth.admin.get_user_by_id(user_group['user_id'])
-                    )
-                    if auth_response.user:
-                        user_email = auth_response.user.email
-                except Exception as e:
-                    logging.error(f"Erro ao buscar email do usuário {user_group['user_id']}: {e}")
+                grupo_data = grupos_por_id.get(user_group['group_id'], grupo_nao_encontrado)
 
                 user_group_detail = UserGroupWithDetails(
                     id=user_group['id'],
@@ -2378,8 +2847,8 @@ async def list_user_groups(
                     created_at=user_group['created_at'],
                     grupo_nome=grupo_data['nome'],
                     grupo_dias_acesso=grupo_data['dias_acesso'],
-                    user_name=user_name,
-                    user_email=user_email
+                    user_name=nomes_usuarios.get(user_group['user_id'], 'N/A'),
+                    user_email=emails.get(user_group['user_id']) or "N/A"
                 )
                 user_groups_with_details.append(user_group_detail)
 
@@ -2403,9 +2872,7 @@ async def update_group_expiration_dates(
     """Atualiza as datas de expiração de todos os membros do grupo com base nos dias_acesso atuais"""
     try:
         # Buscar o grupo
-        group_resp = await asyncio.to_thread(
-            supabase.table('grupos').select('dias_acesso').eq('id', group_id).single().execute
-        )
+        group_resp = await db.table('grupos').select('dias_acesso').eq('id', group_id).single().execute()
         if not group_resp.data:
             raise HTTPException(status_code=404, detail="Grupo não encontrado")
 
@@ -2430,9 +2897,7 @@ async def renew_group_access_endpoint(
     """Renova o acesso de todos os usuários do grupo adicionando dias"""
     try:
         # Verificar se o grupo existe
-        group_resp = await asyncio.to_thread(
-            supabase.table('grupos').select('id').eq('id', group_id).execute
-        )
+        group_resp = await db.table('grupos').select('id').eq('id', group_id).execute()
         if not group_resp.data:
             raise HTTPException(status_code=404, detail="Grupo não encontrado")
 
@@ -2455,52 +2920,43 @@ async def get_user_groups(
     admin_user: UserProfile = Depends(require_page_access('group_admin_users'))
 ):
     try:
-        user_groups_response = await asyncio.to_thread(
-            supabase_admin.table('user_groups').select('*')
+        user_groups_response = await (
+            db_admin.table('user_groups').select('*')
             .eq('user_id', user_id)
             .order('created_at', desc=True)
-            .execute
+            .execute()
         )
 
         # Se não há dados, retornar lista vazia
         if not user_groups_response.data:
             return []
 
+        # Grupos em uma única consulta; perfil e e-mail são do mesmo usuário para todas as linhas
+        grupos, profile_response, user_email = await asyncio.gather(
+            buscar_por_ids(db_admin, 'grupos', '*', 'id', (ug['group_id'] for ug in user_groups_response.data)),
+            db_admin.table('profiles').select('full_name').eq('id', user_id).execute(),
+            user_directory.obter_email(user_id)
+        )
+        grupos_por_id = {grupo['id']: grupo for grupo in grupos}
+        user_name = profile_response.data[0]['full_name'] if profile_response.data else 'N/A'
+
         user_groups = []
 
         for user_group in user_groups_response.data:
             try:
-                group_response = await asyncio.to_thread(
-                    supabase_admin.table('grupos').select('*').eq('id', user_group['group_id']).execute
-                )
-
-                if group_response.data:
-                    profile_response = await asyncio.to_thread(
-                        supabase_admin.table('profiles').select('full_name').eq('id', user_id).execute
-                    )
-
-                    user_email = "N/A"
-                    try:
-                        auth_response = await asyncio.to_thread(
-                            lambda: supabase_admin.auth.admin.get_user_by_id(user_id)
-                        )
-                        if auth_response.user:
-                            user_email = auth_response.user.email
-                    except Exception as e:
-                        logging.error(f"Erro ao buscar email do usuário {user_id}: {e}")
-
-                    user_name = profile_response.data[0]['full_name'] if profile_response.data else 'N/A'
+                grupo = grupos_por_id.get(user_group['group_id'])
 
+                if grupo:
                     group_detail = UserGroupWithDetails(
                         id=user_group['id'],
                         user_id=user_group['user_id'],
                         group_id=user_group['group_id'],
                         data_expiracao=user_group['data_expiracao'],
                         created_at=user_group['created_at'],
-                        grupo_nome=group_response.data[0]['nome'],
-                        grupo_dias_acesso=group_response.data[0]['dias_acesso'],
+                        grupo_nome=grupo['nome'],
+                        grupo_dias_acesso=grupo['dias_acesso'],
                         user_name=user_name,
-                        user_email=user_email
+                        user_email=user_email or "N/A"
                     )
                     user_groups.append(group_detail)
             except Exception as e:
@@ -2520,17 +2976,13 @@ async def get_my_groups_detailed(current_user: UserProfile = Depends(get_current
     try:
         # Reutilizar a lógica do group_admin_routes
         if current_user.role == 'admin':
-            groups_response = await asyncio.to_thread(
-                supabase.table('grupos').select('*').order('nome').execute
-            )
+            groups_response = await db.table('grupos').select('*').order('nome').execute()
             groups = groups_response.data or []
         else:
             # Buscar grupos gerenciados pelo subadmin
             managed_groups = []
             try:
-                admin_response = await asyncio.to_thread(
-                    supabase.table('group_admins').select('group_ids').eq('user_id', current_user.id).execute
-                )
+                admin_response = await db.table('group_admins').select('group_ids').eq('user_id', current_user.id).execute()
                 if admin_response.data:
                     managed_groups = admin_response.data[0].get('group_ids', [])
             except Exception as e:
@@ -2539,12 +2991,12 @@ async def get_my_groups_detailed(current_user: UserProfile = Depends(get_current
             if not managed_groups:
                 return []
 
-            groups_response = await asyncio.to_thread(
-                supabase.table('grupos')
+            groups_response = await (
+                db.table('grupos')
                 .select('*')
                 .in_('id', managed_groups)
                 .order('nome')
-                .execute
+                .execute()
             )
             groups = groups_response.data or []
 
@@ -2552,12 +3004,12 @@ async def get_my_groups_detailed(current_user: UserProfile = Depends(get_current
         groups_with_details = []
         for group in groups:
             # Contar usuários ativos no grupo
-            user_groups_response = await asyncio.to_thread(
-                supabase_admin.table('user_groups')
+            user_groups_response = await (
+                db_admin.table('user_groups')
                 .select('user_id', count='exact')
                 .eq('group_id', group['id'])
                 .gte('data_expiracao', date.today().isoformat())
-                .execute
+                .execute()
             )
 
             group_with_details = {
@@ -2584,9 +3036,9 @@ async def delete_user_group_association(
 ):
     """Remove uma associação usuário-grupo específica"""
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('user_groups').delete().eq('id', user_group_id).execute()
-        )
+        delete_resp = await db.table('user_groups').delete().eq('id', user_group_id).execute()
+        for removida in delete_resp.data or []:
+            invalidar_cache_usuario(removida.get('user_id'))
         return
     except Exception as e:
         logging.error(f"Erro ao deletar associação usuário-grupo {user_group_id}: {e}")
@@ -2602,12 +3054,12 @@ async def renew_user_group_access(
     """Endpoint alternativo para renovar acesso via user_group_id"""
     try:
         # Buscar a associação
-        user_group_response = await asyncio.to_thread(
-            supabase.table('user_groups')
+        user_group_response = await (
+            db.table('user_groups')
             .select('*')
             .eq('id', user_group_id)
             .single()
-            .execute
+            .execute()
         )
 
         if not user_group_response.data:
@@ -2629,12 +3081,13 @@ async def renew_user_group_access(
             nova_data = data_expiracao + timedelta(days=dias_adicionais)
 
         # Atualizar
-        await asyncio.to_thread(
-            lambda: supabase.table('user_groups')
+        await (
+            db.table('user_groups')
             .update({'data_expiracao': nova_data.isoformat()})
             .eq('id', user_group_id)
             .execute()
         )
+        invalidar_cache_usuario(user_group['user_id'])
 
         return {"message": f"Acesso renovado por {dias_adicionais} dias"}
 
@@ -2651,25 +3104,17 @@ async def search_users_for_group_admin(
     """Busca usuários para designação como admin de grupo"""
     try:
         # Buscar por nome
-        profiles_response = await asyncio.to_thread(
-            supabase.table('profiles')
+        profiles_response = await (
+            db.table('profiles')
             .select('id, full_name, role')
             .ilike('full_name', f"%{q}%")
-            .execute
+            .execute()
         )
 
         users = []
+        emails = await user_directory.obter_emails(profile['id'] for profile in profiles_response.data)
         for profile in profiles_response.data:
-            # Buscar email
-            email = None
-            try:
-                auth_response = await asyncio.to_thread(
-                    lambda: supabase_admin.auth.admin.get_user_by_id(profile['id'])
-                )
-                if auth_response.user:
-                    email = auth_response.user.email
-            except Exception as e:
-                logging.error(f"Erro ao buscar email do usuário {profile['id']}: {e}")
+            email = emails.get(profile['id'])
 
             users.append({
                 "id": profile["id"],
@@ -2726,6 +3171,69 @@ async def renew_group_access_bulk(
         logging.error(f"Erro ao renovar acesso do grupo: {e}")
         raise HTTPException(status_code=500, detail=f"Erro ao renovar acesso: {str(e)}")
 
+# Cargas de inicialização em background: a referência evita que a tarefa seja coletada antes de terminar
+_tarefas_inicializacao: Set[asyncio.Task] = set()
+
+def _iniciar_em_background(coro) -> asyncio.Task:
+    tarefa = asyncio.create_task(coro)
+    _tarefas_inicializacao.add(tarefa)
+    tarefa.add_done_callback(_tarefas_inicializacao.discard)
+    return tarefa
+
+@app.on_event("startup")
+async def start_user_directory():
+    """Carrega o diretório de e-mails dos usuários e inicia sua atualização periódica"""
+    _iniciar_em_background(user_directory.iniciar())
+
+@app.on_event("startup")
+async def start_repository():
+    """Abre o pool do backend de leitura configurado (DB_BACKEND)"""
+    await repository.iniciar()
+
+@app.on_event("startup")
+async def start_access_sweeper():
+    """Inicia a varredura periódica de acessos expirados (tabela user_access)"""
+    _iniciar_em_background(access_sweeper.iniciar())
+
+@app.on_event("startup")
+async def start_search_index():
+    """Carrega o índice de busca em background; até lá /api/search consulta o banco"""
+    async def carregar():
+        await search_index.iniciar()
+        # Pondera as sugestões e aquece as buscas populares sem esperar a próxima coleta
+        search_cache_warmer.agendar()
+    _iniciar_em_background(carregar())
+
+@app.on_event("startup")
+async def start_product_clusters():
+    """Carrega os clusters de produtos sem GTIN e agenda a manutenção incremental e a reconstrução"""
+    _iniciar_em_background(product_clusters.iniciar())
+
+@app.on_event("startup")
+async def start_activity_log():
+    """Inicia o consumidor que grava os logs de atividade em lote"""
+    activity_log_writer.iniciar()
+
+@app.on_event("shutdown")
+async def stop_activity_log():
+    """Grava os logs de atividade ainda na fila antes de encerrar"""
+    await activity_log_writer.parar()
+
+@app.on_event("shutdown")
+async def flush_realtime_writeback():
+    """Grava os resultados em tempo real ainda pendentes antes de encerrar"""
+    await realtime_writeback.flush()
+    await user_directory.parar()
+    await access_sweeper.parar()
+    await search_cache_warmer.parar()
+    await product_clusters.parar()
+
+@app.on_event("shutdown")
+async def close_database():
+    """Fecha os pools de conexões do PostgREST e do Postgres (depois dos flushes acima)"""
+    await repository.fechar()
+    await database.fechar()
+
 # --- Servir o Frontend ---
 app.mount("/", StaticFiles(directory="web", html=True), name="static")
 
@@ -0,0 +1,457 @@
+# product_clusters.py - Agrupamento de produtos equivalentes sem GTIN (assinaturas MinHash + LSH)
+import os
+import re
+import time
+import zlib
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy é opcional: sem ele os produtos sem GTIN ficam sem agrupamento
+    np = None
+
+from postgrest.exceptions import APIError as PostgrestAPIError
+
+from database import relacao_inexistente
+from search_index import SEARCH_INDEX_DAYS, normalizar_nome
+
+# --- Configurações ---
+PRODUCT_CLUSTERS_ENABLED = os.getenv("PRODUCT_CLUSTERS_ENABLED", "true").lower() == "true" and np is not None
+# Similaridade de Jaccard estimada (fração de minhashes iguais) para dois nomes serem o mesmo produto
+PRODUCT_CLUSTER_MIN_SIMILARITY = float(os.getenv("PRODUCT_CLUSTER_MIN_SIMILARITY", "0.6"))
+PRODUCT_CLUSTER_INTERVAL_SECONDS = int(os.getenv("PRODUCT_CLUSTER_INTERVAL_SECONDS", "300"))
+PRODUCT_CLUSTER_REBUILD_HOURS = float(os.getenv("PRODUCT_CLUSTER_REBUILD_HOURS", "24"))
+PRODUCT_CLUSTER_PAGE_SIZE = 1000
+# 16 bandas x 4 linhas: pares com Jaccard 0.6 colidem em alguma banda com ~98% de chance, pares com 0.3 com ~12%
+MINHASH_BANDAS = 16
+MINHASH_LINHAS = 4
+MINHASH_PERMUTACOES = MINHASH_BANDAS * MINHASH_LINHAS
+# Baldes muito cheios (nomes genéricos) só comparam com os membros mais recentes
+LSH_CANDIDATOS_POR_BALDE = 50
+MINHASH_LOTE = 1000
+
+# Primeiro primo acima de 2^32: com a, b e x < 2^32, a*x + b cabe em uint64
+_PRIMO = 4294967311
+_MASCARA_32 = 0xFFFFFFFF
+_UNIDADE_SEPARADA = re.compile(r'\b(\d+) (kg|g|gr|mg|ml|l|lt|un|und|unid)\b')
+_NUMEROS = re.compile(r'\d+')
+
+if np is not None:
+    # Semente fixa: as assinaturas precisam ser as mesmas entre processos (ids persistidos)
+    _aleatorio = np.random.RandomState(48)
+    _A = _aleatorio.randint(1, _MASCARA_32, size=MINHASH_PERMUTACOES, dtype=np.uint64)[:, None]
+    _B = _aleatorio.randint(0, _MASCARA_32, size=MINHASH_PERMUTACOES, dtype=np.uint64)[:, None]
+    _MULTIPLICADORES_BANDA = (_aleatorio.randint(1, _MASCARA_32, size=MINHASH_LINHAS, dtype=np.uint64) | 1)
+
+def _shingles(nome: str) -> Set[str]:
+    """Palavras inteiras mais trigramas de cada palavra ('5 kg' e '5kg' viram o mesmo token)"""
+    palavras = _UNIDADE_SEPARADA.sub(r'\1\2', nome).split()
+    conjunto = set(palavras)
+    for palavra in palavras:
+        palavra = f" {palavra} "
+        conjunto.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return conjunto
+
+def _numeros(nome: str) -> frozenset:
+    # Nomes quase iguais com quantidades diferentes (5kg x 1kg) são produtos diferentes
+    return frozenset(_NUMEROS.findall(nome))
+
+def assinaturas(nomes: List[str]) -> "np.ndarray":
+    """Assinatura MinHash (uint32) de cada nome já normalizado e não vazio, em lotes vetorizados"""
+    resultado = np.empty((len(nomes), MINHASH_PERMUTACOES), dtype=np.uint32)
+    for inicio in range(0, len(nomes), MINHASH_LOTE):
+        hashes: List[int] = []
+        posicoes: List[int] = []
+        for nome in nomes[inicio:inicio + MINHASH_LOTE]:
+            posicoes.append(len(hashes))
+            hashes.extend(zlib.crc32(shingle.encode()) for shingle in _shingles(nome))
+        valores = (_A * np.array(hashes, dtype=np.uint64) + _B) % _PRIMO
+        minimos = np.minimum.reduceat(valores, np.array(posicoes, dtype=np.int64), axis=1)
+        resultado[inicio:inicio + len(posicoes)] = np.minimum(minimos, _MASCARA_32).T
+    return resultado
+
+def _bandas(assinaturas_: "np.ndarray") -> "np.ndarray":
+    """Um hash uint64 por banda (soma com multiplicadores ímpares, com estouro proposital)"""
+    blocos = assinaturas_.reshape(len(assinaturas_), MINHASH_BANDAS, MINHASH_LINHAS).astype(np.uint64)
+    return (blocos * _MULTIPLICADORES_BANDA).sum(axis=2, dtype=np.uint64)
+
+class ProductClusterIndex:
+    """
+    Atribui um cluster_id a cada nome normalizado sem GTIN. Cada nome novo só é comparado com os
+    nomes que colidem com ele em alguma banda LSH (tempo ~linear, sem comparar todos os pares) e
+    entra no cluster do mais parecido acima de PRODUCT_CLUSTER_MIN_SIMILARITY, com os mesmos números
+    no nome; sem candidato, abre um cluster novo. Os ids já atribuídos não mudam no incremento.
+    """
+    def __init__(self):
+        self._nomes: List[str] = []
+        self._posicao: Dict[str, int] = {}
+        self._clusters: List[int] = []
+        self._numeros: List[frozenset] = []
+        self._assinaturas = np.empty((0, MINHASH_PERMUTACOES), dtype=np.uint32)
+        self._baldes: List[Dict[int, List[int]]] = [{} for _ in range(MINHASH_BANDAS)]
+        self._membros: Dict[int, List[str]] = {}
+        self.proximo_id = 1
+
+    def __len__(self) -> int:
+        return len(self._nomes)
+
+    def __contains__(self, nome: str) -> bool:
+        return nome in self._posicao
+
+    def cluster_de(self, nome: Optional[str]) -> Optional[int]:
+        posicao = self._posicao.get(nome) if nome else None
+        return self._clusters[posicao] if posicao is not None else None
+
+    def membros(self, cluster_id: int) -> List[str]:
+        return list(self._membros.get(cluster_id, ()))
+
+    def atribuicoes(self) -> Dict[str, int]:
+        return dict(zip(self._nomes, self._clusters))
+
+    def _mais_parecido(self, assinatura: "np.ndarray", bandas: "np.ndarray", numeros: frozenset) -> Optional[int]:
+        candidatos: Set[int] = set()
+        for banda, valor in enumerate(bandas.tolist()):
+            candidatos.update(self._baldes[banda].get(valor, ())[-LSH_CANDIDATOS_POR_BALDE:])
+        candidatos = [c for c in candidatos if self._numeros[c] == numeros]
+        if not candidatos:
+            return None
+        similaridades = np.count_nonzero(self._assinaturas[candidatos] == assinatura, axis=1) / MINHASH_PERMUTACOES
+        melhor = int(np.argmax(similaridades))
+        return candidatos[melhor] if similaridades[melhor] >= PRODUCT_CLUSTER_MIN_SIMILARITY else None
+
+    def preparar(self, nomes: Iterable[str], fixos: Optional[Dict[str, int]] = None) -> Optional[Tuple[List[str], List[str], "np.ndarray", "np.ndarray"]]:
+        """
+        Parte cara da atribuição (normalização e assinaturas MinHash dos nomes ainda não indexados),
+        sem alterar o índice: pode rodar numa thread enquanto o event loop lê o índice publicado.
+        """
+        fixos = fixos or {}
+        por_nome = {n: normalizar_nome(n) for n in nomes if n and n not in self._posicao}
+        novos = sorted((n for n, normalizado in por_nome.items() if normalizado), key=lambda n: (n not in fixos, n))
+        if not novos:
+            return None
+        normalizados = [por_nome[n] for n in novos]
+        assinaturas_novas = assinaturas(normalizados)
+        return novos, normalizados, assinaturas_novas, _bandas(assinaturas_novas)
+
+    def atribuir(self, nomes: Iterable[str], fixos: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        """
+        Atribui clusters aos nomes ainda não indexados e retorna {nome: cluster_id} dos novos.
+        Nomes em `fixos` (atribuições persistidas) mantêm o id e entram antes dos demais.
+        """
+        return self.aplicar(self.preparar(nomes, fixos), fixos)
+
+    def aplicar(self, preparados: Optional[Tuple[List[str], List[str], "np.ndarray", "np.ndarray"]], fixos: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        """Compara os nomes preparados com os candidatos LSH e os insere no índice"""
+        fixos = fixos or {}
+        if preparados is None:
+            return {}
+        novos, normalizados, assinaturas_novas, bandas_novas = preparados
+        # Nomes indexados entre o preparo e a aplicação ficam com a atribuição existente
+        manter = [i for i, nome in enumerate(novos) if nome not in self._posicao]
+        if len(manter) < len(novos):
+            novos = [novos[i] for i in manter]
+            normalizados = [normalizados[i] for i in manter]
+            assinaturas_novas, bandas_novas = assinaturas_novas[manter], bandas_novas[manter]
+            if not novos:
+                return {}
+        base = len(self._nomes)
+        self._assinaturas = np.vstack([self._assinaturas, assinaturas_novas])
+        if fixos:
+            self.proximo_id = max(self.proximo_id, max(fixos.values()) + 1)
+
+        atribuidos: Dict[str, int] = {}
+        for i, nome in enumerate(novos):
+            numeros = _numeros(normalizados[i])
+            cluster_id = fixos.get(nome)
+            if cluster_id is None:
+                parecido = self._mais_parecido(assinaturas_novas[i], bandas_novas[i], numeros)
+                if parecido is not None:
+                    cluster_id = self._clusters[parecido]
+                else:
+                    cluster_id = self.proximo_id
+                    self.proximo_id += 1
+                atribuidos[nome] = cluster_id
+            posicao = base + i
+            self._nomes.append(nome)
+            self._clusters.append(cluster_id)
+            self._numeros.append(numeros)
+            self._posicao[nome] = posicao
+            self._membros.setdefault(cluster_id, []).append(nome)
+            for banda, valor in enumerate(bandas_novas[i].tolist()):
+                self._baldes[banda].setdefault(valor, []).append(posicao)
+        return atribuidos
+
+    def consultar(self, nome: str) -> Optional[int]:
+        """Cluster de um nome qualquer (ex.: item de cesta), sem indexá-lo"""
+        cluster_id = self.cluster_de(nome) or self.cluster_de(nome.lower().strip())
+        normalizado = normalizar_nome(nome)
+        if cluster_id is not None or not normalizado or not self._nomes:
+            return cluster_id
+        assinatura = assinaturas([normalizado])
+        parecido = self._mais_parecido(assinatura[0], _bandas(assinatura)[0], _numeros(normalizado))
+        return self._clusters[parecido] if parecido is not None else None
+
+    def preservar_ids(self, anteriores: Dict[str, int]) -> Dict[str, int]:
+        """
+        Depois de uma reconstrução, renumera os clusters para reaproveitar o id anterior da maioria
+        dos membros (maiores clusters primeiro); retorna os nomes cujo id mudou ou é novo.
+        """
+        usados: Set[int] = set()
+        proximo = max(anteriores.values(), default=0) + 1
+        mapa: Dict[int, int] = {}
+        for cluster_id, membros in sorted(self._membros.items(), key=lambda item: -len(item[1])):
+            votos = Counter(anteriores[nome] for nome in membros if nome in anteriores)
+            escolhido = next((anterior for anterior, _ in votos.most_common() if anterior not in usados), None)
+            if escolhido is None:
+                escolhido, proximo = proximo, proximo + 1
+            usados.add(escolhido)
+            mapa[cluster_id] = escolhido
+        self._clusters = [mapa[c] for c in self._clusters]
+        self._membros = {mapa[c]: membros for c, membros in self._membros.items()}
+        self.proximo_id = proximo
+        return {nome: c for nome, c in zip(self._nomes, self._clusters) if anteriores.get(nome) != c}
+
+    def estatisticas(self) -> Dict[str, int]:
+        return {
+            'nomes': len(self._nomes),
+            'clusters': len(self._membros),
+            'clusters_com_equivalentes': sum(1 for membros in self._membros.values() if len(membros) > 1)
+        }
+
+class ProductClusterService:
+    """
+    Mantém os clusters de produtos sem GTIN: na inicialização carrega as atribuições gravadas em
+    produto_clusters (sql/007) e agrupa só os nomes novos; nomes que chegam pela coleta ou pelo
+    tempo real entram a cada PRODUCT_CLUSTER_INTERVAL_SECONDS (ou ao fim da coleta), e a cada
+    PRODUCT_CLUSTER_REBUILD_HOURS o agrupamento é refeito do zero preservando os ids.
+    """
+    def __init__(
+        self,
+        supabase_client: Any,
+        intervalo: float = PRODUCT_CLUSTER_INTERVAL_SECONDS,
+        intervalo_reconstrucao: float = PRODUCT_CLUSTER_REBUILD_HOURS * 3600
+    ):
+        self.supabase_client = supabase_client
+        self.intervalo = intervalo
+        self.intervalo_reconstrucao = intervalo_reconstrucao
+        self.indice: Optional[ProductClusterIndex] = None
+        # None = ainda não verificado; False = migração sql/007 não aplicada (clusters só em memória)
+        self.persistir: Optional[bool] = None
+        self._pendentes: Set[str] = set()
+        self._lock = asyncio.Lock()
+        self._tarefa: Optional[asyncio.Task] = None
+        self._incremento: Optional[asyncio.Task] = None
+        self.stats = {'reconstrucoes': 0, 'incrementos': 0, 'nomes_atribuidos': 0, 'gravados': 0, 'erros': 0, 'tempo_reconstrucao_segundos': 0.0}
+
+    @property
+    def pronto(self) -> bool:
+        return self.indice is not None
+
+    async def _paginar(self, montar_query) -> List[Dict[str, Any]]:
+        registros: List[Dict[str, Any]] = []
+        inicio = 0
+        while True:
+            response = await montar_query().range(inicio, inicio + PRODUCT_CLUSTER_PAGE_SIZE - 1).execute()
+            lote = response.data or []
+            registros.extend(lote)
+            if len(lote) < PRODUCT_CLUSTER_PAGE_SIZE:
+                return registros
+            inicio += PRODUCT_CLUSTER_PAGE_SIZE
+
+    async def _carregar_nomes(self) -> Set[str]:
+        """Nomes normalizados dos produtos sem GTIN no snapshot de preços atuais"""
+        try:
+            linhas = await self._paginar(lambda: (
+                self.supabase_client.table('current_prices')
+                .select('nome_produto_normalizado')
+                .or_('codigo_barras.is.null,codigo_barras.eq.')
+                .order('produto_chave')
+                .order('cnpj_supermercado')
+            ))
+        except PostgrestAPIError as e:
+            if not relacao_inexistente(e):
+                raise
+            desde = time.strftime('%Y-%m-%d', time.localtime(time.time() - SEARCH_INDEX_DAYS * 86400))
+            linhas = await self._paginar(lambda: (
+                self.supabase_client.table('produtos')
+                .select('nome_produto_normalizado')
+                .or_('codigo_barras.is.null,codigo_barras.eq.')
+                .gte('data_coleta', desde)
+                .order('id_registro')
+            ))
+        return {linha['nome_produto_normalizado'] for linha in linhas if linha.get('nome_produto_normalizado')}
+
+    async def _carregar_atribuicoes(self) -> Dict[str, int]:
+        if self.persistir is False:
+            return {}
+        try:
+            linhas = await self._paginar(lambda: (
+                self.supabase_client.table('produto_clusters')
+                .select('nome_produto_normalizado, cluster_id')
+                .order('nome_produto_normalizado')
+            ))
+        except PostgrestAPIError as e:
+            if not relacao_inexistente(e):
+                raise
+            logging.warning("⚠️ Tabela produto_clusters não encontrada; clusters de produtos mantidos só em memória")
+            self.persistir = False
+            return {}
+        self.persistir = True
+        return {linha['nome_produto_normalizado']: linha['cluster_id'] for linha in linhas}
+
+    async def _gravar(self, atribuicoes: Dict[str, int]):
+        if not self.persistir or not atribuicoes:
+            return
+        agora = datetime.now(timezone.utc).isoformat()
+        linhas = [{'nome_produto_normalizado': nome, 'cluster_id': cluster_id, 'atualizado_em': agora}
+                  for nome, cluster_id in atribuicoes.items()]
+        for inicio in range(0, len(linhas), PRODUCT_CLUSTER_PAGE_SIZE):
+            await (
+                self.supabase_client.table('produto_clusters')
+                .upsert(linhas[inicio:inicio + PRODUCT_CLUSTER_PAGE_SIZE], on_conflict='nome_produto_normalizado')
+                .execute()
+            )
+        self.stats['gravados'] += len(linhas)
+
+    async def carregar(self):
+        """Retoma as atribuições gravadas e agrupa só os nomes que ainda não têm cluster"""
+        async with self._lock:
+            inicio = time.perf_counter()
+            anteriores = await self._carregar_atribuicoes()
+            nomes = await self._carregar_nomes()
+
+            def construir() -> Tuple[ProductClusterIndex, Dict[str, int]]:
+                indice = ProductClusterIndex()
+                novos = indice.atribuir(set(anteriores) | nomes, fixos=anteriores)
+                return indice, novos
+
+            self.indice, novos = await asyncio.to_thread(construir)
+            await self._gravar(novos)
+            self.stats['nomes_atribuidos'] += len(novos)
+            estatisticas = self.indice.estatisticas()
+            logging.info(
+                f"🧩 Clusters de produtos carregados: {estatisticas['clusters_com_equivalentes']} grupos de equivalentes "
+                f"em {estatisticas['nomes']} nomes sem GTIN ({len(novos)} novos) em {time.perf_counter() - inicio:.1f}s"
+            )
+
+    async def reconstruir(self):
+        """Refaz o agrupamento do zero (job offline) mantendo os ids dos clusters que sobrevivem"""
+        async with self._lock:
+            inicio = time.perf_counter()
+            anteriores = await self._carregar_atribuicoes()
+            if self.indice is not None:
+                anteriores = {**self.indice.atribuicoes(), **anteriores}
+            nomes = await self._carregar_nomes() | set(anteriores) | self._pendentes
+            self._pendentes = set()
+
+            def construir() -> Tuple[ProductClusterIndex, Dict[str, int]]:
+                indice = ProductClusterIndex()
+                indice.atribuir(nomes)
+                return indice, indice.preservar_ids(anteriores)
+
+            self.indice, alterados = await asyncio.to_thread(construir)
+            await self._gravar(alterados)
+            duracao = time.perf_counter() - inicio
+            self.stats['reconstrucoes'] += 1
+            self.stats['tempo_reconstrucao_segundos'] = round(duracao, 2)
+            logging.info(f"🧩 Clusters de produtos reconstruídos: {len(alterados)} nomes com cluster novo ou alterado em {duracao:.1f}s")
+
+    def adicionar(self, registros: List[Dict[str, Any]]):
+        """Enfileira os nomes sem GTIN ainda sem cluster (coleta e tempo real)"""
+        if self.indice is None:
+            return
+        for registro in registros:
+            nome = registro.get('nome_produto_normalizado')
+            if nome and not registro.get('codigo_barras') and nome not in self.indice:
+                self._pendentes.add(nome)
+
+    async def processar_pendentes(self) -> int:
+        if self.indice is None or not self._pendentes:
+            return 0
+        async with self._lock:
+            pendentes, self._pendentes = self._pendentes, set()
+            indice = self.indice
+            # MinHash numa thread; a inserção no índice publicado fica no event loop, onde
+            # cluster_de/consultar/estatisticas o leem (lotes incrementais são pequenos)
+            preparados = await asyncio.to_thread(indice.preparar, pendentes)
+            novos = indice.aplicar(preparados)
+            await self._gravar(novos)
+            self.stats['incrementos'] += 1
+            self.stats['nomes_atribuidos'] += len(novos)
+            return len(novos)
+
+    async def _processar_com_log(self):
+        try:
+            total = await self.processar_pendentes()
+            if total:
+                logging.info(f"🧩 {total} nomes novos agrupados")
+        except Exception as e:
+            self.stats['erros'] += 1
+            logging.error(f"Erro ao agrupar nomes novos de produtos: {e}")
+
+    def agendar(self):
+        """Agrupa os nomes pendentes em background (ex.: ao fim da coleta)"""
+        if self._incremento is None or self._incremento.done():
+            self._incremento = asyncio.get_running_loop().create_task(self._processar_com_log())
+
+    async def _executar(self):
+        desde_reconstrucao = 0.0
+        while True:
+            await asyncio.sleep(self.intervalo)
+            try:
+                desde_reconstrucao += self.intervalo
+                if desde_reconstrucao >= self.intervalo_reconstrucao:
+                    desde_reconstrucao = 0.0
+                    await self.reconstruir()
+                else:
+                    await self._processar_com_log()
+            except Exception as e:
+                self.stats['erros'] += 1
+                logging.error(f"Erro na manutenção dos clusters de produtos: {e}")
+
+    async def iniciar(self):
+        if not PRODUCT_CLUSTERS_ENABLED:
+            return
+        try:
+            await self.carregar()
+        except Exception as e:
+            self.stats['erros'] += 1
+            logging.error(f"Erro ao carregar os clusters de produtos: {e}")
+            return
+        if self._tarefa is None or self._tarefa.done():
+            self._tarefa = asyncio.create_task(self._executar())
+
+    async def parar(self):
+        tarefas = [t for t in (self._tarefa, self._incremento) if t is not None and not t.done()]
+        for tarefa in tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        self._tarefa = None
+        self._incremento = None
+
+    def cluster_de(self, nome: Optional[str]) -> Optional[int]:
+        return self.indice.cluster_de(nome) if self.indice is not None else None
+
+    def equivalentes(self, nome: str) -> Tuple[Optional[int], List[str]]:
+        """Cluster e nomes equivalentes de um nome qualquer; vazio se não houver outro membro"""
+        if self.indice is None or not nome:
+            return None, []
+        cluster_id = self.indice.consultar(nome)
+        membros = self.indice.membros(cluster_id) if cluster_id is not None else []
+        return cluster_id, membros if len(membros) > 1 else []
+
+    def membros(self, cluster_id: int) -> List[str]:
+        return self.indice.membros(cluster_id) if self.indice is not None else []
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'habilitado': PRODUCT_CLUSTERS_ENABLED,
+            'persistido': self.persistir,
+            'pendentes': len(self._pendentes),
+            **(self.indice.estatisticas() if self.indice is not None else {})
+        }
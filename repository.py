@@ -0,0 +1,424 @@
+# repository.py - Leituras pesadas (busca, histórico de preços, períodos do dashboard) com backend configurável
+import os
+import re
+import asyncio
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from postgrest.exceptions import APIError as PostgrestAPIError
+
+from database import db, relacao_inexistente
+from search_index import chave_produto
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg é opcional: sem ele, apenas o backend PostgREST fica disponível
+    asyncpg = None
+
+# --- Configurações ---
+# "postgrest" (padrão) ou "asyncpg" (conexão direta ao Postgres via DATABASE_URL)
+DB_BACKEND = os.getenv("DB_BACKEND", "postgrest").lower()
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_DIRECT_POOL_MIN = int(os.getenv("DB_DIRECT_POOL_MIN", "2"))
+DB_DIRECT_POOL_MAX = int(os.getenv("DB_DIRECT_POOL_MAX", "10"))
+DB_DIRECT_COMMAND_TIMEOUT = float(os.getenv("DB_DIRECT_COMMAND_TIMEOUT", "30"))
+# Atrás do pgbouncer em modo transaction os prepared statements precisam ser desligados (0)
+DB_DIRECT_STATEMENT_CACHE_SIZE = int(os.getenv("DB_DIRECT_STATEMENT_CACHE_SIZE", "256"))
+
+SEARCH_DB_LIMIT = 500
+BASKET_CURRENT_PRICES_LIMIT = 200
+# Leitor de código de barras sem o índice: códigos por consulta (tamanho da URL) e linhas por página
+BARCODE_CODIGOS_POR_CONSULTA = 50
+BARCODE_PAGE_SIZE = 500
+# Linhas por período do dashboard nos dois backends (o PostgREST já corta no max-rows do projeto, 1000 por padrão)
+DASHBOARD_PERIOD_LIMIT = int(os.getenv("DASHBOARD_PERIOD_LIMIT", "1000"))
+
+def _para_json(valor: Any) -> Any:
+    """Converte os tipos decodificados pelo asyncpg para o mesmo formato devolvido pelo PostgREST"""
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    return valor
+
+def _linha(registro: Any) -> Dict[str, Any]:
+    return {chave: _para_json(valor) for chave, valor in registro.items()}
+
+def _com_endereco(linha: Dict[str, Any]) -> Dict[str, Any]:
+    """Converte a coluna endereco_mercado da view no formato do embed supermercados(endereco)"""
+    if 'endereco_mercado' in linha:
+        linha['supermercados'] = {'endereco': linha.pop('endereco_mercado')}
+    return linha
+
+def mais_recentes(registros: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Mantém a observação mais recente de cada produto por mercado (para leituras do histórico)"""
+    atuais: Dict[Any, Dict[str, Any]] = {}
+    for registro in registros:
+        chave = chave_produto(registro)
+        atual = atuais.get(chave)
+        if atual is None or str(registro.get('data_ultima_venda') or '') > str(atual.get('data_ultima_venda') or ''):
+            atuais[chave] = registro
+    return list(atuais.values())
+
+class PostgrestRepository:
+    """Consultas pela API REST do Supabase; preços atuais vêm de current_prices quando a migração 004 existe"""
+    nome = 'postgrest'
+
+    def __init__(self):
+        # None = ainda não verificado; False = migração sql/004_current_prices.sql não aplicada
+        self.precos_atuais_disponivel: Optional[bool] = None
+
+    async def iniciar(self):
+        pass
+
+    async def fechar(self):
+        pass
+
+    async def _consultar_precos_atuais(self, montar_query, colunas: str = '*', deduplicar: bool = True) -> List[Dict[str, Any]]:
+        """
+        Executa montar_query(tabela, colunas) no snapshot current_prices ou, sem ele, no histórico
+        de produtos (deduplicado em memória, como antes; deduplicar=False para quem pagina o histórico)
+        """
+        if self.precos_atuais_disponivel is not False:
+            try:
+                response = await montar_query('current_prices_enderecos', colunas).execute()
+                self.precos_atuais_disponivel = True
+                return [_com_endereco(linha) for linha in response.data or []]
+            except PostgrestAPIError as e:
+                if not relacao_inexistente(e):
+                    raise
+                logging.warning("⚠️ current_prices não encontrada; preços atuais lidos do histórico de produtos")
+                self.precos_atuais_disponivel = False
+        response = await montar_query('produtos', '*, supermercados(endereco)').execute()
+        return mais_recentes(response.data or []) if deduplicar else response.data or []
+
+    async def buscar_produtos(self, termo: str, cnpjs: Optional[List[str]], limite: int = SEARCH_DB_LIMIT) -> List[Dict[str, Any]]:
+        def montar(tabela: str, colunas: str):
+            query = db.table(tabela).select(colunas).ilike('nome_produto_normalizado', f"%{termo}%")
+            if cnpjs:
+                query = query.in_('cnpj_supermercado', cnpjs)
+            return query.limit(limite)
+        return await self._consultar_precos_atuais(montar)
+
+    async def buscar_produtos_pagina(
+        self,
+        termo: str,
+        cnpjs: Optional[List[str]],
+        apos: Optional[Tuple[float, str]],
+        limite: int,
+        colunas: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
+        """Página de resultados ordenada por (preço, id_registro), continuando depois do cursor `apos`"""
+        def montar(tabela: str, selecao: str):
+            query = db.table(tabela).select(selecao).ilike('nome_produto_normalizado', f"%{termo}%")
+            if cnpjs:
+                query = query.in_('cnpj_supermercado', cnpjs)
+            if apos is not None:
+                preco, id_registro = apos
+                query = query.or_(f'preco_produto.gt.{preco},and(preco_produto.eq.{preco},id_registro.gt."{id_registro}")')
+            return query.order('preco_produto').order('id_registro').limit(limite)
+        # Sem o snapshot as colunas pedidas são ignoradas (o histórico usa o embed de endereço)
+        return await self._consultar_precos_atuais(montar, ','.join(colunas) if colunas else '*')
+
+    async def precos_atuais_por_nomes(self, nomes: List[str], cnpjs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Preço atual dos produtos com exatamente estes nomes normalizados (ex.: membros de um cluster)"""
+        def montar(tabela: str, colunas: str):
+            query = db.table(tabela).select(colunas).in_('nome_produto_normalizado', nomes)
+            if cnpjs:
+                query = query.in_('cnpj_supermercado', cnpjs)
+            return query.limit(BASKET_CURRENT_PRICES_LIMIT)
+        return await self._consultar_precos_atuais(montar) if nomes else []
+
+    async def precos_atuais_por_codigos(self, codigos: List[str], cnpjs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Preço atual dos produtos com estes códigos de barras (leitor de código sem o índice em memória).
+        Lotes de BARCODE_CODIGOS_POR_CONSULTA códigos em paralelo, cada um paginado até o fim.
+        """
+        async def consultar_lote(lote: List[str]) -> List[Dict[str, Any]]:
+            linhas: List[Dict[str, Any]] = []
+            while True:
+                # Offset nas linhas brutas: sem o snapshot o histórico só é deduplicado ao final
+                inicio = len(linhas)
+
+                def montar(tabela: str, colunas: str):
+                    query = db.table(tabela).select(colunas).in_('codigo_barras', lote)
+                    if cnpjs:
+                        query = query.in_('cnpj_supermercado', cnpjs)
+                    return query.order('id_registro').range(inicio, inicio + BARCODE_PAGE_SIZE - 1)
+                pagina = await self._consultar_precos_atuais(montar, deduplicar=False)
+                linhas.extend(pagina)
+                if len(pagina) < BARCODE_PAGE_SIZE:
+                    return mais_recentes(linhas) if self.precos_atuais_disponivel is False else linhas
+
+        lotes = [codigos[i:i + BARCODE_CODIGOS_POR_CONSULTA] for i in range(0, len(codigos), BARCODE_CODIGOS_POR_CONSULTA)]
+        respostas = await asyncio.gather(*(consultar_lote(lote) for lote in lotes))
+        return [linha for resposta in respostas for linha in resposta]
+
+    async def precos_atuais_cesta(
+        self,
+        itens: List[Dict[str, Any]],
+        cnpjs: List[str],
+        equivalentes: Optional[Dict[str, List[str]]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Preço atual de cada item da cesta (pelo GTIN, ou pelo nome) nos mercados informados. Itens sem
+        GTIN também trazem os nomes equivalentes de `equivalentes` (clusters de produtos sem GTIN).
+        """
+        equivalentes = equivalentes or {}
+
+        async def consultar_item(item: Dict[str, Any]) -> List[Dict[str, Any]]:
+            def montar(tabela: str, colunas: str):
+                query = db.table(tabela).select(colunas).in_('cnpj_supermercado', cnpjs)
+                if item.get('codigo_barras'):
+                    query = query.eq('codigo_barras', item['codigo_barras'])
+                else:
+                    query = query.ilike('nome_produto_normalizado', f"%{item['nome_produto'].lower().strip()}%")
+                return query.limit(BASKET_CURRENT_PRICES_LIMIT)
+            consultas = [self._consultar_precos_atuais(montar)]
+            if not item.get('codigo_barras') and equivalentes.get(item['nome_produto']):
+                consultas.append(self.precos_atuais_por_nomes(equivalentes[item['nome_produto']], cnpjs))
+            linhas: Dict[Any, Dict[str, Any]] = {}
+            for resposta in await asyncio.gather(*consultas):
+                for linha in resposta:
+                    linhas.setdefault(chave_produto(linha), linha)
+            return [{**linha, 'produto_cesta': item['nome_produto']} for linha in linhas.values()]
+
+        validos = [item for item in itens if item.get('nome_produto') or item.get('codigo_barras')]
+        respostas = await asyncio.gather(*(consultar_item(item) for item in validos))
+        return [linha for resposta in respostas for linha in resposta]
+
+    async def historico_precos(self, identificador: str, por_codigo: bool, cnpjs: List[str], inicio: date, fim: date) -> List[Dict[str, Any]]:
+        query = db.table('produtos').select('nome_supermercado, preco_produto, data_ultima_venda') \
+            .in_('cnpj_supermercado', cnpjs).gte('data_ultima_venda', str(inicio)).lte('data_ultima_venda', str(fim))
+        if por_codigo:
+            query = query.eq('codigo_barras', identificador)
+        else:
+            query = query.like('nome_produto_normalizado', f"%{identificador}%")
+        response = await query.execute()
+        return response.data or []
+
+    async def produtos_do_periodo(self, inicio: date, fim: date, cnpjs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        query = db.table('produtos').select('*').gte('data_coleta', str(inicio)).lte('data_coleta', str(fim))
+        if cnpjs:
+            query = query.in_('cnpj_supermercado', cnpjs)
+        response = await query.limit(DASHBOARD_PERIOD_LIMIT).execute()
+        return response.data or []
+
+    async def datas_com_produtos(self) -> List[date]:
+        response = await db.table('produtos').select('data_coleta').order('data_coleta', desc=True).execute()
+        return sorted({datetime.fromisoformat(item['data_coleta']).date() for item in response.data or []}, reverse=True)
+
+    async def datas_de_coleta(self) -> List[str]:
+        response = await db.table('coletas').select('iniciada_em').order('iniciada_em', desc=True).execute()
+        return sorted({coleta['iniciada_em'][:10] for coleta in response.data or []})
+
+# Consultas do backend direto; o asyncpg prepara e guarda cada texto de consulta por conexão
+SQL_BUSCAR_PRODUTOS = """
+    select p.*, s.endereco as _endereco_supermercado
+    from current_prices p
+    left join supermercados s on s.cnpj = p.cnpj_supermercado
+    where p.nome_produto_normalizado ilike $1
+      and ($2::text[] is null or p.cnpj_supermercado = any($2::text[]))
+    limit $3
+"""
+# Keyset por (preço, id_registro): cada página usa o índice current_prices_preco_keyset_idx (sql/005).
+# A seleção segue as colunas pedidas, como no PostgREST; o endereço do mercado vem do join como endereco_mercado
+SQL_BUSCAR_PRODUTOS_PAGINA = """
+    select {selecao}
+    from current_prices p
+    left join supermercados s on s.cnpj = p.cnpj_supermercado
+    where p.nome_produto_normalizado ilike $1
+      and ($2::text[] is null or p.cnpj_supermercado = any($2::text[]))
+      and ($3::numeric is null or (p.preco_produto, p.id_registro) > ($3::numeric, $4::text))
+    order by p.preco_produto, p.id_registro
+    limit $5
+"""
+SELECAO_PAGINA_PADRAO = "p.*, s.endereco as endereco_mercado"
+_COLUNA_VALIDA = re.compile(r'^[a-z_][a-z0-9_]*$')
+SQL_HISTORICO_POR_CODIGO = """
+    select nome_supermercado, preco_produto, data_ultima_venda
+    from produtos
+    where cnpj_supermercado = any($1::text[])
+      and data_ultima_venda >= $2::date and data_ultima_venda <= $3::date
+      and codigo_barras = $4
+"""
+SQL_HISTORICO_POR_NOME = """
+    select nome_supermercado, preco_produto, data_ultima_venda
+    from produtos
+    where cnpj_supermercado = any($1::text[])
+      and data_ultima_venda >= $2::date and data_ultima_venda <= $3::date
+      and nome_produto_normalizado like $4
+"""
+SQL_PRODUTOS_DO_PERIODO = """
+    select *
+    from produtos
+    where data_coleta >= $1::date and data_coleta <= $2::date
+      and ($3::text[] is null or cnpj_supermercado = any($3::text[]))
+    limit $4
+"""
+# As datas distintas são calculadas no banco em vez de trafegar uma linha por produto
+SQL_DATAS_COM_PRODUTOS = "select distinct data_coleta::date as dia from produtos order by dia desc"
+SQL_DATAS_DE_COLETA = "select distinct iniciada_em::date as dia from coletas order by dia"
+
+def _selecao_pagina(colunas: Optional[List[str]]) -> str:
+    """Lista do select da página: só as colunas pedidas (nomes já validados pela API, conferidos de novo aqui)"""
+    if not colunas:
+        return SELECAO_PAGINA_PADRAO
+    invalidas = [c for c in colunas if not _COLUNA_VALIDA.match(c)]
+    if invalidas:
+        raise ValueError(f"colunas inválidas: {invalidas}")
+    return ', '.join(
+        's.endereco as endereco_mercado' if coluna == 'endereco_mercado' else f'p.{coluna}'
+        for coluna in colunas
+    )
+
+class AsyncpgRepository:
+    """
+    Consultas direto no Postgres por um pool asyncpg: protocolo binário (numeric e date chegam
+    já decodificados, sem a dupla serialização JSON do PostgREST) e prepared statements em cache.
+    Qualquer falha do backend direto recai na consulta equivalente do PostgREST.
+    """
+    nome = 'asyncpg'
+
+    def __init__(self, dsn: str, fallback: PostgrestRepository):
+        self.dsn = dsn
+        self.fallback = fallback
+        self._pool = None
+        self.stats = {'consultas': 0, 'fallbacks': 0}
+
+    async def iniciar(self):
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                self.dsn,
+                min_size=DB_DIRECT_POOL_MIN,
+                max_size=DB_DIRECT_POOL_MAX,
+                command_timeout=DB_DIRECT_COMMAND_TIMEOUT,
+                statement_cache_size=DB_DIRECT_STATEMENT_CACHE_SIZE,
+                # Mesmo fuso das datas devolvidas pelo PostgREST
+                server_settings={'timezone': 'UTC'}
+            )
+            logging.info(f"🐘 Pool asyncpg iniciado ({DB_DIRECT_POOL_MIN}-{DB_DIRECT_POOL_MAX} conexões)")
+
+    async def fechar(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def _consultar(self, sql: str, *parametros) -> List[Any]:
+        if self._pool is None:
+            await self.iniciar()
+        self.stats['consultas'] += 1
+        async with self._pool.acquire() as conexao:
+            return await conexao.fetch(sql, *parametros)
+
+    async def _com_fallback(self, metodo: str, consulta, *args):
+        try:
+            return await consulta()
+        except Exception as e:
+            self.stats['fallbacks'] += 1
+            logging.error(f"Falha no backend asyncpg ({metodo}), usando PostgREST: {e}")
+            return await getattr(self.fallback, metodo)(*args)
+
+    async def buscar_produtos(self, termo: str, cnpjs: Optional[List[str]], limite: int = SEARCH_DB_LIMIT) -> List[Dict[str, Any]]:
+        async def consulta():
+            linhas = []
+            for registro in await self._consultar(SQL_BUSCAR_PRODUTOS, f"%{termo}%", cnpjs or None, limite):
+                linha = _linha(registro)
+                # Mesmo formato do embed supermercados(endereco) do PostgREST
+                linha['supermercados'] = {'endereco': linha.pop('_endereco_supermercado')}
+                linhas.append(linha)
+            return linhas
+        return await self._com_fallback('buscar_produtos', consulta, termo, cnpjs, limite)
+
+    async def buscar_produtos_pagina(
+        self,
+        termo: str,
+        cnpjs: Optional[List[str]],
+        apos: Optional[Tuple[float, str]],
+        limite: int,
+        colunas: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
+        async def consulta():
+            preco, id_registro = apos if apos is not None else (None, None)
+            registros = await self._consultar(
+                SQL_BUSCAR_PRODUTOS_PAGINA.format(selecao=_selecao_pagina(colunas)), f"%{termo}%", cnpjs or None,
+                Decimal(str(preco)) if preco is not None else None, id_registro, limite
+            )
+            return [_com_endereco(_linha(registro)) for registro in registros]
+        return await self._com_fallback('buscar_produtos_pagina', consulta, termo, cnpjs, apos, limite, colunas)
+
+    async def precos_atuais_por_nomes(self, nomes: List[str], cnpjs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        return await self.fallback.precos_atuais_por_nomes(nomes, cnpjs)
+
+    async def precos_atuais_por_codigos(self, codigos: List[str], cnpjs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        return await self.fallback.precos_atuais_por_codigos(codigos, cnpjs)
+
+    async def precos_atuais_cesta(
+        self,
+        itens: List[Dict[str, Any]],
+        cnpjs: List[str],
+        equivalentes: Optional[Dict[str, List[str]]] = None
+    ) -> List[Dict[str, Any]]:
+        # Poucas linhas por item: o PostgREST atende bem e reaproveita o mesmo fallback do snapshot
+        return await self.fallback.precos_atuais_cesta(itens, cnpjs, equivalentes)
+
+    async def historico_precos(self, identificador: str, por_codigo: bool, cnpjs: List[str], inicio: date, fim: date) -> List[Dict[str, Any]]:
+        async def consulta():
+            if por_codigo:
+                registros = await self._consultar(SQL_HISTORICO_POR_CODIGO, cnpjs, inicio, fim, identificador)
+            else:
+                registros = await self._consultar(SQL_HISTORICO_POR_NOME, cnpjs, inicio, fim, f"%{identificador}%")
+            return [_linha(registro) for registro in registros]
+        return await self._com_fallback('historico_precos', consulta, identificador, por_codigo, cnpjs, inicio, fim)
+
+    async def produtos_do_periodo(self, inicio: date, fim: date, cnpjs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        async def consulta():
+            registros = await self._consultar(SQL_PRODUTOS_DO_PERIODO, inicio, fim, cnpjs or None, DASHBOARD_PERIOD_LIMIT)
+            return [_linha(registro) for registro in registros]
+        return await self._com_fallback('produtos_do_periodo', consulta, inicio, fim, cnpjs)
+
+    async def datas_com_produtos(self) -> List[date]:
+        async def consulta():
+            return [registro['dia'] for registro in await self._consultar(SQL_DATAS_COM_PRODUTOS)]
+        return await self._com_fallback('datas_com_produtos', consulta)
+
+    async def datas_de_coleta(self) -> List[str]:
+        async def consulta():
+            return [registro['dia'].isoformat() for registro in await self._consultar(SQL_DATAS_DE_COLETA)]
+        return await self._com_fallback('datas_de_coleta', consulta)
+
+    def estatisticas(self) -> Dict[str, Any]:
+        pool = self._pool
+        return {
+            **self.stats,
+            'conexoes': pool.get_size() if pool is not None else 0,
+            'conexoes_livres': pool.get_idle_size() if pool is not None else 0
+        }
+
+def criar_repositorio():
+    postgrest = PostgrestRepository()
+    if DB_BACKEND != 'asyncpg':
+        return postgrest
+    if asyncpg is None or not DATABASE_URL:
+        logging.warning("DB_BACKEND=asyncpg requer o pacote asyncpg e DATABASE_URL; usando PostgREST")
+        return postgrest
+    return AsyncpgRepository(DATABASE_URL, postgrest)
+
+repositorio = criar_repositorio()
+
+async def iniciar():
+    try:
+        await repositorio.iniciar()
+    except Exception as e:
+        # O pool é recriado sob demanda na primeira consulta; até lá as leituras usam o PostgREST
+        logging.error(f"Erro ao iniciar backend {repositorio.nome}: {e}")
+
+async def fechar():
+    await repositorio.fechar()
+
+def estatisticas() -> Dict[str, Any]:
+    if isinstance(repositorio, AsyncpgRepository):
+        return {'backend': repositorio.nome, **repositorio.estatisticas()}
+    return {'backend': repositorio.nome}
@@ -0,0 +1,108 @@
+# search_cache.py - Cache LRU com TTL dos resultados processados de /api/search
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+# --- Configurações ---
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2000"))
+
+ChaveBusca = Tuple[str, Tuple[str, ...], str]
+
+class SearchResultCache:
+    """
+    Resultados já processados (status_preco, ordenação) por (termo normalizado, cnpjs ordenados, modo).
+    Mantém o índice reverso mercado -> chaves para invalidar só as buscas que envolvem os mercados
+    alterados; buscas sem filtro de mercado (todos) caem em qualquer invalidação.
+    """
+    def __init__(self, ttl_segundos: float = SEARCH_CACHE_TTL_SECONDS, max_entradas: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl_segundos = ttl_segundos
+        self.max_entradas = max_entradas
+        self._dados: "OrderedDict[ChaveBusca, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._por_mercado: Dict[str, Set[ChaveBusca]] = {}
+        self._todos_mercados: Set[ChaveBusca] = set()
+        self.stats = {'hits': 0, 'misses': 0, 'expirados': 0, 'despejos': 0, 'invalidacoes': 0}
+
+    def __len__(self) -> int:
+        return len(self._dados)
+
+    @staticmethod
+    def chave(termo: str, cnpjs: Optional[Iterable[str]], modo: str = 'exata') -> ChaveBusca:
+        # Mesma normalização da consulta ao banco (ilike com termo.lower().strip())
+        return (termo.lower().strip(), tuple(sorted(set(cnpjs))) if cnpjs else (), modo)
+
+    def _remover(self, chave: ChaveBusca):
+        if self._dados.pop(chave, None) is None:
+            return
+        if not chave[1]:
+            self._todos_mercados.discard(chave)
+        for cnpj in chave[1]:
+            chaves = self._por_mercado.get(cnpj)
+            if chaves is not None:
+                chaves.discard(chave)
+                if not chaves:
+                    del self._por_mercado[cnpj]
+
+    def obter(self, termo: str, cnpjs: Optional[Iterable[str]], modo: str = 'exata') -> Optional[Dict[str, Any]]:
+        if not SEARCH_CACHE_ENABLED:
+            return None
+        chave = self.chave(termo, cnpjs, modo)
+        entrada = self._dados.get(chave)
+        if entrada is None:
+            self.stats['misses'] += 1
+            return None
+        if time.monotonic() - entrada[0] > self.ttl_segundos:
+            self._remover(chave)
+            self.stats['expirados'] += 1
+            self.stats['misses'] += 1
+            return None
+        self._dados.move_to_end(chave)
+        self.stats['hits'] += 1
+        return entrada[1]
+
+    def guardar(self, termo: str, cnpjs: Optional[Iterable[str]], valor: Dict[str, Any], modo: str = 'exata'):
+        if not SEARCH_CACHE_ENABLED:
+            return
+        chave = self.chave(termo, cnpjs, modo)
+        self._remover(chave)
+        while len(self._dados) >= self.max_entradas:
+            # Menos usada recentemente fica no início
+            self._remover(next(iter(self._dados)))
+            self.stats['despejos'] += 1
+        self._dados[chave] = (time.monotonic(), valor)
+        if chave[1]:
+            for cnpj in chave[1]:
+                self._por_mercado.setdefault(cnpj, set()).add(chave)
+        else:
+            self._todos_mercados.add(chave)
+
+    def invalidar_mercados(self, cnpjs: Iterable[str]) -> int:
+        """Descarta as buscas que incluem algum dos mercados (e as buscas em todos os mercados)"""
+        chaves: Set[ChaveBusca] = set(self._todos_mercados)
+        for cnpj in set(cnpjs):
+            chaves |= self._por_mercado.get(cnpj, set())
+        for chave in chaves:
+            self._remover(chave)
+        self.stats['invalidacoes'] += len(chaves)
+        return len(chaves)
+
+    def limpar(self) -> int:
+        total = len(self._dados)
+        self._dados.clear()
+        self._por_mercado.clear()
+        self._todos_mercados.clear()
+        self.stats['invalidacoes'] += total
+        return total
+
+    def estatisticas(self) -> Dict[str, Any]:
+        consultas = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'habilitado': SEARCH_CACHE_ENABLED,
+            'entradas': len(self._dados),
+            'max_entradas': self.max_entradas,
+            'ttl_segundos': self.ttl_segundos,
+            'hit_rate': round(self.stats['hits'] / consultas, 4) if consultas else 0.0
+        }
@@ -0,0 +1,547 @@
+# search_index.py - Índice invertido em memória (tokens e trigramas) dos produtos mais recentes por mercado
+import os
+import re
+import time
+import heapq
+import bisect
+import asyncio
+import contextlib
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from postgrest.exceptions import APIError as PostgrestAPIError
+
+from collector_service import anotar_precos_unitarios, remover_acentos
+from database import relacao_inexistente
+from fuzzy_search import FUZZY_SEARCH_ENABLED, FuzzyNameMatcher
+
+# --- Configurações ---
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "true").lower() == "true"
+# Janela de coletas carregada no índice quando current_prices (sql/004) não existe
+SEARCH_INDEX_DAYS = int(os.getenv("SEARCH_INDEX_DAYS", "7"))
+SEARCH_INDEX_PAGE_SIZE = 1000
+# Autocompletar: prefixos com mais entradas que isto têm as sugestões memorizadas
+SUGGEST_INTERVALO_DIRETO = 256
+SUGGEST_LIMITE = 10
+# Peso de cada busca registrada em relação a cada mercado que vende o produto
+SUGGEST_PESO_BUSCA = float(os.getenv("SUGGEST_PESO_BUSCA", "0.5"))
+
+_SEPARADORES = re.compile(r'[^0-9a-z]+')
+
+def normalizar_nome(texto: Optional[str]) -> str:
+    """Mesma dobra de acentos da coleta (remover_acentos), com espaços e pontuação colapsados"""
+    return ' '.join(_SEPARADORES.split(remover_acentos(texto or ''))).strip()
+
+def _trigramas(token: str) -> Set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+def chave_produto(registro: Dict[str, Any]) -> Tuple[str, str]:
+    """Um documento por produto e mercado: GTIN quando houver, senão o nome normalizado"""
+    produto = registro.get('codigo_barras') or registro.get('nome_produto_normalizado') or ''
+    return (registro.get('cnpj_supermercado') or '', str(produto))
+
+def normalizar_gtin(codigo: Any) -> str:
+    """Só os dígitos, sem zeros à esquerda: EAN-13 lido com zero extra e UPC-12 caem na mesma chave"""
+    return ''.join(c for c in str(codigo or '') if c.isdigit()).lstrip('0')
+
+def _mais_recente(novo: Dict[str, Any], atual: Dict[str, Any]) -> bool:
+    return (str(novo.get('data_ultima_venda') or ''), str(novo.get('data_coleta') or '')) >= \
+           (str(atual.get('data_ultima_venda') or ''), str(atual.get('data_coleta') or ''))
+
+class ProductSearchIndex:
+    """
+    Guarda a observação mais recente de cada produto por mercado e indexa o nome (sem acentos)
+    por token e por trigrama. A busca intersecta as listas de trigramas de cada termo, confirma
+    a ocorrência por substring (mesma semântica do ilike '%termo%') e ordena por relevância.
+    """
+    def __init__(self):
+        self._docs: Dict[int, Dict[str, Any]] = {}
+        self._nomes: Dict[int, str] = {}
+        self._ids: Dict[Tuple[str, str], int] = {}
+        self._tokens: Dict[str, Set[int]] = {}
+        self._trigramas: Dict[str, Set[int]] = {}
+        self._docs_por_nome: Dict[str, Set[int]] = {}
+        self._docs_por_gtin: Dict[str, Set[int]] = {}
+        self._proximo_id = 0
+        self.construido_em: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    # --- Manutenção ---
+    def _indexar_nome(self, doc_id: int, nome: str):
+        self._docs_por_nome.setdefault(nome, set()).add(doc_id)
+        for token in set(nome.split()):
+            self._tokens.setdefault(token, set()).add(doc_id)
+            for trigrama in _trigramas(token):
+                self._trigramas.setdefault(trigrama, set()).add(doc_id)
+
+    def _desindexar_nome(self, doc_id: int, nome: str):
+        docs = self._docs_por_nome.get(nome)
+        if docs is not None:
+            docs.discard(doc_id)
+            if not docs:
+                del self._docs_por_nome[nome]
+        for token in set(nome.split()):
+            postings = self._tokens.get(token)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del self._tokens[token]
+            for trigrama in _trigramas(token):
+                postings = self._trigramas.get(trigrama)
+                if postings is not None:
+                    postings.discard(doc_id)
+                    if not postings:
+                        del self._trigramas[trigrama]
+
+    def adicionar(self, registros: Iterable[Dict[str, Any]]) -> int:
+        """Insere ou substitui registros, mantendo só o mais recente por produto e mercado"""
+        alterados = 0
+        for registro in registros:
+            if registro.get('preco_produto') is None:
+                continue
+            chave = chave_produto(registro)
+            doc_id = self._ids.get(chave)
+            if doc_id is not None and not _mais_recente(registro, self._docs[doc_id]):
+                continue
+            if 'supermercados' not in registro and registro.get('endereco_supermercado'):
+                # Mesmo formato do embed supermercados(endereco) da consulta ao banco
+                registro = {**registro, 'supermercados': {'endereco': registro['endereco_supermercado']}}
+
+            nome = normalizar_nome(registro.get('nome_produto_normalizado') or registro.get('nome_produto'))
+            if doc_id is None:
+                doc_id = self._proximo_id
+                self._proximo_id += 1
+                self._ids[chave] = doc_id
+                # O GTIN faz parte da chave do documento: só precisa ser indexado na criação
+                gtin = normalizar_gtin(registro.get('codigo_barras'))
+                if gtin:
+                    self._docs_por_gtin.setdefault(gtin, set()).add(doc_id)
+            elif self._nomes[doc_id] != nome:
+                self._desindexar_nome(doc_id, self._nomes[doc_id])
+            else:
+                self._docs[doc_id] = registro
+                alterados += 1
+                continue
+
+            self._docs[doc_id] = registro
+            self._nomes[doc_id] = nome
+            self._indexar_nome(doc_id, nome)
+            alterados += 1
+        return alterados
+
+    # --- Consulta ---
+    def _candidatos(self, termos: List[str]) -> Optional[Set[int]]:
+        """Interseção das listas de trigramas dos termos com 3+ caracteres (None = sem filtro possível)"""
+        candidatos: Optional[Set[int]] = None
+        for termo in sorted(termos, key=len, reverse=True):
+            for trigrama in _trigramas(termo):
+                postings = self._trigramas.get(trigrama)
+                if not postings:
+                    return set()
+                candidatos = set(postings) if candidatos is None else candidatos & postings
+                if not candidatos:
+                    return candidatos
+        return candidatos
+
+    @staticmethod
+    def _relevancia(nome: str, consulta: str, termos: List[str]) -> float:
+        palavras = nome.split()
+        pontos = 0.0
+        if nome == consulta:
+            pontos += 8
+        elif nome.startswith(consulta):
+            pontos += 4
+        elif consulta in nome:
+            pontos += 2
+        pontos += sum(1.5 for termo in termos if termo in palavras)
+        pontos += sum(0.5 for termo in termos if any(p.startswith(termo) for p in palavras))
+        # Nomes mais curtos são mais específicos para o termo
+        return pontos - len(palavras) * 0.05
+
+    def buscar(self, consulta: str, cnpjs: Optional[Iterable[str]] = None, limite: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Registros que contêm todos os termos, do mais relevante ao menos; empate pelo menor preço"""
+        consulta = normalizar_nome(consulta)
+        termos = consulta.split()
+        if not termos:
+            return []
+        filtro_cnpjs = set(cnpjs) if cnpjs else None
+
+        candidatos = self._candidatos([t for t in termos if len(t) >= 3])
+        if candidatos is None:
+            # Só termos curtos: percorre o vocabulário de tokens em vez de todos os documentos
+            candidatos = set()
+            for token, postings in self._tokens.items():
+                if termos[0] in token:
+                    candidatos |= postings
+
+        encontrados = []
+        for doc_id in candidatos:
+            registro = self._docs[doc_id]
+            if filtro_cnpjs is not None and registro.get('cnpj_supermercado') not in filtro_cnpjs:
+                continue
+            nome = self._nomes[doc_id]
+            if all(termo in nome for termo in termos):
+                encontrados.append((self._relevancia(nome, consulta, termos), registro))
+
+        encontrados.sort(key=lambda item: (-item[0], float(item[1].get('preco_produto') or 0)))
+        if limite:
+            encontrados = encontrados[:limite]
+        return [{**registro, 'relevancia': round(pontos, 2)} for pontos, registro in encontrados]
+
+    def nomes(self) -> List[str]:
+        return list(self._docs_por_nome)
+
+    def por_gtin(self, gtin: str, cnpjs: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """Preço mais recente do GTIN em cada mercado, do mais barato ao mais caro"""
+        filtro_cnpjs = set(cnpjs) if cnpjs else None
+        # Grafias diferentes do mesmo código (com e sem zero à esquerda) são documentos distintos
+        por_mercado: Dict[str, Dict[str, Any]] = {}
+        for doc_id in self._docs_por_gtin.get(normalizar_gtin(gtin), ()):
+            registro = self._docs[doc_id]
+            cnpj = registro.get('cnpj_supermercado') or ''
+            if filtro_cnpjs is not None and cnpj not in filtro_cnpjs:
+                continue
+            if cnpj not in por_mercado or _mais_recente(registro, por_mercado[cnpj]):
+                por_mercado[cnpj] = registro
+        return sorted(por_mercado.values(), key=lambda r: float(r.get('preco_produto') or 0))
+
+    def registros_por_nome(self, pontuacoes: List[Tuple[str, float]], cnpjs: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """Registros dos nomes pontuados (busca aproximada), com a pontuação como relevância"""
+        filtro_cnpjs = set(cnpjs) if cnpjs else None
+        encontrados = []
+        for nome, pontos in pontuacoes:
+            for doc_id in self._docs_por_nome.get(nome, ()):
+                registro = self._docs[doc_id]
+                if filtro_cnpjs is None or registro.get('cnpj_supermercado') in filtro_cnpjs:
+                    encontrados.append({**registro, 'relevancia': round(pontos * 10, 2)})
+        return encontrados
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            'documentos': len(self._docs),
+            'tokens': len(self._tokens),
+            'trigramas': len(self._trigramas),
+            'gtins': len(self._docs_por_gtin),
+            'construido_em': self.construido_em
+        }
+
+class SuggestionIndex:
+    """
+    Autocompletar por prefixo com busca binária em um vetor ordenado de (chave, nome). Cada nome
+    entra uma vez por palavra (o sufixo que começa nela), de modo que 'joao' sugere 'arroz tio joao'.
+    Peso: mercados que vendem o produto + popularidade nas buscas registradas. Os termos mais
+    buscados com resultados também são sugeridos. Prefixos com muitos nomes têm as melhores
+    sugestões memorizadas; os demais são resolvidos na hora sobre um intervalo pequeno.
+    """
+    def __init__(self):
+        self._entradas: List[Tuple[str, str]] = []
+        self._termos: List[Tuple[str, str]] = []
+        self._mercados: Dict[str, Set[str]] = {}
+        self._exibicao: Dict[str, str] = {}
+        self._popularidade: Dict[str, float] = {}
+        self._buscas: Dict[str, int] = {}
+        self._memo: Dict[str, List[Tuple[float, str, str]]] = {}
+        # Nomes adicionados enquanto o pré-cálculo roda em outra thread (reaplicados ao final)
+        self._novos_durante_pre_calculo: Optional[List[str]] = None
+
+    def __len__(self) -> int:
+        return len(self._mercados)
+
+    @staticmethod
+    def _sufixos(nome: str) -> List[Tuple[str, str]]:
+        palavras = nome.split()
+        return [(' '.join(palavras[i:]), nome) for i in range(len(palavras))]
+
+    def _candidato(self, nome: str) -> Tuple[float, str, str]:
+        if nome in self._buscas:
+            return (SUGGEST_PESO_BUSCA * self._buscas[nome] + 1, nome, 'busca')
+        return (len(self._mercados.get(nome, ())) + SUGGEST_PESO_BUSCA * self._popularidade.get(nome, 0), nome, 'produto')
+
+    @staticmethod
+    def _melhores(candidatos: Iterable[Tuple[float, str, str]], limite: int) -> List[Tuple[float, str, str]]:
+        # Empate: o nome mais curto é o mais genérico
+        return heapq.nlargest(limite, candidatos, key=lambda c: (c[0], -len(c[1])))
+
+    def _memorizar_nome(self, memo: Dict[str, List[Tuple[float, str, str]]], nome: str):
+        """Atualiza as listas memorizadas dos prefixos do nome sem refazer o pré-cálculo"""
+        candidato = self._candidato(nome)
+        for chave, _ in self._sufixos(nome):
+            for tamanho in range(1, len(chave) + 1):
+                lista = memo.get(chave[:tamanho])
+                if lista is not None:
+                    memo[chave[:tamanho]] = self._melhores([c for c in lista if c[1] != nome] + [candidato], SUGGEST_LIMITE)
+
+    def adicionar(self, registros: Iterable[Dict[str, Any]], incremental: bool = True) -> int:
+        """Nomes novos entram por inserção ordenada (na carga completa, por um único sort no final)"""
+        novos = 0
+        for registro in registros:
+            nome = normalizar_nome(registro.get('nome_produto_normalizado') or registro.get('nome_produto'))
+            if not nome:
+                continue
+            mercados = self._mercados.get(nome)
+            if mercados is None:
+                mercados = self._mercados[nome] = set()
+                self._exibicao[nome] = registro.get('nome_produto') or nome
+                for entrada in self._sufixos(nome):
+                    if incremental:
+                        bisect.insort(self._entradas, entrada)
+                    else:
+                        self._entradas.append(entrada)
+                novos += 1
+            mercados.add(registro.get('cnpj_supermercado') or '')
+            if incremental:
+                self._memorizar_nome(self._memo, nome)
+                if self._novos_durante_pre_calculo is not None:
+                    self._novos_durante_pre_calculo.append(nome)
+        if not incremental:
+            self._entradas.sort()
+        return novos
+
+    def definir_popularidade(self, popularidade: Dict[str, float], buscas: Dict[str, int]):
+        """Troca os pesos de popularidade; as listas memorizadas são refeitas por pre_calcular()"""
+        self._popularidade = popularidade
+        self._buscas = buscas
+        self._termos = sorted(entrada for termo in buscas for entrada in self._sufixos(termo))
+
+    @staticmethod
+    def _intervalo(entradas: List[Tuple[str, str]], prefixo: str) -> List[Tuple[str, str]]:
+        return entradas[bisect.bisect_left(entradas, (prefixo,)):bisect.bisect_left(entradas, (prefixo + '\uffff',))]
+
+    def _calcular(self, prefixo: str, limite: int) -> List[Tuple[float, str, str]]:
+        nomes = {nome for _, nome in self._intervalo(self._entradas, prefixo)}
+        nomes |= {termo for _, termo in self._intervalo(self._termos, prefixo)}
+        return self._melhores(map(self._candidato, nomes), limite)
+
+    def pre_calcular(self):
+        """
+        Memoriza as melhores sugestões de cada prefixo cujo intervalo passa de SUGGEST_INTERVALO_DIRETO,
+        de baixo para cima: as melhores de um prefixo estão entre as melhores de seus filhos.
+        """
+        self._novos_durante_pre_calculo = []
+        entradas = sorted(self._entradas + self._termos)
+        memo: Dict[str, List[Tuple[float, str, str]]] = {}
+
+        def visitar(inicio: int, fim: int, prefixo: str) -> List[Tuple[float, str, str]]:
+            if fim - inicio <= SUGGEST_INTERVALO_DIRETO:
+                return self._melhores(map(self._candidato, {nome for _, nome in entradas[inicio:fim]}), SUGGEST_LIMITE)
+            # Chaves iguais ao prefixo vêm primeiro no intervalo; depois, um subintervalo por próximo caractere
+            i = inicio
+            while i < fim and len(entradas[i][0]) == len(prefixo):
+                i += 1
+            candidatos = {nome: self._candidato(nome) for _, nome in entradas[inicio:i]}
+            while i < fim:
+                filho = entradas[i][0][:len(prefixo) + 1]
+                j = bisect.bisect_left(entradas, (filho + '\uffff',), i, fim)
+                for candidato in visitar(i, j, filho):
+                    candidatos[candidato[1]] = candidato
+                i = j
+            melhores = self._melhores(candidatos.values(), SUGGEST_LIMITE)
+            memo[prefixo] = melhores
+            return melhores
+
+        visitar(0, len(entradas), '')
+        for nome in self._novos_durante_pre_calculo:
+            self._memorizar_nome(memo, nome)
+        self._memo = memo
+        self._novos_durante_pre_calculo = None
+
+    def sugerir(self, prefixo: str, limite: int = SUGGEST_LIMITE) -> List[Dict[str, Any]]:
+        # Mantém o espaço final: 'arroz ' só sugere nomes com outra palavra depois de 'arroz'
+        prefixo = normalizar_nome(prefixo) + (' ' if prefixo.endswith(' ') and prefixo.strip() else '')
+        if not prefixo:
+            return []
+        melhores = self._memo.get(prefixo) if limite <= SUGGEST_LIMITE else None
+        if melhores is None:
+            melhores = self._calcular(prefixo, limite)
+        return [
+            {'texto': self._exibicao.get(nome, nome) if tipo == 'produto' else nome, 'tipo': tipo, 'peso': round(peso, 2)}
+            for peso, nome, tipo in melhores[:limite]
+        ]
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            'nomes': len(self._mercados),
+            'entradas': len(self._entradas),
+            'termos_populares': len(self._buscas),
+            'prefixos_memorizados': len(self._memo)
+        }
+
+class SearchIndexManager:
+    """
+    Carrega o índice a partir do snapshot current_prices (ou, sem a migração, das coletas dos últimos
+    SEARCH_INDEX_DAYS dias) em background e troca a instância de uma vez; registros novos da coleta e
+    das buscas em tempo real entram incrementalmente.
+    """
+    def __init__(self, supabase_client: Any, dias: int = SEARCH_INDEX_DAYS):
+        self.supabase_client = supabase_client
+        self.dias = dias
+        self.indice: Optional[ProductSearchIndex] = None
+        self.sugestoes: Optional[SuggestionIndex] = None
+        self.aproximada: Optional[FuzzyNameMatcher] = None
+        self._lock = asyncio.Lock()
+        # Incrementos recebidos durante uma recarga: reaplicados no índice novo antes de publicá-lo
+        self._pendentes: Optional[List[List[Dict[str, Any]]]] = None
+        self.stats = {'buscas': 0, 'buscas_aproximadas': 0, 'sugestoes': 0, 'consultas_gtin': 0, 'recargas': 0, 'incrementos': 0, 'tempo_recarga_segundos': 0.0}
+
+    @property
+    def pronto(self) -> bool:
+        return SEARCH_INDEX_ENABLED and self.indice is not None
+
+    async def _paginar(self, montar_query) -> List[Dict[str, Any]]:
+        registros: List[Dict[str, Any]] = []
+        inicio = 0
+        while True:
+            response = await montar_query().range(inicio, inicio + SEARCH_INDEX_PAGE_SIZE - 1).execute()
+            lote = response.data or []
+            registros.extend(lote)
+            if len(lote) < SEARCH_INDEX_PAGE_SIZE:
+                return registros
+            inicio += SEARCH_INDEX_PAGE_SIZE
+
+    async def _carregar_registros(self) -> List[Dict[str, Any]]:
+        try:
+            # O snapshot já tem uma linha por produto e mercado, sem limite de janela
+            registros = await self._paginar(lambda: (
+                self.supabase_client.table('current_prices_enderecos')
+                .select('*')
+                .order('produto_chave')
+                .order('cnpj_supermercado')
+            ))
+            for registro in registros:
+                registro['supermercados'] = {'endereco': registro.pop('endereco_mercado', None)}
+            return registros
+        except PostgrestAPIError as e:
+            if not relacao_inexistente(e):
+                raise
+
+        desde = time.strftime('%Y-%m-%d', time.localtime(time.time() - self.dias * 86400))
+        return await self._paginar(lambda: (
+            self.supabase_client.table('produtos')
+            .select('*, supermercados(endereco)')
+            .gte('data_coleta', desde)
+            .order('id_registro')
+        ))
+
+    @contextlib.asynccontextmanager
+    async def _recarga(self):
+        """Uma recarga por vez; enquanto ela dura, os incrementos também ficam guardados para o índice novo"""
+        async with self._lock:
+            self._pendentes = []
+            try:
+                yield
+            finally:
+                self._pendentes = None
+
+    async def recarregar(self):
+        """Reconstrói o índice completo fora do event loop e o publica quando pronto"""
+        if not SEARCH_INDEX_ENABLED:
+            return
+        async with self._recarga():
+            inicio = time.perf_counter()
+            registros = await self._carregar_registros()
+
+            def construir() -> Tuple[ProductSearchIndex, SuggestionIndex, Optional[FuzzyNameMatcher]]:
+                # Linhas gravadas antes da migração 008 ganham o preço por unidade base aqui, uma vez por carga
+                anotar_precos_unitarios([r for r in registros if r.get('unidade_base') is None])
+                indice = ProductSearchIndex()
+                indice.adicionar(registros)
+                indice.construido_em = time.time()
+                sugestoes = SuggestionIndex()
+                sugestoes.adicionar(registros, incremental=False)
+                if self.sugestoes is not None:
+                    sugestoes.definir_popularidade(self.sugestoes._popularidade, self.sugestoes._buscas)
+                sugestoes.pre_calcular()
+                aproximada = None
+                if FUZZY_SEARCH_ENABLED:
+                    aproximada = FuzzyNameMatcher()
+                    aproximada.construir(indice.nomes())
+                return indice, sugestoes, aproximada
+
+            indice, sugestoes, aproximada = await asyncio.to_thread(construir)
+            # O snapshot lido pode não ter as vendas que chegaram durante a construção
+            for pendentes in self._pendentes:
+                self._aplicar(indice, sugestoes, aproximada, pendentes)
+            self.indice, self.sugestoes, self.aproximada = indice, sugestoes, aproximada
+            duracao = time.perf_counter() - inicio
+            self.stats['recargas'] += 1
+            self.stats['tempo_recarga_segundos'] = round(duracao, 2)
+            logging.info(f"🔎 Índice de busca carregado: {len(self.indice)} produtos de {len(registros)} registros em {duracao:.1f}s")
+
+    def _aplicar(self, indice: ProductSearchIndex, sugestoes: SuggestionIndex, aproximada: Optional[FuzzyNameMatcher], registros: List[Dict[str, Any]]):
+        self.stats['incrementos'] += indice.adicionar(registros)
+        sugestoes.adicionar(registros)
+        if aproximada is not None:
+            aproximada.adicionar(
+                normalizar_nome(r.get('nome_produto_normalizado') or r.get('nome_produto')) for r in registros
+            )
+
+    def adicionar(self, registros: List[Dict[str, Any]]):
+        """Atualização incremental (fim da coleta de um mercado, resultados em tempo real)"""
+        if not registros:
+            return
+        if self._pendentes is not None:
+            self._pendentes.append(list(registros))
+        if self.indice is not None:
+            self._aplicar(self.indice, self.sugestoes, self.aproximada, registros)
+
+    async def atualizar_popularidade(self, buscas: Dict[str, int]):
+        """
+        Pondera as sugestões pelas buscas registradas: cada termo soma sua contagem aos produtos que
+        ele encontra, e termos com resultado viram sugestões. Roda no event loop, cedendo a cada termo,
+        porque o índice também é alterado pelo loop.
+        """
+        if self.indice is None:
+            return
+        popularidade: Dict[str, float] = {}
+        com_resultado: Dict[str, int] = {}
+        for termo, contagem in buscas.items():
+            termo = normalizar_nome(termo)
+            encontrados = self.indice.buscar(termo) if termo else []
+            if encontrados:
+                com_resultado[termo] = com_resultado.get(termo, 0) + contagem
+            for registro in encontrados:
+                nome = normalizar_nome(registro.get('nome_produto_normalizado') or registro.get('nome_produto'))
+                popularidade[nome] = popularidade.get(nome, 0) + contagem
+            await asyncio.sleep(0)
+        self.sugestoes.definir_popularidade(popularidade, com_resultado)
+        await asyncio.to_thread(self.sugestoes.pre_calcular)
+        logging.info(f"🔤 Sugestões ponderadas por {len(com_resultado)} termos buscados")
+
+    def buscar_aproximado(self, consulta: str, cnpjs: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """Busca tolerante a erros de digitação (n-gramas); vazia se numpy/scipy não estiverem disponíveis"""
+        if self.aproximada is None:
+            return []
+        self.stats['buscas_aproximadas'] += 1
+        return self.indice.registros_por_nome(self.aproximada.buscar(normalizar_nome(consulta)), cnpjs)
+
+    def sugerir(self, prefixo: str, limite: int = SUGGEST_LIMITE) -> List[Dict[str, Any]]:
+        self.stats['sugestoes'] += 1
+        return self.sugestoes.sugerir(prefixo, limite)
+
+    def buscar(self, consulta: str, cnpjs: Optional[Iterable[str]] = None, limite: Optional[int] = None) -> List[Dict[str, Any]]:
+        self.stats['buscas'] += 1
+        return self.indice.buscar(consulta, cnpjs, limite)
+
+    def buscar_gtins(self, gtins: Iterable[str], cnpjs: Optional[Iterable[str]] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Preços atuais por mercado de cada GTIN (leitura de lista de compras), sem ir ao banco"""
+        cnpjs = set(cnpjs) if cnpjs else None
+        resultados = {gtin: self.indice.por_gtin(gtin, cnpjs) for gtin in gtins}
+        self.stats['consultas_gtin'] += len(resultados)
+        return resultados
+
+    async def iniciar(self):
+        try:
+            await self.recarregar()
+        except Exception as e:
+            logging.error(f"Erro ao carregar índice de busca (buscas seguem no banco): {e}")
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'habilitado': SEARCH_INDEX_ENABLED,
+            **(self.indice.estatisticas() if self.indice is not None else {'documentos': 0}),
+            'sugestoes_indice': self.sugestoes.estatisticas() if self.sugestoes is not None else None,
+            'busca_aproximada': self.aproximada.estatisticas() if self.aproximada is not None else None
+        }
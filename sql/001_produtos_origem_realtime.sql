@@ -0,0 +1,8 @@
+-- Permite gravar em produtos os resultados das buscas em tempo real (write-back).
+-- Registros de tempo real não pertencem a nenhuma coleta e são marcados com origem 'realtime'.
+
+alter table produtos alter column coleta_id drop not null;
+
+alter table produtos add column if not exists origem text not null default 'coleta';
+
+create index if not exists idx_produtos_origem on produtos (origem);
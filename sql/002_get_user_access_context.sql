@@ -0,0 +1,48 @@
+-- Contexto de acesso de um usuário em uma única chamada: perfil (role, páginas),
+-- grupos gerenciados como subadmin e todas as associações a grupos com as datas de expiração.
+-- A classificação em grupos ativos/expirados é feita na aplicação (dependencies._avaliar_acesso).
+
+create or replace function get_user_access_context(p_user_id uuid)
+returns jsonb
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    select jsonb_build_object(
+        'profile_exists', p.id is not null,
+        'role', coalesce(p.role, 'user'),
+        'full_name', p.full_name,
+        'allowed_pages', coalesce(to_jsonb(p.allowed_pages), '[]'::jsonb),
+        'managed_groups', coalesce(
+            (select to_jsonb(ga.group_ids) from group_admins ga where ga.user_id = p_user_id limit 1),
+            '[]'::jsonb
+        ),
+        'memberships', coalesce(
+            (
+                select jsonb_agg(
+                    jsonb_build_object(
+                        'user_group_id', ug.id,
+                        'group_id', g.id,
+                        'group_name', g.nome,
+                        'dias_acesso', g.dias_acesso,
+                        'grupo_ativo', g.ativo,
+                        'data_expiracao_user', ug.data_expiracao,
+                        'data_expiracao_grupo', g.data_expiracao_grupo
+                    )
+                    order by ug.data_expiracao desc
+                )
+                from user_groups ug
+                join grupos g on g.id = ug.group_id
+                where ug.user_id = p_user_id
+            ),
+            '[]'::jsonb
+        )
+    )
+    from (select 1) as base
+    left join profiles p on p.id = p_user_id;
+$$;
+
+-- Apenas o backend (service role) resolve o contexto de qualquer usuário
+revoke execute on function get_user_access_context(uuid) from public, anon, authenticated;
+grant execute on function get_user_access_context(uuid) to service_role;
@@ -0,0 +1,162 @@
+-- Acesso efetivo materializado por usuário: uma linha por usuário com a decisão de acesso e a data
+-- em que ela expira. Recalculado por refresh_user_access (mutações e recarga periódica) e varrido
+-- por sweep_expired_user_access (access_sweeper.py), de modo que a requisição só lê uma chave.
+
+create table if not exists user_access (
+    user_id uuid primary key references profiles(id) on delete cascade,
+    has_access boolean not null default false,
+    -- Último dia de acesso entre os grupos ativos; null = algum grupo ativo não expira
+    access_expires_at date,
+    active_groups integer not null default 0,
+    expired_groups integer not null default 0,
+    computed_at timestamptz not null default now()
+);
+
+-- A varredura só percorre quem ainda tem acesso e já passou da data
+create index if not exists user_access_expiracao_idx on user_access (access_expires_at) where has_access;
+
+alter table user_access enable row level security;
+
+-- Recalcula o acesso de um usuário (p_user_id) ou de todos (null); retorna quantas linhas gravou
+create or replace function refresh_user_access(p_user_id uuid default null)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_total integer;
+begin
+    with associacoes as (
+        select
+            ug.user_id,
+            (
+                coalesce(g.ativo, true)
+                and (g.data_expiracao_grupo is null or g.data_expiracao_grupo::date >= current_date)
+                and (ug.data_expiracao is null or ug.data_expiracao::date >= current_date)
+            ) as ativa,
+            case
+                when g.data_expiracao_grupo is null then ug.data_expiracao::date
+                when ug.data_expiracao is null then g.data_expiracao_grupo::date
+                else least(ug.data_expiracao::date, g.data_expiracao_grupo::date)
+            end as expira_em
+        from user_groups ug
+        join grupos g on g.id = ug.group_id
+        where p_user_id is null or ug.user_id = p_user_id
+    ),
+    calculado as (
+        select
+            p.id as user_id,
+            coalesce(bool_or(a.ativa), false) as has_access,
+            case
+                when bool_or(a.ativa and a.expira_em is null) then null
+                else max(a.expira_em) filter (where a.ativa)
+            end as access_expires_at,
+            count(a.user_id) filter (where a.ativa) as active_groups,
+            count(a.user_id) filter (where not a.ativa) as expired_groups
+        from profiles p
+        left join associacoes a on a.user_id = p.id
+        where p_user_id is null or p.id = p_user_id
+        group by p.id
+    )
+    insert into user_access (user_id, has_access, access_expires_at, active_groups, expired_groups, computed_at)
+    select user_id, has_access, access_expires_at, active_groups, expired_groups, now()
+    from calculado
+    on conflict (user_id) do update set
+        has_access = excluded.has_access,
+        access_expires_at = excluded.access_expires_at,
+        active_groups = excluded.active_groups,
+        expired_groups = excluded.expired_groups,
+        computed_at = excluded.computed_at;
+
+    get diagnostics v_total = row_count;
+    return v_total;
+end;
+$$;
+
+-- Desativa o acesso de quem passou da data de expiração e devolve os usuários afetados
+-- (a aplicação descarta o perfil deles do cache). As associações em user_groups não são
+-- alteradas: renovações apenas movem data_expiracao e o próximo refresh reativa o acesso.
+create or replace function sweep_expired_user_access()
+returns table (user_id uuid)
+language sql
+security definer
+set search_path = public
+as $$
+    update user_access
+    set has_access = false,
+        expired_groups = expired_groups + active_groups,
+        active_groups = 0,
+        computed_at = now()
+    where has_access
+      and access_expires_at < current_date
+    returning user_access.user_id;
+$$;
+
+-- Contexto de acesso com a linha materializada. Com p_memberships = false as associações só são
+-- agregadas quando o usuário ainda não tem linha em user_access.
+drop function if exists get_user_access_context(uuid);
+
+create or replace function get_user_access_context(p_user_id uuid, p_memberships boolean default true)
+returns jsonb
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    select jsonb_build_object(
+        'profile_exists', p.id is not null,
+        'role', coalesce(p.role, 'user'),
+        'full_name', p.full_name,
+        'allowed_pages', coalesce(to_jsonb(p.allowed_pages), '[]'::jsonb),
+        'managed_groups', coalesce(
+            (select to_jsonb(ga.group_ids) from group_admins ga where ga.user_id = p_user_id limit 1),
+            '[]'::jsonb
+        ),
+        'access', (
+            select jsonb_build_object(
+                'has_access', ua.has_access,
+                'access_expires_at', ua.access_expires_at,
+                'active_groups', ua.active_groups,
+                'expired_groups', ua.expired_groups
+            )
+            from user_access ua
+            where ua.user_id = p_user_id
+        ),
+        'memberships', case
+            when p_memberships or not exists (select 1 from user_access ua where ua.user_id = p_user_id) then coalesce(
+                (
+                    select jsonb_agg(
+                        jsonb_build_object(
+                            'user_group_id', ug.id,
+                            'group_id', g.id,
+                            'group_name', g.nome,
+                            'dias_acesso', g.dias_acesso,
+                            'grupo_ativo', g.ativo,
+                            'data_expiracao_user', ug.data_expiracao,
+                            'data_expiracao_grupo', g.data_expiracao_grupo
+                        )
+                        order by ug.data_expiracao desc
+                    )
+                    from user_groups ug
+                    join grupos g on g.id = ug.group_id
+                    where ug.user_id = p_user_id
+                ),
+                '[]'::jsonb
+            )
+            else '[]'::jsonb
+        end
+    )
+    from (select 1) as base
+    left join profiles p on p.id = p_user_id;
+$$;
+
+revoke execute on function get_user_access_context(uuid, boolean) from public, anon, authenticated;
+grant execute on function get_user_access_context(uuid, boolean) to service_role;
+revoke execute on function refresh_user_access(uuid) from public, anon, authenticated;
+grant execute on function refresh_user_access(uuid) to service_role;
+revoke execute on function sweep_expired_user_access() from public, anon, authenticated;
+grant execute on function sweep_expired_user_access() to service_role;
+
+-- Carga inicial
+select refresh_user_access(null);
@@ -0,0 +1,177 @@
+-- Preço atual por produto e mercado: só a observação mais recente (data_ultima_venda) de cada
+-- (produto_chave, cnpj_supermercado). Mantida por triggers em produtos, de modo que todo upsert
+-- (coleta completa e write-back do tempo real) atualiza o snapshot no mesmo comando.
+-- produto_chave = GTIN quando houver, senão o nome normalizado (mesma chave do índice de busca).
+
+create extension if not exists pg_trgm;
+
+-- Mesmos tipos de coluna de produtos
+create table if not exists current_prices as
+select
+    coalesce(nullif(codigo_barras, ''), nome_produto_normalizado) as produto_chave,
+    cnpj_supermercado,
+    nome_supermercado,
+    nome_produto,
+    nome_produto_normalizado,
+    codigo_barras,
+    preco_produto,
+    unidade_medida,
+    tipo_unidade,
+    data_ultima_venda,
+    data_coleta,
+    endereco_supermercado,
+    id_registro
+from produtos
+with no data;
+
+alter table current_prices add primary key (produto_chave, cnpj_supermercado);
+create index if not exists current_prices_nome_trgm_idx on current_prices using gin (nome_produto_normalizado gin_trgm_ops);
+create index if not exists current_prices_codigo_barras_idx on current_prices (codigo_barras);
+
+create or replace function sync_current_prices()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    -- distinct on: um mesmo comando pode trazer várias observações do mesmo produto e mercado
+    insert into current_prices (
+        produto_chave, cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro
+    )
+    select distinct on (produto_chave, cnpj_supermercado) *
+    from (
+        select
+            coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) as produto_chave,
+            n.cnpj_supermercado, n.nome_supermercado, n.nome_produto, n.nome_produto_normalizado,
+            n.codigo_barras, n.preco_produto, n.unidade_medida, n.tipo_unidade, n.data_ultima_venda, n.data_coleta,
+            n.endereco_supermercado, n.id_registro
+        from novos n
+        where n.preco_produto is not null
+          and coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) is not null
+    ) as observacoes
+    order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+    on conflict (produto_chave, cnpj_supermercado) do update set
+        nome_supermercado = excluded.nome_supermercado,
+        nome_produto = excluded.nome_produto,
+        nome_produto_normalizado = excluded.nome_produto_normalizado,
+        codigo_barras = excluded.codigo_barras,
+        preco_produto = excluded.preco_produto,
+        unidade_medida = excluded.unidade_medida,
+        tipo_unidade = excluded.tipo_unidade,
+        data_ultima_venda = excluded.data_ultima_venda,
+        data_coleta = excluded.data_coleta,
+        endereco_supermercado = coalesce(excluded.endereco_supermercado, current_prices.endereco_supermercado),
+        id_registro = excluded.id_registro
+    where (excluded.data_ultima_venda, excluded.data_coleta) >= (current_prices.data_ultima_venda, current_prices.data_coleta)
+       or current_prices.data_ultima_venda is null;
+    return null;
+end;
+$$;
+
+drop trigger if exists produtos_current_prices_insert on produtos;
+create trigger produtos_current_prices_insert
+    after insert on produtos
+    referencing new table as novos
+    for each statement execute function sync_current_prices();
+
+drop trigger if exists produtos_current_prices_update on produtos;
+create trigger produtos_current_prices_update
+    after update on produtos
+    referencing new table as novos
+    for each statement execute function sync_current_prices();
+
+-- Exclusões em produtos (limpeza por coletas, exclusão de coleta em cascata) também atualizam o
+-- snapshot: quando a linha apagada era o preço atual de um (produto_chave, cnpj_supermercado), a
+-- chave é recalculada a partir das observações restantes, ou removida se não sobrar nenhuma.
+create index if not exists current_prices_id_registro_idx on current_prices (id_registro);
+-- Recalcular uma chave lê só as observações dela, mais recentes primeiro
+create index if not exists produtos_produto_chave_idx on produtos (
+    (coalesce(nullif(codigo_barras, ''), nome_produto_normalizado)), cnpj_supermercado, data_ultima_venda desc
+);
+
+create or replace function sync_current_prices_delete()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_chaves text[];
+    v_cnpjs text[];
+begin
+    -- Só as chaves cujo preço atual foi apagado mudam; as demais continuam com a observação vigente
+    with removidas as (
+        delete from current_prices cp
+        using removidos r
+        where cp.id_registro = r.id_registro
+        returning cp.produto_chave, cp.cnpj_supermercado
+    )
+    select array_agg(produto_chave), array_agg(cnpj_supermercado) into v_chaves, v_cnpjs
+    from removidas;
+
+    if v_chaves is null then
+        return null;
+    end if;
+
+    insert into current_prices (
+        produto_chave, cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro
+    )
+    select distinct on (produto_chave, cnpj_supermercado) *
+    from (
+        select
+            c.produto_chave,
+            n.cnpj_supermercado, n.nome_supermercado, n.nome_produto, n.nome_produto_normalizado,
+            n.codigo_barras, n.preco_produto, n.unidade_medida, n.tipo_unidade, n.data_ultima_venda, n.data_coleta,
+            n.endereco_supermercado, n.id_registro
+        from unnest(v_chaves, v_cnpjs) as c (produto_chave, cnpj_supermercado)
+        join produtos n
+          on coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) = c.produto_chave
+         and n.cnpj_supermercado = c.cnpj_supermercado
+        where n.preco_produto is not null
+    ) as observacoes
+    order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+    on conflict (produto_chave, cnpj_supermercado) do nothing;
+    return null;
+end;
+$$;
+
+drop trigger if exists produtos_current_prices_delete on produtos;
+create trigger produtos_current_prices_delete
+    after delete on produtos
+    referencing old table as removidos
+    for each statement execute function sync_current_prices_delete();
+
+-- Leitura com o endereço do cadastro de mercados (equivalente ao embed supermercados(endereco))
+create or replace view current_prices_enderecos as
+select cp.*, s.endereco as endereco_mercado
+from current_prices cp
+left join supermercados s on s.cnpj = cp.cnpj_supermercado;
+
+grant select on current_prices, current_prices_enderecos to anon, authenticated;
+
+-- Somente leitura pela API: o snapshot só é escrito pelos triggers (security definer, dono da tabela)
+revoke insert, update, delete, truncate on current_prices from anon, authenticated;
+alter table current_prices enable row level security;
+drop policy if exists current_prices_leitura on current_prices;
+create policy current_prices_leitura on current_prices for select to anon, authenticated using (true);
+
+-- Carga inicial a partir do histórico
+insert into current_prices
+select distinct on (produto_chave, cnpj_supermercado) *
+from (
+    select
+        coalesce(nullif(codigo_barras, ''), nome_produto_normalizado) as produto_chave,
+        cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro
+    from produtos
+    where preco_produto is not null
+      and coalesce(nullif(codigo_barras, ''), nome_produto_normalizado) is not null
+) as observacoes
+order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+on conflict do nothing;
@@ -0,0 +1,3 @@
+-- Paginação por cursor de /api/search: ordem (preco_produto, id_registro) servida pelo índice,
+-- de modo que cada página lê só as linhas seguintes ao cursor.
+create index if not exists current_prices_preco_keyset_idx on current_prices (preco_produto, id_registro);
@@ -0,0 +1,224 @@
+-- Dicionário canônico de produtos e mercados: cada chave ganha um id inteiro compacto na ingestão,
+-- e as análises agrupam por esses ids em vez de strings longas (nome normalizado, nome do mercado).
+-- produto_chave = GTIN quando houver, senão o nome normalizado (mesma chave de current_prices).
+-- Uma única transação: se o backfill falhar, os triggers de produtos não ficam desabilitados.
+
+begin;
+
+create table if not exists produto_ids (
+    id integer generated always as identity primary key,
+    chave text not null unique,
+    codigo_barras text,
+    nome_produto_normalizado text,
+    criado_em timestamptz not null default now()
+);
+
+create table if not exists mercado_ids (
+    id integer generated always as identity primary key,
+    cnpj text not null unique,
+    criado_em timestamptz not null default now()
+);
+
+alter table produtos add column if not exists produto_id integer references produto_ids (id);
+alter table produtos add column if not exists mercado_id integer references mercado_ids (id);
+alter table current_prices add column if not exists produto_id integer;
+alter table current_prices add column if not exists mercado_id integer;
+
+-- Atribui os ids a cada linha gravada (coleta completa e write-back do tempo real); a consulta pelo
+-- índice único resolve as chaves já conhecidas, só chaves novas chegam ao insert
+create or replace function atribuir_ids_produto()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_chave text := coalesce(nullif(new.codigo_barras, ''), new.nome_produto_normalizado);
+begin
+    if v_chave is not null and (tg_op = 'INSERT' or new.produto_id is null
+        or v_chave is distinct from coalesce(nullif(old.codigo_barras, ''), old.nome_produto_normalizado)) then
+        select id into new.produto_id from produto_ids where chave = v_chave;
+        if not found then
+            insert into produto_ids (chave, codigo_barras, nome_produto_normalizado)
+            values (v_chave, nullif(new.codigo_barras, ''), new.nome_produto_normalizado)
+            on conflict (chave) do nothing;
+            select id into new.produto_id from produto_ids where chave = v_chave;
+        end if;
+    end if;
+
+    if new.cnpj_supermercado is not null and (tg_op = 'INSERT' or new.mercado_id is null
+        or new.cnpj_supermercado is distinct from old.cnpj_supermercado) then
+        select id into new.mercado_id from mercado_ids where cnpj = new.cnpj_supermercado;
+        if not found then
+            insert into mercado_ids (cnpj) values (new.cnpj_supermercado) on conflict (cnpj) do nothing;
+            select id into new.mercado_id from mercado_ids where cnpj = new.cnpj_supermercado;
+        end if;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists produtos_atribuir_ids on produtos;
+create trigger produtos_atribuir_ids
+    before insert or update on produtos
+    for each row execute function atribuir_ids_produto();
+
+-- sync_current_prices (sql/004) passa a copiar os ids para o snapshot
+create or replace function sync_current_prices()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    insert into current_prices (
+        produto_chave, cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro, produto_id, mercado_id
+    )
+    select distinct on (produto_chave, cnpj_supermercado) *
+    from (
+        select
+            coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) as produto_chave,
+            n.cnpj_supermercado, n.nome_supermercado, n.nome_produto, n.nome_produto_normalizado,
+            n.codigo_barras, n.preco_produto, n.unidade_medida, n.tipo_unidade, n.data_ultima_venda, n.data_coleta,
+            n.endereco_supermercado, n.id_registro, n.produto_id, n.mercado_id
+        from novos n
+        where n.preco_produto is not null
+          and coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) is not null
+    ) as observacoes
+    order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+    on conflict (produto_chave, cnpj_supermercado) do update set
+        nome_supermercado = excluded.nome_supermercado,
+        nome_produto = excluded.nome_produto,
+        nome_produto_normalizado = excluded.nome_produto_normalizado,
+        codigo_barras = excluded.codigo_barras,
+        preco_produto = excluded.preco_produto,
+        unidade_medida = excluded.unidade_medida,
+        tipo_unidade = excluded.tipo_unidade,
+        data_ultima_venda = excluded.data_ultima_venda,
+        data_coleta = excluded.data_coleta,
+        endereco_supermercado = coalesce(excluded.endereco_supermercado, current_prices.endereco_supermercado),
+        id_registro = excluded.id_registro,
+        produto_id = excluded.produto_id,
+        mercado_id = excluded.mercado_id
+    where (excluded.data_ultima_venda, excluded.data_coleta) >= (current_prices.data_ultima_venda, current_prices.data_coleta)
+       or current_prices.data_ultima_venda is null;
+    return null;
+end;
+$$;
+
+-- sync_current_prices_delete (sql/004) passa a recalcular também os ids
+create or replace function sync_current_prices_delete()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_chaves text[];
+    v_cnpjs text[];
+begin
+    -- Só as chaves cujo preço atual foi apagado mudam; as demais continuam com a observação vigente
+    with removidas as (
+        delete from current_prices cp
+        using removidos r
+        where cp.id_registro = r.id_registro
+        returning cp.produto_chave, cp.cnpj_supermercado
+    )
+    select array_agg(produto_chave), array_agg(cnpj_supermercado) into v_chaves, v_cnpjs
+    from removidas;
+
+    if v_chaves is null then
+        return null;
+    end if;
+
+    insert into current_prices (
+        produto_chave, cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro, produto_id, mercado_id
+    )
+    select distinct on (produto_chave, cnpj_supermercado) *
+    from (
+        select
+            c.produto_chave,
+            n.cnpj_supermercado, n.nome_supermercado, n.nome_produto, n.nome_produto_normalizado,
+            n.codigo_barras, n.preco_produto, n.unidade_medida, n.tipo_unidade, n.data_ultima_venda, n.data_coleta,
+            n.endereco_supermercado, n.id_registro, n.produto_id, n.mercado_id
+        from unnest(v_chaves, v_cnpjs) as c (produto_chave, cnpj_supermercado)
+        join produtos n
+          on coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) = c.produto_chave
+         and n.cnpj_supermercado = c.cnpj_supermercado
+        where n.preco_produto is not null
+    ) as observacoes
+    order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+    on conflict (produto_chave, cnpj_supermercado) do nothing;
+    return null;
+end;
+$$;
+
+-- cp.* é expandido na criação da view: recriada para incluir as colunas novas
+drop view if exists current_prices_enderecos;
+create view current_prices_enderecos as
+select cp.*, s.endereco as endereco_mercado
+from current_prices cp
+left join supermercados s on s.cnpj = cp.cnpj_supermercado;
+
+grant select on produto_ids, mercado_ids, current_prices_enderecos to anon, authenticated;
+
+-- Dicionários somente leitura pela API: os ids são atribuídos pelo trigger (security definer)
+revoke insert, update, delete, truncate on produto_ids, mercado_ids from anon, authenticated;
+alter table produto_ids enable row level security;
+alter table mercado_ids enable row level security;
+drop policy if exists produto_ids_leitura on produto_ids;
+create policy produto_ids_leitura on produto_ids for select to anon, authenticated using (true);
+drop policy if exists mercado_ids_leitura on mercado_ids;
+create policy mercado_ids_leitura on mercado_ids for select to anon, authenticated using (true);
+
+-- Carga inicial a partir do histórico
+insert into produto_ids (chave, codigo_barras, nome_produto_normalizado)
+select distinct on (chave) chave, nullif(codigo_barras, ''), nome_produto_normalizado
+from (
+    select coalesce(nullif(codigo_barras, ''), nome_produto_normalizado) as chave, codigo_barras, nome_produto_normalizado
+    from produtos
+) as chaves
+where chave is not null
+order by chave
+on conflict (chave) do nothing;
+
+insert into mercado_ids (cnpj)
+select distinct cnpj_supermercado from produtos where cnpj_supermercado is not null
+on conflict (cnpj) do nothing;
+
+-- Os triggers de produtos ficam fora do backfill (ids já resolvidos em lote; current_prices atualizado abaixo);
+-- se algo falhar antes do enable, o rollback também desfaz o disable
+alter table produtos disable trigger user;
+
+update produtos p
+set produto_id = d.id
+from produto_ids d
+where d.chave = coalesce(nullif(p.codigo_barras, ''), p.nome_produto_normalizado)
+  and p.produto_id is null;
+
+update produtos p
+set mercado_id = m.id
+from mercado_ids m
+where m.cnpj = p.cnpj_supermercado
+  and p.mercado_id is null;
+
+alter table produtos enable trigger user;
+
+update current_prices cp
+set produto_id = d.id
+from produto_ids d
+where d.chave = cp.produto_chave;
+
+update current_prices cp
+set mercado_id = m.id
+from mercado_ids m
+where m.cnpj = cp.cnpj_supermercado;
+
+create index if not exists produtos_produto_id_idx on produtos (produto_id);
+create index if not exists produtos_mercado_id_idx on produtos (mercado_id);
+
+commit;
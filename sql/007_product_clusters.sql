@@ -0,0 +1,19 @@
+-- Clusters de produtos equivalentes sem GTIN (product_clusters.py): cada nome normalizado sem
+-- código de barras recebe um cluster_id; nomes do mesmo cluster são o mesmo produto em descrições
+-- diferentes. Os ids são preservados entre reconstruções para comparações e cestas continuarem válidas.
+
+create table if not exists produto_clusters (
+    nome_produto_normalizado text primary key,
+    cluster_id integer not null,
+    atualizado_em timestamptz not null default now()
+);
+
+create index if not exists produto_clusters_cluster_idx on produto_clusters (cluster_id);
+
+grant select on produto_clusters to anon, authenticated;
+
+-- Gravada só pelo backend (service role); leitura liberada
+revoke insert, update, delete, truncate on produto_clusters from anon, authenticated;
+alter table produto_clusters enable row level security;
+drop policy if exists produto_clusters_leitura on produto_clusters;
+create policy produto_clusters_leitura on produto_clusters for select to anon, authenticated using (true);
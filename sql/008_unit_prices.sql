@@ -0,0 +1,123 @@
+-- Preço por unidade base (KG, L ou UN), calculado na ingestão a partir da descrição
+-- (collector_service.anotar_precos_unitarios): comparações e cestas ordenam pelo preço real por
+-- quilo/litro sem interpretar a embalagem a cada requisição. Linhas antigas ficam nulas até serem
+-- coletadas de novo; a aplicação calcula o valor ao ler essas linhas.
+
+alter table produtos add column if not exists quantidade_embalagem numeric;
+alter table produtos add column if not exists unidade_base text;
+alter table produtos add column if not exists preco_unitario numeric;
+alter table current_prices add column if not exists quantidade_embalagem numeric;
+alter table current_prices add column if not exists unidade_base text;
+alter table current_prices add column if not exists preco_unitario numeric;
+
+-- sync_current_prices (sql/006) passa a copiar também o preço por unidade base
+create or replace function sync_current_prices()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    insert into current_prices (
+        produto_chave, cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro, produto_id, mercado_id,
+        quantidade_embalagem, unidade_base, preco_unitario
+    )
+    select distinct on (produto_chave, cnpj_supermercado) *
+    from (
+        select
+            coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) as produto_chave,
+            n.cnpj_supermercado, n.nome_supermercado, n.nome_produto, n.nome_produto_normalizado,
+            n.codigo_barras, n.preco_produto, n.unidade_medida, n.tipo_unidade, n.data_ultima_venda, n.data_coleta,
+            n.endereco_supermercado, n.id_registro, n.produto_id, n.mercado_id,
+            n.quantidade_embalagem, n.unidade_base, n.preco_unitario
+        from novos n
+        where n.preco_produto is not null
+          and coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) is not null
+    ) as observacoes
+    order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+    on conflict (produto_chave, cnpj_supermercado) do update set
+        nome_supermercado = excluded.nome_supermercado,
+        nome_produto = excluded.nome_produto,
+        nome_produto_normalizado = excluded.nome_produto_normalizado,
+        codigo_barras = excluded.codigo_barras,
+        preco_produto = excluded.preco_produto,
+        unidade_medida = excluded.unidade_medida,
+        tipo_unidade = excluded.tipo_unidade,
+        data_ultima_venda = excluded.data_ultima_venda,
+        data_coleta = excluded.data_coleta,
+        endereco_supermercado = coalesce(excluded.endereco_supermercado, current_prices.endereco_supermercado),
+        id_registro = excluded.id_registro,
+        produto_id = excluded.produto_id,
+        mercado_id = excluded.mercado_id,
+        quantidade_embalagem = excluded.quantidade_embalagem,
+        unidade_base = excluded.unidade_base,
+        preco_unitario = excluded.preco_unitario
+    where (excluded.data_ultima_venda, excluded.data_coleta) >= (current_prices.data_ultima_venda, current_prices.data_coleta)
+       or current_prices.data_ultima_venda is null;
+    return null;
+end;
+$$;
+
+-- sync_current_prices_delete (sql/006) passa a recalcular também o preço por unidade base
+create or replace function sync_current_prices_delete()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_chaves text[];
+    v_cnpjs text[];
+begin
+    -- Só as chaves cujo preço atual foi apagado mudam; as demais continuam com a observação vigente
+    with removidas as (
+        delete from current_prices cp
+        using removidos r
+        where cp.id_registro = r.id_registro
+        returning cp.produto_chave, cp.cnpj_supermercado
+    )
+    select array_agg(produto_chave), array_agg(cnpj_supermercado) into v_chaves, v_cnpjs
+    from removidas;
+
+    if v_chaves is null then
+        return null;
+    end if;
+
+    insert into current_prices (
+        produto_chave, cnpj_supermercado, nome_supermercado, nome_produto, nome_produto_normalizado,
+        codigo_barras, preco_produto, unidade_medida, tipo_unidade, data_ultima_venda, data_coleta,
+        endereco_supermercado, id_registro, produto_id, mercado_id,
+        quantidade_embalagem, unidade_base, preco_unitario
+    )
+    select distinct on (produto_chave, cnpj_supermercado) *
+    from (
+        select
+            c.produto_chave,
+            n.cnpj_supermercado, n.nome_supermercado, n.nome_produto, n.nome_produto_normalizado,
+            n.codigo_barras, n.preco_produto, n.unidade_medida, n.tipo_unidade, n.data_ultima_venda, n.data_coleta,
+            n.endereco_supermercado, n.id_registro, n.produto_id, n.mercado_id,
+            n.quantidade_embalagem, n.unidade_base, n.preco_unitario
+        from unnest(v_chaves, v_cnpjs) as c (produto_chave, cnpj_supermercado)
+        join produtos n
+          on coalesce(nullif(n.codigo_barras, ''), n.nome_produto_normalizado) = c.produto_chave
+         and n.cnpj_supermercado = c.cnpj_supermercado
+        where n.preco_produto is not null
+    ) as observacoes
+    order by produto_chave, cnpj_supermercado, data_ultima_venda desc nulls last, data_coleta desc nulls last
+    on conflict (produto_chave, cnpj_supermercado) do nothing;
+    return null;
+end;
+$$;
+
+-- cp.* é expandido na criação da view: recriada para incluir as colunas novas
+drop view if exists current_prices_enderecos;
+create view current_prices_enderecos as
+select cp.*, s.endereco as endereco_mercado
+from current_prices cp
+left join supermercados s on s.cnpj = cp.cnpj_supermercado;
+
+grant select on current_prices_enderecos to anon, authenticated;
+
+create index if not exists current_prices_preco_unitario_idx on current_prices (unidade_base, preco_unitario);
@@ -0,0 +1,43 @@
+# test_embalagem.py - Quantidade da embalagem por unidade base a partir da descrição do produto
+import unittest
+
+from collector_service import anotar_precos_unitarios, extrair_embalagem
+
+# (descrição, unidade da API) -> (quantidade, unidade base)
+CASOS = [
+    (("ARROZ TIO JOAO TIPO 1 5KG", "UN"), (5.0, 'KG')),
+    (("LEITE UHT INTEGRAL 1L", "UN"), (1.0, 'L')),
+    (("REFRIGERANTE COLA 1,5L", ""), (1.5, 'L')),
+    (("CAFE TORRADO 500 G", ""), (0.5, 'KG')),
+    (("IOGURTE MORANGO 6X170G", ""), (1.02, 'KG')),
+    (("AGUA MINERAL 12 X 1,5L", ""), (18.0, 'L')),
+    (("CERVEJA LATA 350ML C/12", "UN"), (4.2, 'L')),
+    (("CERVEJA LATA 350ML C/ 12", "UN"), (4.2, 'L')),
+    (("SABONETE 85G 4 UN", ""), (0.34, 'KG')),
+    (("BISCOITO RECHEADO 3 PACOTES 130G", ""), (0.39, 'KG')),
+    (("PAPEL HIG 12 ROLOS", "UN"), (12.0, 'UN')),
+    (("PAPEL TOALHA 2 ROLOS", ""), (2.0, 'UN')),
+    (("OVOS BRANCOS C/12", ""), (12.0, 'UN')),
+    (("FRALDA INFANTIL G 30UN", ""), (30.0, 'UN')),
+    (("ESPONJA MULTIUSO", ""), (1.0, 'UN')),
+    (("BANANA PRATA", "KG"), (1.0, 'KG')),
+    (("", ""), (1.0, 'UN')),
+]
+
+class ExtrairEmbalagemTest(unittest.TestCase):
+    def test_tabela_de_descricoes(self):
+        for (descricao, unidade), esperado in CASOS:
+            with self.subTest(descricao=descricao):
+                quantidade, base = extrair_embalagem(descricao, unidade)
+                self.assertEqual(base, esperado[1])
+                self.assertAlmostEqual(quantidade, esperado[0], places=6)
+
+    def test_preco_unitario_usa_a_embalagem_inteira(self):
+        registro, = anotar_precos_unitarios([
+            {'nome_produto': 'CERVEJA LATA 350ML C/12', 'unidade_medida': 'UN', 'preco_produto': 42.0}
+        ])
+        self.assertEqual(registro['unidade_base'], 'L')
+        self.assertEqual(registro['preco_unitario'], 10.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# user_directory.py - Diretório em memória dos usuários do Supabase Auth (id -> e-mail)
+import os
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+# --- Configurações ---
+USER_DIRECTORY_PAGE_SIZE = int(os.getenv("USER_DIRECTORY_PAGE_SIZE", "1000"))
+USER_DIRECTORY_REFRESH_SECONDS = int(os.getenv("USER_DIRECTORY_REFRESH_SECONDS", "300"))
+USER_DIRECTORY_FULL_RELOAD_SECONDS = int(os.getenv("USER_DIRECTORY_FULL_RELOAD_SECONDS", "3600"))
+USER_DIRECTORY_MISS_CONCURRENCY = 8
+
+class UserDirectory:
+    """
+    Mantém o e-mail de todos os usuários do Auth em memória, carregado em lote pela API admin
+    de listagem (paginada). Uma atualização periódica incremental busca as páginas mais recentes
+    até encontrar uma página sem novidades; periodicamente o diretório é recarregado por completo.
+    Usuários ausentes são buscados individualmente e adicionados ao diretório.
+    """
+    def __init__(
+        self,
+        supabase_admin_client: Any,
+        tamanho_pagina: int = USER_DIRECTORY_PAGE_SIZE,
+        intervalo_atualizacao: float = USER_DIRECTORY_REFRESH_SECONDS,
+        intervalo_recarga_completa: float = USER_DIRECTORY_FULL_RELOAD_SECONDS
+    ):
+        self.supabase_admin_client = supabase_admin_client
+        self.tamanho_pagina = tamanho_pagina
+        self.intervalo_atualizacao = intervalo_atualizacao
+        self.intervalo_recarga_completa = intervalo_recarga_completa
+        self._usuarios: Dict[str, Dict[str, Any]] = {}
+        self._carregado_em: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._tarefa_atualizacao: Optional[asyncio.Task] = None
+        self.stats = {'hits': 0, 'misses': 0, 'cargas_completas': 0, 'atualizacoes': 0, 'paginas': 0}
+
+    # --- Carga a partir da API admin ---
+    @staticmethod
+    def _resumir(user: Any) -> Dict[str, Any]:
+        return {
+            'email': getattr(user, 'email', None),
+            'updated_at': str(getattr(user, 'updated_at', '') or ''),
+            'last_sign_in_at': getattr(user, 'last_sign_in_at', None)
+        }
+
+    def _listar_pagina(self, pagina: int) -> List[Any]:
+        return self.supabase_admin_client.auth.admin.list_users(page=pagina, per_page=self.tamanho_pagina) or []
+
+    async def carregar(self, forcar: bool = True):
+        """Recarrega o diretório completo, página a página"""
+        async with self._lock:
+            if not forcar and self._carregado_em is not None:
+                return
+            usuarios: Dict[str, Dict[str, Any]] = {}
+            pagina = 1
+            while True:
+                lote = await asyncio.to_thread(self._listar_pagina, pagina)
+                self.stats['paginas'] += 1
+                for user in lote:
+                    usuarios[str(user.id)] = self._resumir(user)
+                if len(lote) < self.tamanho_pagina:
+                    break
+                pagina += 1
+            self._usuarios = usuarios
+            self._carregado_em = time.time()
+            self.stats['cargas_completas'] += 1
+            logging.info(f"👥 Diretório de usuários carregado: {len(usuarios)} usuários ({pagina} páginas)")
+
+    async def atualizar(self):
+        """Atualização incremental: percorre as páginas até encontrar uma sem usuários novos ou alterados"""
+        if self._carregado_em is None or time.time() - self._carregado_em > self.intervalo_recarga_completa:
+            await self.carregar()
+            return
+
+        async with self._lock:
+            pagina = 1
+            alterados = 0
+            while True:
+                lote = await asyncio.to_thread(self._listar_pagina, pagina)
+                self.stats['paginas'] += 1
+                novidades = 0
+                for user in lote:
+                    resumo = self._resumir(user)
+                    if self._usuarios.get(str(user.id)) != resumo:
+                        self._usuarios[str(user.id)] = resumo
+                        novidades += 1
+                alterados += novidades
+                if not novidades or len(lote) < self.tamanho_pagina:
+                    break
+                pagina += 1
+            self.stats['atualizacoes'] += 1
+            if alterados:
+                logging.info(f"👥 Diretório de usuários: {alterados} usuários novos ou alterados")
+
+    async def _loop_atualizacao(self):
+        while True:
+            await asyncio.sleep(self.intervalo_atualizacao)
+            try:
+                await self.atualizar()
+            except Exception as e:
+                logging.error(f"Erro ao atualizar diretório de usuários: {e}")
+
+    async def iniciar(self):
+        """Carrega o diretório e agenda a atualização periódica"""
+        try:
+            await self.carregar()
+        except Exception as e:
+            logging.error(f"Erro ao carregar diretório de usuários (será carregado sob demanda): {e}")
+        if self._tarefa_atualizacao is None or self._tarefa_atualizacao.done():
+            self._tarefa_atualizacao = asyncio.create_task(self._loop_atualizacao())
+
+    async def parar(self):
+        if self._tarefa_atualizacao is not None:
+            self._tarefa_atualizacao.cancel()
+            await asyncio.gather(self._tarefa_atualizacao, return_exceptions=True)
+            self._tarefa_atualizacao = None
+
+    # --- Consulta ---
+    def _buscar_individual(self, user_id: str) -> Optional[str]:
+        auth_response = self.supabase_admin_client.auth.admin.get_user_by_id(user_id)
+        if auth_response and auth_response.user:
+            self._usuarios[user_id] = self._resumir(auth_response.user)
+            return auth_response.user.email
+        return None
+
+    def email_em_memoria(self, user_id: Optional[str]) -> Optional[str]:
+        """E-mail do usuário se já estiver no diretório (sem acesso à rede)"""
+        usuario = self._usuarios.get(str(user_id)) if user_id else None
+        return usuario['email'] if usuario else None
+
+    def obter_email_sync(self, user_id: Optional[str]) -> Optional[str]:
+        """Versão síncrona de obter_email, para funções que já rodam em threads de background"""
+        if not user_id:
+            return None
+        if str(user_id) in self._usuarios:
+            self.stats['hits'] += 1
+            return self._usuarios[str(user_id)]['email']
+        self.stats['misses'] += 1
+        try:
+            return self._buscar_individual(str(user_id))
+        except Exception as e:
+            logging.error(f"Erro ao buscar e-mail do usuário {user_id}: {e}")
+            return None
+
+    async def obter_emails(self, user_ids: Iterable[Optional[str]]) -> Dict[str, Optional[str]]:
+        """Resolve o e-mail de vários usuários; apenas os ausentes do diretório vão à API do Auth"""
+        if self._carregado_em is None:
+            try:
+                await self.carregar(forcar=False)
+            except Exception as e:
+                logging.error(f"Erro ao carregar diretório de usuários: {e}")
+
+        ids = list(dict.fromkeys(str(uid) for uid in user_ids if uid))
+        ausentes = [uid for uid in ids if uid not in self._usuarios]
+        self.stats['hits'] += len(ids) - len(ausentes)
+        self.stats['misses'] += len(ausentes)
+
+        if ausentes:
+            semaforo = asyncio.Semaphore(USER_DIRECTORY_MISS_CONCURRENCY)
+
+            async def buscar(uid: str):
+                async with semaforo:
+                    try:
+                        await asyncio.to_thread(self._buscar_individual, uid)
+                    except Exception as e:
+                        logging.error(f"Erro ao buscar e-mail do usuário {uid}: {e}")
+
+            await asyncio.gather(*(buscar(uid) for uid in ausentes))
+
+        return {uid: self.email_em_memoria(uid) for uid in ids}
+
+    async def obter_email(self, user_id: Optional[str]) -> Optional[str]:
+        if not user_id:
+            return None
+        return (await self.obter_emails([user_id])).get(str(user_id))
+
+    # --- Atualizações feitas pela própria aplicação ---
+    def registrar(self, user_id: str, email: Optional[str]):
+        """Atualiza o diretório após criar usuário ou alterar e-mail"""
+        atual = self._usuarios.get(str(user_id), {})
+        self._usuarios[str(user_id)] = {**atual, 'email': email, 'updated_at': atual.get('updated_at', '')}
+
+    def remover(self, user_id: str):
+        self._usuarios.pop(str(user_id), None)
+
+    def estatisticas(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'usuarios': len(self._usuarios),
+            'carregado_em': self._carregado_em
+        }
@@ -8,6 +8,54 @@ document.addEventListener('DOMContentLoaded', () => {
         return;
     }
 
+    // Mercados marcados na página (vazio = todos)
+    const getSelectedCnpjs = () => {
+        return Array.from(document.querySelectorAll('input[name="supermarket"]:checked')).map(cb => cb.value);
+    };
+
+    const formatPrice = (value) => `R$ ${Number(value).toFixed(2).replace('.', ',')}`;
+
+    // Consulta direta ao índice de códigos de barras do servidor (sem passar pela busca genérica)
+    const lookupBarcode = async (code) => {
+        const params = new URLSearchParams();
+        getSelectedCnpjs().forEach(cnpj => params.append('cnpjs', cnpj));
+        const response = await fetch(`/api/barcode/${encodeURIComponent(code)}?${params.toString()}`);
+        if (!response.ok) {
+            throw new Error(`Erro HTTP ${response.status}`);
+        }
+        return response.json();
+    };
+
+    // Vários códigos em uma única requisição (modo lista de compras)
+    const lookupBarcodes = async (codes) => {
+        const response = await fetch('/api/barcode/batch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ gtins: codes, cnpjs: getSelectedCnpjs() })
+        });
+        if (!response.ok) {
+            throw new Error(`Erro HTTP ${response.status}`);
+        }
+        return response.json();
+    };
+
+    const describeBarcodeResult = (result) => {
+        if (!result.encontrado) {
+            return `Código ${result.gtin}: sem preço registrado`;
+        }
+        return `${result.nome_produto}: ${formatPrice(result.menor_preco)} em ${result.mercado_mais_barato}`;
+    };
+
+    // Mostra o menor preço conhecido logo após a leitura; a busca completa continua disponível no campo
+    const showBarcodePrices = async (code) => {
+        try {
+            const result = await lookupBarcode(code);
+            showBarcodeNotification(describeBarcodeResult(result));
+        } catch (error) {
+            console.error('Erro ao consultar código de barras:', error);
+        }
+    };
+
     // Verificar se a API de câmera é suportada
     const isCameraSupported = () => {
         return 'mediaDevices' in navigator && 'getUserMedia' in navigator.mediaDevices;
@@ -67,10 +115,14 @@ document.addEventListener('DOMContentLoaded', () => {
                 <div class="scanner-status" id="scannerStatus">
                     Preparando câmera...
                 </div>
+                <ul class="scanner-list" id="scannerList" style="display: none; max-height: 180px; overflow-y: auto; margin: 0; padding: 0.5rem 1rem; list-style: none;"></ul>
                 <div class="scanner-footer">
                     <button class="btn outline" id="toggleTorch">
                         <i class="fas fa-lightbulb"></i> Luz
                     </button>
+                    <button class="btn outline" id="toggleListMode">
+                        <i class="fas fa-list"></i> Lista
+                    </button>
                     <button class="btn" id="manualInput">
                         <i class="fas fa-keyboard"></i> Inserir Manualmente
                     </button>
@@ -89,13 +141,17 @@ document.addEventListener('DOMContentLoaded', () => {
             statusElement.textContent = 'Aponte para um código de barras...';
         });
 
+        // Modo lista: o scanner continua aberto e cada código lido entra na lista de compras
+        const shoppingList = createShoppingList(scannerModal.querySelector('#scannerList'), statusElement);
+
         // Inicializar QuaggaJS para leitura de código de barras
-        initQuaggaJS(video, scannerModal, statusElement);
+        initQuaggaJS(video, scannerModal, statusElement, shoppingList);
 
         // Event listeners
         const closeBtn = scannerModal.querySelector('.close-scanner');
         const toggleTorch = scannerModal.querySelector('#toggleTorch');
         const manualInput = scannerModal.querySelector('#manualInput');
+        const toggleListMode = scannerModal.querySelector('#toggleListMode');
 
         closeBtn.addEventListener('click', () => closeScanner(scannerModal, stream));
         scannerModal.addEventListener('click', (e) => {
@@ -112,19 +168,92 @@ document.addEventListener('DOMContentLoaded', () => {
                 '<i class="fas fa-lightbulb"></i> Ligar Luz';
         });
 
+        toggleListMode.addEventListener('click', () => {
+            const active = shoppingList.toggle();
+            toggleListMode.innerHTML = active ?
+                '<i class="fas fa-list"></i> Encerrar Lista' :
+                '<i class="fas fa-list"></i> Lista';
+        });
+
         // Entrada manual
         manualInput.addEventListener('click', () => {
             const barcode = prompt('Digite o código de barras:');
             if (barcode && barcode.trim()) {
+                if (shoppingList.active) {
+                    shoppingList.add(barcode.trim());
+                    return;
+                }
                 searchInput.value = barcode.trim();
                 closeScanner(scannerModal, stream);
                 showBarcodeNotification(`Código inserido: ${barcode.trim()}`);
+                showBarcodePrices(barcode.trim());
             }
         });
     };
 
+    // Lista de compras: leituras próximas são agrupadas em uma única consulta em lote
+    const createShoppingList = (listElement, statusElement) => {
+        const items = new Map();
+        let pending = [];
+        let timer = null;
+
+        const render = () => {
+            listElement.innerHTML = '';
+            let total = 0;
+            items.forEach((result, code) => {
+                const item = document.createElement('li');
+                item.style.padding = '0.25rem 0';
+                item.textContent = result ? describeBarcodeResult(result) : `Código ${code}: consultando...`;
+                listElement.appendChild(item);
+                if (result && result.encontrado) {
+                    total += Number(result.menor_preco);
+                }
+            });
+            statusElement.textContent = `${items.size} item(ns) na lista - menor total: ${formatPrice(total)}`;
+        };
+
+        const flush = async () => {
+            timer = null;
+            const codes = pending;
+            pending = [];
+            try {
+                const data = await lookupBarcodes(codes);
+                data.results.forEach(result => items.set(result.gtin, result));
+                data.invalidos.forEach(code => items.delete(code));
+            } catch (error) {
+                console.error('Erro ao consultar lista de códigos:', error);
+                codes.forEach(code => items.delete(code));
+                showBarcodeNotification('Não foi possível consultar os preços da lista');
+            }
+            render();
+        };
+
+        return {
+            active: false,
+            toggle() {
+                this.active = !this.active;
+                listElement.style.display = this.active ? 'block' : 'none';
+                if (this.active) {
+                    render();
+                }
+                return this.active;
+            },
+            add(code) {
+                if (items.has(code)) {
+                    return;
+                }
+                items.set(code, null);
+                pending.push(code);
+                render();
+                if (!timer) {
+                    timer = setTimeout(flush, 300);
+                }
+            }
+        };
+    };
+
     // Inicializar QuaggaJS para decodificação
-    const initQuaggaJS = (video, modal, statusElement) => {
+    const initQuaggaJS = (video, modal, statusElement, shoppingList) => {
         const Quagga = window.Quagga;
 
         if (!Quagga) {
@@ -172,9 +301,15 @@ document.addEventListener('DOMContentLoaded', () => {
             statusElement.textContent = 'Scanner ativo - Aponte para um código de barras';
 
             // Detectar código de barras
+            let handled = false;
             Quagga.onDetected((result) => {
                 const code = result.codeResult.code;
-                if (code) {
+                if (code && shoppingList.active) {
+                    shoppingList.add(code);
+                    return;
+                }
+                if (code && !handled) {
+                    handled = true;
                     statusElement.textContent = `Código detectado: ${code}`;
                     statusElement.style.color = 'var(--success)';
 
@@ -189,6 +324,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         Quagga.stop();
                         closeScanner(modal, video.srcObject);
                         showBarcodeNotification(`Código lido: ${code}`);
+                        showBarcodePrices(code);
                     }, 1000);
                 }
             });
@@ -6,6 +6,11 @@ class UserActivityMonitor {
         this.isInitialized = false;
         this.currentPage = '';
         this.userId = null;
+        // Eventos acumulados e enviados em lote para /api/log-events
+        this.eventQueue = [];
+        this.maxBatchSize = 50;
+        this.flushIntervalMs = 10000;
+        this.flushTimer = null;
         this.init();
     }
 
@@ -107,63 +112,65 @@ class UserActivityMonitor {
         }
     }
 
-    async logPageAccess(pageKey) {
-        try {
-            const token = this.getToken();
-            if (!token) return;
-
-            const response = await fetch('/api/log-page-access', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${token}`
-                },
-                body: JSON.stringify({
-                    page_key: pageKey
-                })
-            });
-
-            if (!response.ok) {
-                throw new Error(`HTTP ${response.status}`);
-            }
+    enqueueEvent(event) {
+        this.eventQueue.push({ ...event, timestamp: new Date().toISOString() });
 
-            console.log(`Acesso à página ${pageKey} registrado`);
-        } catch (error) {
-            console.error('Erro ao registrar acesso à página:', error);
+        if (this.eventQueue.length >= this.maxBatchSize) {
+            this.flushEvents();
+        } else if (!this.flushTimer) {
+            this.flushTimer = setTimeout(() => this.flushEvents(), this.flushIntervalMs);
         }
     }
 
-    async logCustomAction(actionType, details = {}) {
-        try {
-            const token = this.getToken();
-            if (!token) return;
+    flushEvents(useBeacon = false) {
+        if (this.flushTimer) {
+            clearTimeout(this.flushTimer);
+            this.flushTimer = null;
+        }
+        if (this.eventQueue.length === 0) return;
 
-            const logData = {
-                action_type: actionType,
-                page: this.currentPage,
-                details: details,
-                timestamp: new Date().toISOString()
-            };
+        const token = this.getToken();
+        const events = this.eventQueue.splice(0, this.eventQueue.length);
+
+        try {
+            if (useBeacon && navigator.sendBeacon) {
+                // sendBeacon não permite cabeçalhos: o token vai no corpo
+                const blob = new Blob(
+                    [JSON.stringify({ events, access_token: token || null })],
+                    { type: 'application/json' }
+                );
+                if (navigator.sendBeacon('/api/log-events', blob)) return;
+            }
 
-            const response = await fetch('/api/log-custom-action', {
+            fetch('/api/log-events', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${token}`
+                    ...(token ? { 'Authorization': `Bearer ${token}` } : {})
                 },
-                body: JSON.stringify(logData)
-            });
-
-            if (!response.ok) {
-                throw new Error(`HTTP ${response.status}`);
-            }
-
-            console.log(`Ação ${actionType} registrada:`, details);
+                body: JSON.stringify({ events }),
+                keepalive: true
+            }).catch(error => console.error('Erro ao enviar eventos de atividade:', error));
         } catch (error) {
-            console.error('Erro ao registrar ação customizada:', error);
+            console.error('Erro ao enviar eventos de atividade:', error);
         }
     }
 
+    async logPageAccess(pageKey) {
+        if (!this.getToken()) return;
+        this.enqueueEvent({ type: 'page_access', page: pageKey });
+    }
+
+    async logCustomAction(actionType, details = {}) {
+        if (!this.getToken()) return;
+        this.enqueueEvent({
+            type: 'custom_action',
+            action_type: actionType,
+            page: this.currentPage,
+            details: details
+        });
+    }
+
     setupActivityListeners() {
         // Monitorar cliques em botões importantes
         this.setupButtonClickTracking();
@@ -234,6 +241,9 @@ class UserActivityMonitor {
         let startTime = Date.now();
         let isActive = true;
 
+        // Envia o que estiver pendente quando a página some ou é fechada
+        window.addEventListener('pagehide', () => this.flushEvents(true));
+
         // Registrar tempo gasto na página
         window.addEventListener('beforeunload', () => {
             const timeSpent = Math.round((Date.now() - startTime) / 1000); // em segundos
@@ -249,6 +259,7 @@ class UserActivityMonitor {
         document.addEventListener('visibilitychange', () => {
             if (document.hidden) {
                 isActive = false;
+                this.flushEvents(true);
             } else {
                 isActive = true;
                 startTime = Date.now(); // Reset timer quando volta para a página